@@ -26,7 +26,11 @@ setup(name='wisper',
       packages=find_packages(),
       entry_points={
             'console_scripts': ['wisper-runserver=wisper.session:run_server',
-                                'wisper=wisper.session:run_client']
+                                'wisper=wisper.session:run_client',
+                                'wisper-bench=wisper.benchmarks:main']
+      },
+      extras_require={
+            'zstd': ['zstandard']
       },
       install_requires=[
             'boto3',
@@ -0,0 +1,86 @@
+import socket
+import threading
+import time
+import unittest
+
+from wisper.framing import JOIN_ROOM, FrameDecoder, encode_frame, encode_join
+
+
+"""Helpers for tests that run servers on localhost
+
+   Every server runs its event loop in a thread of its own. Tests talk to
+     them over real sockets, as clients and as other servers.
+"""
+
+
+def free_port():
+    """Port nothing on localhost is listening on"""
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def read_frames(sock, timeout=0.3):
+    """Frames read from sock until it closes or goes quiet for timeout
+         seconds
+    """
+
+    decoder = FrameDecoder()
+    frames = []
+    sock.settimeout(timeout)
+    try:
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            frames.extend(decoder.feed(data))
+    except socket.timeout:
+        pass
+    return frames
+
+
+def wait_for(condition, timeout=5):
+    """Whether condition became true within timeout seconds"""
+
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class ServerTestCase(unittest.TestCase):
+
+    def run_server(self, server):
+        """Run server in a thread until the test ends"""
+
+        thread = threading.Thread(target=server.start)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.stop_server, server, thread)
+        self.assertTrue(wait_for(lambda: server._running))
+        return server
+
+    def stop_server(self, server, thread):
+        server._running = False
+        # Wake the event loop, so it sees it has been stopped
+        try:
+            socket.create_connection(server.address).close()
+        except socket.error:
+            pass
+        thread.join(5)
+
+    def join(self, server, room):
+        """Connect a client to server, in room"""
+
+        members = server.registry.room_size(room)
+        client = socket.create_connection(server.address)
+        self.addCleanup(client.close)
+        client.sendall(encode_frame(encode_join(room), JOIN_ROOM))
+        self.assertTrue(wait_for(
+            lambda: server.registry.room_size(room) > members))
+        return client
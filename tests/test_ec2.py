@@ -0,0 +1,100 @@
+import os
+import sys
+import unittest
+from StringIO import StringIO
+
+import boto3
+from botocore.stub import Stubber
+
+os.environ.setdefault('INSTANCE_ID', 'i-0123456789abcdef0')
+
+from wisper.aws import ec2
+
+
+"""The Lambda function starting and stopping the server instance, against
+     stubbed AWS clients
+"""
+
+
+def described(state, address=None):
+    """describe_instances response for the instance in state"""
+
+    instance = {'InstanceId': ec2.INSTANCE_ID,
+                'State': {'Name': state, 'Code': 0}}
+    if address is not None:
+        instance['PublicIpAddress'] = address
+    return {'Reservations': [{'Instances': [instance]}]}
+
+
+class InstanceCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stubs = dict()
+        for service in ('ec2', 'ssm'):
+            stub = Stubber(boto3.client(
+                service, region_name='us-east-1', aws_access_key_id='test',
+                aws_secret_access_key='test'))
+            stub.activate()
+            self.addCleanup(stub.deactivate)
+            self.stubs[service] = stub
+            ec2.clients[service] = stub.client
+        self.addCleanup(ec2.clients.clear)
+        cache = ec2.instance_cache
+        ec2.instance_cache = ec2.InstanceCache(60)
+        self.addCleanup(setattr, ec2, 'instance_cache', cache)
+        # The function reports its progress by printing
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        self.addCleanup(setattr, sys, 'stdout', stdout)
+
+    def expect_describe(self, state, address=None):
+        self.stubs['ec2'].add_response(
+            'describe_instances', described(state, address),
+            {'InstanceIds': [ec2.INSTANCE_ID]})
+
+    def expect_dry_run(self, operation):
+        """operation is tried as a dry run, then for real"""
+
+        stub = self.stubs['ec2']
+        stub.add_client_error(
+            operation, 'DryRunOperation',
+            expected_params={'InstanceIds': [ec2.INSTANCE_ID],
+                             'DryRun': True})
+        stub.add_response(operation, {}, {'InstanceIds': [ec2.INSTANCE_ID],
+                                          'DryRun': False})
+
+    def tearDown(self):
+        for stub in self.stubs.values():
+            stub.assert_no_pending_responses()
+
+    def test_description_is_reused_until_it_expires(self):
+        self.expect_describe('running', '203.0.113.1')
+        self.assertEqual(ec2.start_ec2_instance(), '203.0.113.1')
+        self.assertEqual(ec2.get_public_ip(), '203.0.113.1')
+        ec2.instance_cache.described_at -= ec2.instance_cache.ttl
+        self.expect_describe('running', '203.0.113.2')
+        self.assertEqual(ec2.get_public_ip(), '203.0.113.2')
+
+    def test_starting_the_instance_invalidates_its_description(self):
+        self.expect_describe('stopped')
+        self.expect_dry_run('start_instances')
+        # Polled by the instance_running waiter
+        self.expect_describe('running')
+        self.stubs['ssm'].add_response('send_command', {}, {
+            'DocumentName': 'AWS-RunShellScript',
+            'Parameters': {'commands': ['wisper-runserver']},
+            'InstanceIds': [ec2.INSTANCE_ID]})
+        self.expect_describe('running', '203.0.113.1')
+        self.assertEqual(ec2.start_ec2_instance(), '203.0.113.1')
+
+    def test_stopping_the_instance_invalidates_its_description(self):
+        self.expect_describe('running', '203.0.113.1')
+        self.assertEqual(ec2.get_public_ip(), '203.0.113.1')
+        self.expect_dry_run('stop_instances')
+        ec2.stop_ec2_instance()
+        self.expect_describe('stopped')
+        self.assertIsNone(ec2.get_public_ip())
+
+
+if __name__ == '__main__':
+    unittest.main()
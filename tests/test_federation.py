@@ -0,0 +1,157 @@
+import socket
+import unittest
+from StringIO import StringIO
+
+from support import ServerTestCase, free_port, read_frames, wait_for
+from wisper.federation import DIALER, MESSAGE_HEADER, FederatedServer
+from wisper.framing import (FED_HELLO, FED_PROOF, FED_RELAY, PEER_MESSAGE,
+                            encode_frame)
+from wisper.links import encode_relay
+from wisper.utils import ServerLog
+
+
+"""Federated nodes, run together on localhost"""
+
+
+SECRET = 'shared by every node'
+
+
+class FederationTestCase(ServerTestCase):
+
+    def start_node(self, secret=SECRET, peers=()):
+        """Run a node accepting links, until the test ends"""
+
+        return self.run_server(FederatedServer(
+            host='127.0.0.1', port=free_port(), link_port=free_port(),
+            peers=peers, link_secret=secret, idle_grace=60,
+            log=ServerLog(stream=StringIO())))
+
+    def link_address(self, node):
+        return node.link_listener.getsockname()
+
+    def link_up(self, *nodes):
+        """Wait until every node trusts every other"""
+
+        self.assertTrue(wait_for(lambda: all(
+            len(node.link_nodes) == len(nodes) - 1 for node in nodes)))
+
+    def dial(self, node):
+        """Connect to node's link port, returns the socket and the hello
+             payload the node opened with
+        """
+
+        sock = socket.create_connection(self.link_address(node))
+        self.addCleanup(sock.close)
+        kind, hello = read_frames(sock)[0]
+        self.assertEqual(kind, FED_HELLO)
+        return sock, hello
+
+
+class HandshakeTest(FederationTestCase):
+
+    def test_nodes_sharing_the_secret_trust_each_other(self):
+        first = self.start_node()
+        second = self.start_node(peers=[self.link_address(first)])
+        self.assertTrue(wait_for(lambda: first.link_nodes.values() == [
+            second.node_id]))
+        self.assertTrue(wait_for(lambda: second.link_nodes.values() == [
+            first.node_id]))
+
+    def test_hello_is_not_answered_before_the_dialer_proves_itself(self):
+        first = self.start_node()
+        second = self.start_node()
+        client = self.join(first, 'room')
+        to_first, first_hello = self.dial(first)
+        to_second, second_hello = self.dial(second)
+        # Ask second to prove itself for the challenge first gave, claiming
+        #   to be first, then reflect first's own hello back at it
+        to_second.sendall(encode_frame(first_hello, FED_HELLO))
+        answers = read_frames(to_second)
+        self.assertNotIn(FED_PROOF, [kind for kind, payload in answers])
+        # Pose as second to first, with whatever second gave away
+        forged = MESSAGE_HEADER.pack(second_hello[:8], 1, 8) + encode_relay(
+            'room', PEER_MESSAGE, 'forged')
+        to_first.sendall(encode_frame(second_hello, FED_HELLO) + ''.join(
+            encode_frame(payload, kind) for kind, payload in answers
+            if kind == FED_PROOF) + encode_frame(forged, FED_RELAY))
+        read_frames(to_first)
+        self.assertEqual(first.link_nodes, {})
+        self.assertNotIn((PEER_MESSAGE, 'forged'), read_frames(client))
+
+    def test_node_with_another_secret_is_not_trusted(self):
+        first = self.start_node()
+        second = self.start_node(secret='not the shared secret',
+                                 peers=[self.link_address(first)])
+        client = self.join(first, 'room')
+        self.join(second, 'room').sendall(
+            encode_frame('untrusted', PEER_MESSAGE))
+        self.assertNotIn((PEER_MESSAGE, 'untrusted'), read_frames(client, 1))
+        self.assertEqual(first.link_nodes, {})
+        self.assertEqual(second.link_nodes, {})
+
+    def test_failed_proof_drops_the_link(self):
+        node = self.start_node()
+        sock, hello = self.dial(node)
+        impostor = FederatedServer(link_secret='not the shared secret',
+                                   log=ServerLog(stream=StringIO()))
+        self.addCleanup(impostor.socket.close)
+        claim = ('i' * 8, 'c' * 16)
+        sock.sendall(encode_frame(''.join(claim), FED_HELLO) + encode_frame(
+            impostor._proof(DIALER, claim, (hello[:8], hello[8:])),
+            FED_PROOF))
+        self.assertTrue(wait_for(lambda: not node.links))
+        self.assertEqual(sock.recv(65536), '')
+
+    def test_proof_is_bound_to_its_role_and_both_challenges(self):
+        node = FederatedServer(link_secret=SECRET,
+                               log=ServerLog(stream=StringIO()))
+        self.addCleanup(node.socket.close)
+        a, b = ('a' * 8, 'x' * 16), ('b' * 8, 'y' * 16)
+        proof = node._proof('D', a, b)
+        self.assertNotEqual(proof, node._proof('A', a, b))
+        self.assertNotEqual(proof, node._proof('D', b, a))
+        self.assertNotEqual(proof, node._proof('D', a, ('b' * 8, 'z' * 16)))
+
+
+class RelayTest(FederationTestCase):
+
+    def test_message_reaches_each_member_once_over_a_loop(self):
+        first = self.start_node()
+        second = self.start_node(peers=[self.link_address(first)])
+        third = self.start_node(peers=[self.link_address(first),
+                                       self.link_address(second)])
+        self.link_up(first, second, third)
+        sender = self.join(first, 'room')
+        receivers = [self.join(second, 'room'), self.join(third, 'room')]
+        self.assertTrue(wait_for(lambda: all(
+            node._room_size('room') == 3 for node in (first, second, third))))
+        for receiver in receivers:
+            read_frames(receiver)
+        sender.sendall(encode_frame('hello', PEER_MESSAGE))
+        for receiver in receivers:
+            self.assertEqual(read_frames(receiver).count(
+                (PEER_MESSAGE, 'hello')), 1)
+
+
+class PresenceTest(FederationTestCase):
+
+    def test_members_are_counted_on_every_node(self):
+        first = self.start_node()
+        second = self.start_node(peers=[self.link_address(first)])
+        self.link_up(first, second)
+        client = self.join(first, 'room')
+        self.assertTrue(wait_for(lambda: second.remote_members == {
+            'room': {first.node_id: 1}}))
+        client.close()
+        self.assertTrue(wait_for(lambda: second.remote_members == {}))
+
+    def test_late_node_is_sent_the_members_it_missed(self):
+        first = self.start_node()
+        self.join(first, 'room')
+        second = self.start_node(peers=[self.link_address(first)])
+        self.assertTrue(wait_for(lambda: second.remote_members == {
+            'room': {first.node_id: 1}}))
+
+
+if __name__ == '__main__':
+    unittest.main()
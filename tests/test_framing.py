@@ -0,0 +1,52 @@
+import unittest
+
+from wisper.framing import (FILE_CHUNK, HEADER, PEER_MESSAGE, SERVER_NOTICE,
+                            FrameDecoder, FrameError, encode_frame,
+                            frame_kind)
+
+
+"""Encoding and decoding the frames of the wire protocol"""
+
+
+class FrameDecoderTest(unittest.TestCase):
+
+    def test_frames_split_across_reads_are_buffered(self):
+        decoder = FrameDecoder()
+        data = (encode_frame('first', PEER_MESSAGE) +
+                encode_frame('second', SERVER_NOTICE))
+        frames = []
+        for byte in data:
+            frames.extend(decoder.feed(byte))
+        self.assertEqual(frames, [(PEER_MESSAGE, 'first'),
+                                  (SERVER_NOTICE, 'second')])
+        self.assertEqual(len(decoder.buffer), 0)
+
+    def test_every_frame_a_read_completes_is_returned(self):
+        decoder = FrameDecoder()
+        data = (encode_frame('first', PEER_MESSAGE) +
+                encode_frame('second', PEER_MESSAGE))
+        self.assertEqual(decoder.feed(data[:-2]), [(PEER_MESSAGE, 'first')])
+        self.assertEqual(decoder.feed(data[-2:]), [(PEER_MESSAGE, 'second')])
+
+    def test_empty_payload(self):
+        self.assertEqual(FrameDecoder().feed(encode_frame('', SERVER_NOTICE)),
+                         [(SERVER_NOTICE, '')])
+
+    def test_oversize_frame_is_refused_from_its_header(self):
+        decoder = FrameDecoder(max_frame_size=4)
+        self.assertEqual(decoder.feed(encode_frame('four', PEER_MESSAGE)),
+                         [(PEER_MESSAGE, 'four')])
+        with self.assertRaises(FrameError):
+            decoder.feed(HEADER.pack(5, PEER_MESSAGE))
+
+    def test_whole_kinds_are_returned_with_their_header(self):
+        decoder = FrameDecoder(whole_kinds=(FILE_CHUNK,))
+        chunk = encode_frame('chunk', FILE_CHUNK)
+        frames = decoder.feed(chunk + encode_frame('message', PEER_MESSAGE))
+        self.assertEqual(frames, [(FILE_CHUNK, chunk),
+                                  (PEER_MESSAGE, 'message')])
+        self.assertEqual(frame_kind(frames[0][1]), FILE_CHUNK)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import shutil
+import tempfile
+import unittest
+
+from wisper.framing import HEADER, HISTORY_HEADER
+from wisper.history import MessageHistory
+
+
+"""Message history, on disk in a temporary directory"""
+
+
+class RetentionTest(unittest.TestCase):
+
+    def open_history(self, directory=None, **options):
+        """History kept in directory, or in a new one"""
+
+        if directory is None:
+            directory = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, directory)
+        history = MessageHistory(directory, **options)
+        history.open()
+        self.addCleanup(history.close)
+        return history
+
+    def replay(self, history, room, from_seq=0):
+        """Sequence numbers a replay of room sends"""
+
+        cursor = history.cursor(room, from_seq)
+        frames = []
+        while not cursor.done():
+            frames.extend(cursor.read(65536))
+        return [HISTORY_HEADER.unpack_from(frame, HEADER.size)[0]
+                for frame in frames]
+
+    def test_max_messages_holds_within_a_segment(self):
+        history = self.open_history(max_messages=3)
+        for message in range(5):
+            history.append('room', 'message %d' % message)
+        self.assertEqual(len(history.segments), 1)
+        self.assertEqual(self.replay(history, 'room'), [3, 4, 5])
+        self.assertEqual(self.replay(history, 'room', 4), [4, 5])
+        self.assertIsNone(history.read('room', 2))
+
+    def test_max_messages_counts_every_room(self):
+        history = self.open_history(max_messages=3)
+        history.append('quiet', 'first')
+        history.append('quiet', 'second')
+        for message in range(2):
+            history.append('busy', 'message %d' % message)
+        self.assertEqual(self.replay(history, 'quiet'), [2])
+        self.assertEqual(self.replay(history, 'busy'), [1, 2])
+
+    def test_max_messages_holds_after_reopening(self):
+        history = self.open_history(max_messages=3)
+        for message in range(5):
+            history.append('room', 'message %d' % message)
+        history.close()
+        reopened = self.open_history(history.directory, max_messages=3)
+        self.assertEqual(self.replay(reopened, 'room'), [3, 4, 5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import socket
+import threading
+import unittest
+from StringIO import StringIO
+
+from support import ServerTestCase, free_port, wait_for
+from wisper.framing import PEER_MESSAGE, encode_frame
+from wisper.utils import ServerLog
+from wisper.workers import WorkerServer
+
+
+"""Links between servers, run on localhost"""
+
+
+def drain(sock):
+    """Read from sock until it closes"""
+
+    try:
+        while sock.recv(65536):
+            pass
+    except socket.error:
+        pass
+
+
+class LinkBufferTest(ServerTestCase):
+
+    def test_stuck_link_is_dropped_without_shedding_clients(self):
+        stuck, unread = socket.socketpair()
+        self.addCleanup(unread.close)
+        worker = self.run_server(WorkerServer(
+            0, {1: stuck}, host='127.0.0.1', port=free_port(),
+            max_buffered_bytes=2000000, link_buffer_limit=1000000,
+            idle_grace=60, log=ServerLog(stream=StringIO())))
+        clients = [self.join(worker, 'room') for i in range(5)]
+        self.assertTrue(wait_for(lambda: worker.registry.room_size(
+            'room') == 5))
+        for client in clients:
+            reader = threading.Thread(target=drain, args=(client,))
+            reader.daemon = True
+            reader.start()
+        message = encode_frame('m' * 8000, PEER_MESSAGE)
+        for i in range(400):
+            clients[i % 5].sendall(message)
+        self.assertTrue(wait_for(lambda: not worker.links))
+        self.assertEqual(len(worker.registry), 5)
+        self.assertEqual(worker.metrics.budget_disconnects.value, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import socket
+import threading
+import unittest
+from StringIO import StringIO
+
+from support import ServerTestCase, free_port, read_frames
+from wisper.framing import (ACK_HEADER, FILE_CHUNK, MESSAGE_ACK,
+                            MESSAGE_LIMIT, MESSAGE_LIMIT_HEADER, RESUME_HEADER,
+                            RESUME_SESSION, SEQUENCE_HEADER, FrameDecoder,
+                            encode_frame)
+from wisper.server import Server
+from wisper.utils import ServerLog
+
+
+"""A single server, run on localhost"""
+
+
+class LocalServerTestCase(ServerTestCase):
+
+    def start_server(self, **options):
+        return self.run_server(Server(
+            host='127.0.0.1', port=free_port(), idle_grace=60,
+            log=ServerLog(stream=StringIO()), **options))
+
+
+class SocketOptionsTest(LocalServerTestCase):
+
+    def test_clients_are_sent_to_without_delay(self):
+        server = self.start_server()
+        self.join(server, 'room')
+        for connection in server.registry.connections.values():
+            self.assertTrue(connection.sock.getsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY))
+
+
+class JoinTest(LocalServerTestCase):
+
+    def test_client_is_told_the_largest_message_it_may_send(self):
+        server = self.start_server(recv_buffer_limit=4096)
+        client = self.join(server, 'room')
+        self.assertIn((MESSAGE_LIMIT, MESSAGE_LIMIT_HEADER.pack(4096)),
+                      read_frames(client))
+
+
+class FileTransferTest(LocalServerTestCase):
+
+    def open_session(self, server, room):
+        """Connect a client to server, in room, with a session"""
+
+        client = self.join(server, room)
+        client.sendall(encode_frame(RESUME_HEADER.pack(0), RESUME_SESSION))
+        return client
+
+    def send_file(self, sender, chunks, chunk_size, in_flight):
+        """Send chunks like a client would, with at most in_flight of them
+             unacknowledged
+        """
+
+        decoder = FrameDecoder()
+        sender.settimeout(10)
+        acked = 0
+        for seq in range(1, chunks + 1):
+            while seq - 1 - acked >= in_flight:
+                for kind, payload in decoder.feed(sender.recv(65536)):
+                    if kind == MESSAGE_ACK:
+                        acked = ACK_HEADER.unpack(payload)[0]
+            sender.sendall(encode_frame(
+                SEQUENCE_HEADER.pack(seq) + 'c' * chunk_size, FILE_CHUNK))
+
+    def test_slow_receiver_gets_every_chunk(self):
+        for policy in ('drop', 'coalesce'):
+            server = self.start_server(
+                slow_consumer_policy=policy, high_watermark=262144,
+                low_watermark=65536, send_buffer_limit=4194304)
+            sender = self.open_session(server, 'room')
+            receiver = self.open_session(server, 'room')
+            transfer = threading.Thread(
+                target=self.send_file, args=(sender, 100, 65536, 8))
+            transfer.daemon = True
+            transfer.start()
+            # The sender runs ahead before the receiver starts reading
+            transfer.join(1)
+            chunks = [payload for kind, payload in read_frames(receiver, 2)
+                      if kind == FILE_CHUNK]
+            transfer.join(10)
+            self.assertEqual(
+                [SEQUENCE_HEADER.unpack_from(chunk)[0] for chunk in chunks],
+                range(1, 101))
+
+
+if __name__ == '__main__':
+    unittest.main()
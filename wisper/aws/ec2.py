@@ -3,12 +3,18 @@
 import boto3
 import json
 import os
+import time
 
 from botocore.exceptions import ClientError
 
 
 INSTANCE_ID = os.environ['INSTANCE_ID']
 
+# Seconds a described instance is trusted for. Module state lives on across
+#   warm invocations of the function, so a client starting a session shortly
+#   after another skips the EC2 round trip
+INSTANCE_CACHE_TTL = float(os.environ.get('INSTANCE_CACHE_TTL', 5))
+
 
 def lambda_handler(event, context):
     """Entry point into the Lambda function
@@ -32,13 +38,58 @@ def lambda_handler(event, context):
     return response
 
 
-ec2 = boto3.client('ec2')
+# AWS clients, created on first use and kept for the life of the container.
+#   Tests install stubs here, e.g. clients['ec2'] = stubbed_client
+clients = {}
+
+
+def client(service):
+    """Cached boto3 client for service"""
+
+    if service not in clients:
+        clients[service] = boto3.client(service)
+    return clients[service]
+
+
+class InstanceCache(object):
+    """Last description of the wisper server instance
+
+       instance: (dict) Instance as returned by describe_instances, None
+         until described
+       described_at: (float) Time the instance was described
+       ttl: (float) Seconds the description is trusted for
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.instance = None
+        self.described_at = 0
+
+    def get(self):
+        """Describe the instance, unless the last description is fresh"""
+
+        if (self.instance is None or
+                time.time() - self.described_at >= self.ttl):
+            response = client('ec2').describe_instances(
+                InstanceIds=[INSTANCE_ID])
+            self.instance = response['Reservations'][0]['Instances'][0]
+            self.described_at = time.time()
+        return self.instance
+
+    def invalidate(self):
+        """Forget the description, after the instance is started or stopped"""
+
+        self.instance = None
+
+
+instance_cache = InstanceCache(INSTANCE_CACHE_TTL)
 
 
 def start_ec2_instance():
     if check_instance_state():
         # Returns True if running
         return get_public_ip()
+    ec2 = client('ec2')
     # Do a dryrun first to verify permissions
     try:
         ec2.start_instances(InstanceIds=[INSTANCE_ID], DryRun=True)
@@ -48,8 +99,9 @@ def start_ec2_instance():
     # Dry run succeeded, start the instance
     try:
         ec2.start_instances(InstanceIds=[INSTANCE_ID], DryRun=False)
+        instance_cache.invalidate()
         print 'Waiting for EC2 instance to start...'
-        ec2.get_waiter('image_available').wait()
+        ec2.get_waiter('instance_running').wait(InstanceIds=[INSTANCE_ID])
         print 'Instance started'
         run_wisper_server()
         print 'Remote server running'
@@ -59,6 +111,7 @@ def start_ec2_instance():
 
 
 def stop_ec2_instance():
+    ec2 = client('ec2')
     # Do a dryrun first to verify permissions
     try:
         ec2.stop_instances(InstanceIds=[INSTANCE_ID], DryRun=True)
@@ -68,6 +121,7 @@ def stop_ec2_instance():
     # Dry run succeeded, call stop_instances without dryrun
     try:
         ec2.stop_instances(InstanceIds=[INSTANCE_ID], DryRun=False)
+        instance_cache.invalidate()
         print 'Shutting down EC2 instance'
         return
     except ClientError as e:
@@ -77,8 +131,7 @@ def stop_ec2_instance():
 def check_instance_state():
     """Determine current state of instance"""
 
-    res = boto3.resource('ec2')
-    state = res.Instance(INSTANCE_ID).state[u'Name']
+    state = instance_cache.get()[u'State'][u'Name']
     if state == 'stopping':
         raise RuntimeError('The instance is stopping and cannot be started.')
     return state == 'running'
@@ -89,8 +142,7 @@ def run_wisper_server():
 
     try:
         print 'Starting wisper server'
-        ssm_client = boto3.client('ssm')
-        resp = ssm_client.send_command(
+        resp = client('ssm').send_command(
             DocumentName='AWS-RunShellScript',
             Parameters={'commands': ['wisper-runserver']},
             InstanceIds=[INSTANCE_ID])
@@ -101,18 +153,10 @@ def run_wisper_server():
 
 
 def get_public_ip():
-    """Retrieve public IP address of most recently launched instance"""
+    """Retrieve public IP address of the instance"""
 
-    try:
-        running_instances = []
-        response = ec2.describe_instances()
-        # Collect running instances
-        for reservation in response['Reservations']:
-            for instance in reservation['Instances']:
-                if instance[u'State'][u'Name'] == 'running':
-                    running_instances.append(instance)
-        # Select instance with newest launch time
-        most_recent_instance = min(running_instances, key=lambda x: x[u'LaunchTime'])
-        return most_recent_instance[u'PublicIpAddress']
-    except ValueError:
+    instance = instance_cache.get()
+    if instance[u'State'][u'Name'] != 'running':
         print 'EC2 instance not running'
+        return None
+    return instance.get(u'PublicIpAddress')
@@ -0,0 +1,402 @@
+import argparse
+import json
+import os
+import platform
+import socket
+import sys
+import time
+import traceback
+
+import psutil
+
+from encryption import (CIPHER_SUITES, DEFAULT_CIPHER_SUITE, Cipher,
+                        generate_secret_key)
+from framing import (FrameDecoder, JOIN_ROOM, PEER_MESSAGE, ROOM_PRESENCE,
+                     ROOM_PRESENCE_HEADER, encode_frame)
+from poller import Poller
+from protobuf import available_codecs, deserialize, serialize
+from server import Server
+
+
+"""Benchmarks for Wisper's hot paths
+
+   Run with 'wisper-bench', or 'python -m wisper.benchmarks'. Results print
+     as tables, or as JSON with --json so that runs can be compared between
+     releases.
+"""
+
+
+# Room every synthetic client of a relay benchmark joins
+BENCH_ROOM = 'bench'
+
+# Seconds to wait for a relay benchmark's clients to join, and for messages
+#   still in flight once sending stops
+SETTLE_TIMEOUT = 10.0
+
+# Seconds between samples of the server's resident memory
+RSS_SAMPLE_INTERVAL = 0.1
+
+SUITES = ('cipher', 'compression', 'relay')
+
+
+def bench_cipher_suites(sizes=(64, 1024, 16384), iterations=2000):
+    """Compare bytes on the wire and throughput of every cipher suite
+
+       Each message is a serialized SecureMessage with a body of random
+         printable bytes, as the client would encrypt it.
+
+       sizes: (tuple) Message body sizes, in bytes
+       iterations: (int) Messages encrypted and decrypted per measurement
+
+       Returns a list of result dicts, one per suite and size
+    """
+
+    secret_key = generate_secret_key()
+    results = []
+    for name in sorted(CIPHER_SUITES):
+        suite = CIPHER_SUITES[name](secret_key)
+        for size in sizes:
+            body = os.urandom(size).encode('hex')[:size]
+            plain_text = serialize(body, 'benchmark', ())
+            started = time.time()
+            for _ in xrange(iterations):
+                token = suite.encrypt(plain_text)
+            encrypt_seconds = time.time() - started
+            started = time.time()
+            for _ in xrange(iterations):
+                suite.decrypt(token)
+            decrypt_seconds = time.time() - started
+            megabytes = len(plain_text) * iterations / 1048576.0
+            results.append({
+                'suite': name,
+                'body_bytes': size,
+                'plain_bytes': len(plain_text),
+                'wire_bytes': len(token),
+                'overhead': len(token) / float(len(plain_text)),
+                'encrypt_mb_per_second': megabytes / encrypt_seconds,
+                'decrypt_mb_per_second': megabytes / decrypt_seconds,
+            })
+    return results
+
+
+def print_cipher_suites(results):
+    """Print bench_cipher_suites results as a table"""
+
+    row = '%-8s %10s %10s %9s %12s %12s'
+    print row % ('suite', 'body', 'wire', 'overhead', 'enc MB/s',
+                 'dec MB/s')
+    for result in results:
+        print row % (
+            result['suite'], result['body_bytes'], result['wire_bytes'],
+            '%.2fx' % result['overhead'],
+            '%.1f' % result['encrypt_mb_per_second'],
+            '%.1f' % result['decrypt_mb_per_second'])
+
+
+def bench_compression(sizes=(64, 1024, 16384), iterations=2000):
+    """Compare bytes on the wire and serialize time for every codec
+
+       Bodies are lines of log output, like the pasted logs that make up
+         most large messages.
+
+       sizes: (tuple) Message body sizes, in bytes
+       iterations: (int) Messages serialized per measurement
+
+       Returns a list of result dicts, one per codec and size
+    """
+
+    line = '2018-06-01 12:00:00 INFO [server] Client connected: %s\n'
+    text = ''.join(line % os.urandom(4).encode('hex') for _ in xrange(2048))
+    results = []
+    for codec in [None] + sorted(available_codecs()):
+        codecs = () if codec is None else (codec,)
+        for size in sizes:
+            body = text[:size]
+            started = time.time()
+            for _ in xrange(iterations):
+                plain_text = serialize(body, 'benchmark', codecs)
+            seconds = time.time() - started
+            results.append({
+                'codec': codec or 'none',
+                'body_bytes': size,
+                'plain_bytes': len(plain_text),
+                'ratio': len(plain_text) / float(size),
+                'microseconds': seconds / iterations * 1000000,
+            })
+    return results
+
+
+def print_compression(results):
+    """Print bench_compression results as a table"""
+
+    row = '%-8s %10s %10s %8s %12s'
+    print row % ('codec', 'body', 'plain', 'ratio', 'usec/msg')
+    for result in results:
+        print row % (
+            result['codec'], result['body_bytes'], result['plain_bytes'],
+            '%.2f' % result['ratio'], '%.1f' % result['microseconds'])
+
+
+def bench_relay(clients=(2, 8, 32), rates=(50, 500), sizes=(64, 1024),
+                duration=2.0, suite=DEFAULT_CIPHER_SUITE, **server_options):
+    """Load a local Server with synthetic clients, and measure relay
+
+       Every combination of client count, message rate and body size is run
+         against a fresh Server in its own process, so that its CPU time and
+         memory can be measured apart from the clients. All clients join one
+         room, and take turns sending, so each message fans out to every
+         other client. Messages go through the same serialize and Cipher
+         calls as a real Client.
+
+       clients: (tuple) Numbers of clients to connect, at least 2
+       rates: (tuple) Messages sent per second, across all clients
+       sizes: (tuple) Message body sizes, in bytes
+       duration: (float) Seconds to send for, at each combination
+       suite: (str) Cipher suite the clients encrypt with
+       server_options: Passed on to each Server. See server.Server
+
+       Returns a list of result dicts, one per combination
+    """
+
+    cipher = Cipher(generate_secret_key(), suite)
+    results = []
+    for client_count in clients:
+        for rate in rates:
+            for size in sizes:
+                results.append(_run_relay(
+                    cipher, client_count, rate, size, duration,
+                    server_options))
+    return results
+
+
+def _run_relay(cipher, client_count, rate, size, duration, server_options):
+    """Run one relay benchmark combination. See bench_relay"""
+
+    if client_count < 2:
+        raise ValueError('Relay benchmarks need at least 2 clients')
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(socket.SOMAXCONN)
+    address = listener.getsockname()
+    pid = os.fork()
+    if pid == 0:
+        _run_bench_server(listener, address, server_options)
+    listener.close()
+    server = psutil.Process(pid)
+    harness = psutil.Process()
+
+    poller = Poller()
+    decoders = dict()
+    socks = []
+    for _ in xrange(client_count):
+        sock = socket.create_connection(address)
+        sock.sendall(encode_frame(BENCH_ROOM, JOIN_ROOM))
+        decoders[sock.fileno()] = (sock, FrameDecoder())
+        poller.register(sock.fileno(), Poller.READ)
+        socks.append(sock)
+
+    latencies = []
+    joined = set()
+
+    def receive(timeout):
+        for fileno, events in poller.poll(timeout):
+            sock, decoder = decoders[fileno]
+            for kind, payload in decoder.feed(sock.recv(65536)):
+                if kind == PEER_MESSAGE:
+                    body = deserialize(cipher.decrypt(payload)).body
+                    latencies.append(
+                        time.time() - float(body.split(' ', 1)[0]))
+                elif kind == ROOM_PRESENCE and ROOM_PRESENCE_HEADER.unpack(
+                        payload)[2] == client_count - 1:
+                    joined.add(fileno)
+
+    deadline = time.time() + SETTLE_TIMEOUT
+    while len(joined) < client_count and time.time() < deadline:
+        receive(deadline - time.time())
+
+    padding = os.urandom(size).encode('hex')
+    server_cpu = sum(server.cpu_times()[:2])
+    harness_cpu = sum(harness.cpu_times()[:2])
+    peak_rss = server.memory_info().rss
+    next_sample = 0
+    sent = 0
+    started = time.time()
+    stop_sending = started + duration
+    next_send = started
+    deadline = stop_sending + SETTLE_TIMEOUT
+    while True:
+        now = time.time()
+        while next_send <= now and next_send < stop_sending:
+            # Stamped with the time it was due rather than the time it was
+            #   sent, so falling behind schedule shows up as latency
+            stamp = '%.6f ' % next_send
+            body = stamp + padding[:max(0, size - len(stamp))]
+            socks[sent % client_count].sendall(encode_frame(
+                cipher.encrypt(serialize(body, 'bench')), PEER_MESSAGE))
+            sent += 1
+            next_send = started + sent / float(rate)
+        if now >= next_sample:
+            peak_rss = max(peak_rss, server.memory_info().rss)
+            next_sample = now + RSS_SAMPLE_INTERVAL
+        expected = sent * (client_count - 1)
+        if next_send >= stop_sending and len(latencies) >= expected:
+            break
+        if now >= deadline:
+            break
+        receive(max(0, min(next_send, next_sample) - now))
+    elapsed = time.time() - started
+    server_cpu = sum(server.cpu_times()[:2]) - server_cpu
+    harness_cpu = sum(harness.cpu_times()[:2]) - harness_cpu
+
+    poller.close()
+    for sock in socks:
+        sock.close()
+    # The server shuts itself down once its last client has gone
+    try:
+        server.wait(SETTLE_TIMEOUT)
+    except psutil.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+    latencies.sort()
+    return {
+        'clients': client_count,
+        'rate': rate,
+        'body_bytes': size,
+        'duration': duration,
+        'sent': sent,
+        'delivered': len(latencies),
+        'lost': expected - len(latencies),
+        'deliveries_per_second': len(latencies) / elapsed,
+        'p50_ms': _percentile(latencies, 50) * 1000,
+        'p99_ms': _percentile(latencies, 99) * 1000,
+        'p999_ms': _percentile(latencies, 99.9) * 1000,
+        'max_ms': _percentile(latencies, 100) * 1000,
+        'server_cpu_percent': server_cpu / elapsed * 100,
+        'server_peak_rss_mb': peak_rss / 1048576.0,
+        'harness_cpu_percent': harness_cpu / elapsed * 100,
+    }
+
+
+def _run_bench_server(listener, address, server_options):
+    """Entry point of a forked benchmark server process. Never returns"""
+
+    # Logging every relayed message would swamp the results
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    exit_code = 0
+    try:
+        Server(host=address[0], port=address[1], listener=listener,
+               **server_options).start()
+    except Exception:
+        traceback.print_exc()
+        exit_code = 1
+    sys.stdout.flush()
+    os._exit(exit_code)
+
+
+def _percentile(ordered, percent):
+    """Nearest-rank percentile of an ordered list, 0 when it is empty"""
+
+    if not ordered:
+        return 0
+    rank = int(round(percent / 100.0 * len(ordered) + 0.5)) - 1
+    return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+
+def print_relay(results):
+    """Print bench_relay results as a table"""
+
+    row = '%7s %6s %6s %10s %6s %8s %8s %8s %7s %7s %9s'
+    print row % ('clients', 'rate', 'body', 'deliv/s', 'lost', 'p50 ms',
+                 'p99 ms', 'p999 ms', 'srv cpu', 'srv MB', 'bench cpu')
+    for result in results:
+        print row % (
+            result['clients'], result['rate'], result['body_bytes'],
+            '%.0f' % result['deliveries_per_second'], result['lost'],
+            '%.2f' % result['p50_ms'], '%.2f' % result['p99_ms'],
+            '%.2f' % result['p999_ms'],
+            '%.0f%%' % result['server_cpu_percent'],
+            '%.1f' % result['server_peak_rss_mb'],
+            '%.0f%%' % result['harness_cpu_percent'])
+
+
+def parse_list(value):
+    """Parse a comma separated list of numbers given on the command line"""
+
+    try:
+        return tuple(int(number) for number in value.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'expected comma separated numbers, got %r' % value)
+
+
+def main():
+    """Entry point of 'wisper-bench'"""
+
+    parser = argparse.ArgumentParser(prog='wisper-bench')
+    parser.add_argument(
+        '--suite', action='append', choices=SUITES,
+        help='benchmark to run. May be repeated (default: all)')
+    parser.add_argument(
+        '--iterations', type=int, default=2000,
+        help='messages per cipher and compression measurement '
+             '(default: 2000)')
+    parser.add_argument(
+        '--clients', type=parse_list, default=(2, 8, 32),
+        help='relay client counts to sweep (default: 2,8,32)')
+    parser.add_argument(
+        '--rates', type=parse_list, default=(50, 500),
+        help='relay messages per second to sweep (default: 50,500)')
+    parser.add_argument(
+        '--sizes', type=parse_list, default=(64, 1024),
+        help='relay message body sizes to sweep (default: 64,1024)')
+    parser.add_argument(
+        '--duration', type=float, default=2.0,
+        help='seconds to send for at each relay combination (default: 2)')
+    parser.add_argument(
+        '--write-batch', type=int, default=65536, metavar='BYTES',
+        help='relay server write batch size. See wisper-runserver')
+    parser.add_argument(
+        '--no-write-coalescing', dest='write_coalescing',
+        action='store_false',
+        help='relay server writes each message as soon as it is relayed')
+    parser.add_argument(
+        '--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+    if min(args.clients) < 2:
+        parser.error('--clients must each be at least 2')
+    if min(args.rates) < 1:
+        parser.error('--rates must each be at least 1')
+    suites = args.suite or SUITES
+
+    results = dict()
+    if 'cipher' in suites:
+        results['cipher_suites'] = bench_cipher_suites(
+            iterations=args.iterations)
+    if 'compression' in suites:
+        results['compression'] = bench_compression(
+            iterations=args.iterations)
+    if 'relay' in suites:
+        results['relay'] = bench_relay(
+            args.clients, args.rates, args.sizes, args.duration,
+            write_coalescing=args.write_coalescing,
+            max_write_batch=args.write_batch)
+    if args.json:
+        results['environment'] = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': psutil.cpu_count(),
+        }
+        print json.dumps(results, indent=2, sort_keys=True)
+        return
+    for name, print_results in (('cipher_suites', print_cipher_suites),
+                                ('compression', print_compression),
+                                ('relay', print_relay)):
+        if name in results:
+            print_results(results[name])
+            print
+
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,143 @@
+import os
+import random
 import select
 import socket
 import sys
+import time
+from collections import deque
 
 from encryption import InvalidToken
-from protobuf import deserialize, serialize
+from framing import (ACK_HEADER, FILE_CHUNK, HISTORY_HEADER, HISTORY_MESSAGE,
+                     FrameDecoder, FrameError, JOIN_ROOM, MESSAGE_ACK,
+                     MESSAGE_LIMIT, MESSAGE_LIMIT_HEADER, PEER_MESSAGE,
+                     REPLAY_HEADER, REPLAY_HISTORY,
+                     RESUME_HEADER, RESUME_SESSION, ROOM_CODECS, ROOM_MESSAGE,
+                     ROOM_PRESENCE, ROOM_PRESENCE_HEADER, SEQUENCE_HEADER,
+                     SERVER_NOTICE, SESSION_MESSAGE, SESSION_TOKEN,
+                     encode_frame, encode_join)
+from protobuf import (BASELINE_CODECS, CompressionError, available_codecs,
+                      deserialize, deserialize_chunk, serialize_batch)
+from renderer import Renderer
+from transfers import IncomingTransfer, OutgoingTransfer, TransferError
 from utils import socket_context
 
 
+class ConnectionLost(Exception):
+    """Raised when the connection with the server drops"""
+
+
 class Client(object):
     """Each client-side initialization is an instance of this class.
 
          alias: (str) Username for the duration of a session. Set at startup
 
-         cipher: (Fernet) Cipher object, required for
+         room: (str) Name of the room to join on the server. Only peers in
+           the same room receive each other's messages. Set at startup
+
+         cipher: (Cipher) Cipher object, required for
            encryption/decryption. Must be matching for all connected clients.
            Otherwise, connection will close. Set at startup. See encryption.py
+
+         decoder: (FrameDecoder) Reassembles inbound frames that span
+           multiple reads. See framing.py
+
+         codecs: (frozenset) Codecs outbound messages may be compressed
+           with. Starts with the baseline, and grows with the optional
+           codecs the server says every member of the room has.
+           See protobuf/compression.py
+
+         session_token: (str) Token of the session the server keeps for the
+           client, None until it sends one. A lost connection is reconnected
+           and the session resumed with it
+
+         last_seq: (int) Sequence number of the newest room message received
+
+         next_seq: (int) Sequence number of the next message sent
+
+         unacked: (deque) (seq, frame) of every message sent that the server
+           has not acknowledged, oldest first. Sent again after a reconnect
+
+         acked: (int) Sequence number of the last message the server
+           acknowledged
+
+         connect_attempts: (int) Connections made since the server last
+           confirmed the session, by sending its token or acknowledging a
+           message. A connection the server closes before then is no better
+           than one that failed, and is waited on just as long
+
+         drops: (int) Connections lost while the oldest message in unacked
+           was outstanding. See max_drops
+
+         dropped_seq: (int) Sequence number of the message drops counts for
+
+         transfer: (OutgoingTransfer) File being sent with /send, if any.
+           See transfers.py
+
+         downloads: (dict) Mapping of transfer ids to the IncomingTransfer
+           of each file being received
+
+         download_dir: (str) Where received files are saved
+
+         renderer: (Renderer) Collects what the client prints once running,
+           and draws it to the terminal frame_rate times a second at most.
+           See renderer.py
     """
 
-    def __init__(self, host, port, alias, cipher):
+    # Most messages and file chunks sent without being acknowledged. File
+    #   chunks wait for acknowledgements once there are this many, so a
+    #   transfer never has more than this many chunks in flight
+    max_in_flight = 8
+
+    # Most lines sent together in one message
+    max_batch = 64
+
+    # Largest message the server takes. Servers say when the client joins,
+    #   until then it is the default recv_buffer_limit of server.py. The
+    #   server closes the connection of a client sending more
+    max_message_size = 1048576
+
+    # Connection attempts made without the server confirming the session,
+    #   before giving up
+    reconnect_attempts = 10
+
+    # Most connections lost while a message is outstanding. It is then given
+    #   up on rather than sent again, as the server may be closing the
+    #   connection over it
+    max_drops = 2
+
+    # Longest wait between connection attempts, which starts at
+    #   reconnect_delay and doubles each time. Each wait is picked at random
+    #   up to its limit, so clients dropped together don't return together
+    reconnect_delay = 0.05
+    max_reconnect_delay = 5
+
+    # Most times a second the terminal is drawn to, and most lines waiting
+    #   to be drawn. Lines past that are dropped, oldest first
+    frame_rate = 30
+    scrollback = 1000
+
+    def __init__(self, host, port, alias, cipher, room, download_dir='.'):
         self.server_address = (host, port)
         self.alias = alias
+        self.room = room
         self.cipher = cipher
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.decoder = FrameDecoder()
+        self.codecs = BASELINE_CODECS
+        self.session_token = None
+        self.last_seq = 0
+        self.next_seq = 1
+        self.unacked = deque()
+        self.acked = 0
+        self.connect_attempts = 0
+        self.drops = 0
+        self.dropped_seq = 0
+        self.transfer = None
+        self.downloads = dict()
+        self.download_dir = download_dir
+        self.socket = None
+        self._stdin_buffer = ''
+        self.renderer = Renderer(frame_rate=self.frame_rate,
+                                 scrollback=self.scrollback)
 
     def start(self):
         """Initiate connection with the server.
@@ -31,28 +147,114 @@ class Client(object):
 
         print 'Establishing connection with server...'
         try:
-            self.socket.connect(self.server_address)
-            self.socket.setblocking(False)
-            # Run if connection is successful
-            self._run()
+            self._connect()
         except socket.error, e:
             print 'Server not responding: ' + str(e)
             return
+        # Run if connection is successful
+        self._run()
 
-    def _run(self):
-        """Detect and select readable sockets until shutdown"""
+    def _connect(self):
+        """Connect to the server, join the room and open or resume the
+             session
+
+           Messages the server never acknowledged are sent again. It drops
+             any that did arrive
+        """
 
-        # Python2 doesn't manage socket contexts, here's a hand-rolled manager
-        with socket_context(self.socket) as server_connection:
+        # The socket stays blocking so that large messages are sent whole.
+        #   Reads never block, select only returns readable sockets
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Each message goes out in a single write of its own
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.decoder = FrameDecoder()
+        frames = [encode_frame(encode_join(
+            self.room, available_codecs() - BASELINE_CODECS), JOIN_ROOM)]
+        frames.append(encode_frame(
+            RESUME_HEADER.pack(self.last_seq) + (self.session_token or ''),
+            RESUME_SESSION))
+        if self.session_token is None:
+            # Catch up on whatever the room's history still holds. A resumed
+            #   session is only sent what it missed. A server keeping no
+            #   history ignores the request
+            frames.append(encode_frame(REPLAY_HEADER.pack(0), REPLAY_HISTORY))
+        frames.extend(frame for seq, frame in self.unacked)
+        self.connect_attempts += 1
+        try:
+            self.socket.connect(self.server_address)
+            self.socket.sendall(''.join(frames))
+        except socket.error:
+            self.socket.close()
+            raise
+
+    def _reconnect(self):
+        """Try to connect again after the connection drops
+
+           The first attempt after a confirmed session is made straight away,
+             as most drops are brief. Returns whether an attempt succeeded
+        """
+
+        while self.connect_attempts < self.reconnect_attempts:
+            if self.connect_attempts:
+                self.renderer.draw()
+                delay = self.reconnect_delay * 2 ** (self.connect_attempts - 1)
+                time.sleep(random.uniform(
+                    0, min(delay, self.max_reconnect_delay)))
             try:
-                while True:
-                    read_list, write_list, except_list = select.select(
-                        [sys.stdin, server_connection], [], [])
-                    for sock in read_list:
-                        # Check socket type and switch as necessary
-                        self._inspect_socket_origin(sock, server_connection)
-            except KeyboardInterrupt:
-                self._shutdown(server_connection)
+                self._connect()
+                return True
+            except socket.error, e:
+                self.renderer.write('Reconnect failed: ' + str(e))
+        return False
+
+    def _count_drop(self):
+        """Give up on the oldest unacknowledged message once max_drops
+             connections have been lost while it was outstanding
+        """
+
+        if not self.unacked:
+            return
+        seq = self.unacked[0][0]
+        if seq != self.dropped_seq:
+            self.dropped_seq = seq
+            self.drops = 0
+        self.drops += 1
+        if self.drops >= self.max_drops:
+            self.unacked.popleft()
+            self.renderer.write('A message could not be delivered, the '
+                                'connection was lost each time it was sent')
+
+    def _run(self):
+        """Detect and select readable sockets until shutdown
+
+           A dropped connection is reconnected, and the session resumed.
+             Output waiting to be drawn wakes select when its frame is due
+        """
+
+        while True:
+            # Python2 doesn't manage socket contexts, here's a hand-rolled
+            #   manager
+            with socket_context(self.socket) as server_connection:
+                try:
+                    while True:
+                        self._send_file_chunks(server_connection)
+                        read_list, write_list, except_list = select.select(
+                            [sys.stdin, server_connection], [], [],
+                            self.renderer.timeout())
+                        for sock in read_list:
+                            # Check socket type and switch as necessary
+                            self._inspect_socket_origin(
+                                sock, server_connection)
+                        self.renderer.refresh()
+                except KeyboardInterrupt:
+                    self._shutdown(server_connection)
+                except ConnectionLost, e:
+                    self.renderer.write(
+                        'Connection lost: %s. Reconnecting...' % e)
+                    self._count_drop()
+            if not self._reconnect():
+                self.renderer.write('Server not responding')
+                self._shutdown(self.socket)
 
     def _inspect_socket_origin(self, current_socket, server_connection):
         """Determine whether selected socket is inbound or outbound"""
@@ -67,64 +269,287 @@ class Client(object):
 
              A message sent by another client will always be encrypted.
              If the message is a status update from the server, it is
-             not encrypted.
+             not encrypted. The frame kind says which is which, so each
+             message is decrypted at most once.
         """
         inbound_messages = self._receive_data(inbound_socket)
-        for message in inbound_messages:
-            if self.cipher.is_encrypted(message):
+        for kind, message in inbound_messages:
+            if kind == PEER_MESSAGE:
                 self._display_client_message(inbound_socket, message)
-            else:
+            elif kind == ROOM_MESSAGE:
+                seq = SEQUENCE_HEADER.unpack_from(message)[0]
+                self.last_seq = max(self.last_seq, seq)
+                self._display_client_message(
+                    inbound_socket, message[SEQUENCE_HEADER.size:])
+            elif kind == HISTORY_MESSAGE:
+                seq, received = HISTORY_HEADER.unpack_from(message)
+                self.last_seq = max(self.last_seq, seq)
+                self._display_client_message(
+                    inbound_socket, message[HISTORY_HEADER.size:],
+                    time.strftime('%H:%M ', time.localtime(received)))
+            elif kind == SERVER_NOTICE:
                 self._display_server_message(message)
+            elif kind == ROOM_PRESENCE:
+                self._display_presence(message)
+            elif kind == ROOM_CODECS:
+                self._set_room_codecs(message)
+            elif kind == MESSAGE_LIMIT:
+                self.max_message_size = MESSAGE_LIMIT_HEADER.unpack(message)[0]
+            elif kind == MESSAGE_ACK:
+                self._acknowledge(message)
+            elif kind == SESSION_TOKEN:
+                self._set_session(message)
+            elif kind == FILE_CHUNK:
+                self._receive_file_chunk(
+                    inbound_socket, message[SEQUENCE_HEADER.size:])
 
     def _receive_data(self, inbound_socket):
-        """Receive inbound data and split at delineation
+        """Receive inbound data and decode complete frames
 
-           Messages are read into a list. Separate messages are delineated
-             by newlines. A complete packet is delineated by a message with
-             an empty string.
+           Messages are read into a list. A message split across reads is
+             held by the decoder until the rest of it arrives.
         """
 
-        # Remove message delineation
-        data = [msg for msg in inbound_socket.recv(1024).split('\n')]
-        if data and data[-1] != '':
-            print 'Inbound packet was dropped'
-        # Remove packet delineation and return list of messages
-        return data[:-1]
+        try:
+            data = inbound_socket.recv(65536)
+        except socket.error, e:
+            raise ConnectionLost(e)
+        if not data:
+            raise ConnectionLost('server closed the connection')
+        try:
+            return self.decoder.feed(data)
+        except FrameError, e:
+            self.renderer.write('Malformed data from server: ' + str(e))
+            self._shutdown(inbound_socket)
 
-    def _display_client_message(self, inbound_socket, inbound_message):
-        """Display encrypted message sent by peers"""
+    def _display_client_message(self, inbound_socket, inbound_message,
+                                prefix=''):
+        """Display encrypted message sent by peers
+
+           prefix: (str) Printed ahead of the sender, such as the time a
+             message from the room's history was sent
+        """
 
         try:
             # Decrypt and deserialize
             inbound_message = deserialize(self.cipher.decrypt(inbound_message))
-            print '<' + inbound_message.sender + '>', inbound_message.body
+            # Lines sent in a burst arrive together, in order
+            for message in [inbound_message] + list(inbound_message.batch):
+                self.renderer.write('%s<%s> %s' % (
+                    prefix, message.sender.encode('utf-8'), message.body))
         except InvalidToken:
-            print 'Secret key does not match.'
+            self.renderer.write('Secret key does not match.')
             self._shutdown(inbound_socket)
+        except CompressionError, e:
+            # Peer compressed with a codec missing here, or sent garbage
+            self.renderer.write(
+                'Message from peer could not be read: ' + str(e))
 
     def _display_server_message(self, server_update):
         """Display status message sent by server"""
 
-        print server_update
+        self.renderer.write(server_update)
+
+    def _display_presence(self, payload):
+        """Display who came and went in the room, and how many remain"""
+
+        joined, left, peers = ROOM_PRESENCE_HEADER.unpack(payload)
+        if joined == 1:
+            self.renderer.write('Peer connected')
+        elif joined:
+            self.renderer.write('%d peers connected' % joined)
+        if left == 1:
+            self.renderer.write('Peer disconnected')
+        elif left:
+            self.renderer.write('%d peers disconnected' % left)
+        self.renderer.write('Number of connected peers: %d' % peers)
+
+    def _set_room_codecs(self, room_codecs):
+        """Allow the optional codecs every member of the room has"""
+
+        shared = frozenset(codec for codec in room_codecs.split(',') if codec)
+        self.codecs = BASELINE_CODECS | (shared & available_codecs())
+
+    def _acknowledge(self, payload):
+        """Forget the messages the server has received"""
+
+        acked, last_seq = ACK_HEADER.unpack(payload)
+        self.connect_attempts = 0
+        self.acked = max(self.acked, acked)
+        while self.unacked and self.unacked[0][0] <= acked:
+            self.unacked.popleft()
+        self.last_seq = max(self.last_seq, last_seq)
+
+    def _set_session(self, token):
+        """Keep the token of the session the server gave the client"""
+
+        if self.session_token is not None and token != self.session_token:
+            # Expired, or kept by another server
+            self.renderer.write('Session could not be resumed, '
+                                'messages sent while disconnected may be '
+                                'missing')
+        self.session_token = token
+        self.connect_attempts = 0
 
     def _handle_outbound_message(self, outbound_socket):
-        """Send data to another client"""
+        """Send data to another client
+
+           Every line waiting on stdin is read at once, so a burst of them,
+             such as pasted text, is sent in batches that each take one
+             encryption and one frame
+        """
+
+        batch = []
+        for read_in in self._read_lines():
+            if read_in.lower() == 'exit()\n':
+                self._send_batch(outbound_socket, batch)
+                self._shutdown(outbound_socket)
+            if read_in.startswith('/send '):
+                self._send_batch(outbound_socket, batch)
+                batch = []
+                self._start_transfer(read_in[len('/send '):].strip())
+                continue
+            batch.append(read_in)
+            if len(batch) == self.max_batch:
+                self._send_batch(outbound_socket, batch)
+                batch = []
+        self._send_batch(outbound_socket, batch)
+
+    def _read_lines(self):
+        """Read every complete line waiting on stdin
+
+           Reads from the file descriptor itself, as lines held in the buffer
+             of sys.stdin would go unseen by select. A partial line is kept
+             until the rest of it arrives
+        """
+
+        fileno = sys.stdin.fileno()
+        data = os.read(fileno, 65536)
+        chunks = [self._stdin_buffer, data]
+        # A terminal returns one line per read, so keep reading while more
+        #   is waiting
+        while data and select.select([fileno], [], [], 0)[0]:
+            data = os.read(fileno, 65536)
+            chunks.append(data)
+        lines = ''.join(chunks).splitlines(True)
+        self._stdin_buffer = ''
+        if lines and not lines[-1].endswith('\n'):
+            self._stdin_buffer = lines.pop()
+        if not data:
+            # End of input ends the session
+            if self._stdin_buffer:
+                lines.append(self._stdin_buffer + '\n')
+            lines.append('exit()\n')
+        return lines
+
+    def _send_batch(self, outbound_socket, batch):
+        """Serialize, encrypt and send lines as one message
+
+           A batch too large for the server is split in two and each half
+             sent in turn. A single line too large is not sent at all
+        """
 
-        read_in = sys.stdin.readline()
-        if read_in.lower() == 'exit()\n':
-            self._shutdown(outbound_socket)
-        # Serialize and encrypt
+        if not batch:
+            return
         outbound_message = self.cipher.encrypt(
-            serialize(read_in, self.alias))
-        outbound_socket.sendall(outbound_message)
-        # Move shell cursor to beginning of previous line
-        # Ref: http://tldp.org/HOWTO/Bash-Prompt-HOWTO/x361.html
-        print '%sSent: %s' % ('\033[F', read_in)
+            serialize_batch(batch, self.alias, self.codecs))
+        if SEQUENCE_HEADER.size + len(outbound_message) > (
+                self.max_message_size):
+            if len(batch) == 1:
+                self.renderer.write(
+                    'Line too long to send, the server takes messages of at '
+                    'most %d bytes' % self.max_message_size)
+                return
+            half = len(batch) // 2
+            self._send_batch(outbound_socket, batch[:half])
+            self._send_batch(outbound_socket, batch[half:])
+            return
+        self.renderer.echo_sent(batch)
+        self._send_numbered(outbound_socket, outbound_message, SESSION_MESSAGE)
+
+    def _send_numbered(self, outbound_socket, ciphertext, kind):
+        """Number ciphertext in the session and send it
+
+           The frame is kept until acknowledged, so it is sent again if the
+             connection drops first
+        """
+
+        frame = encode_frame(SEQUENCE_HEADER.pack(self.next_seq) + ciphertext,
+                             kind)
+        self.unacked.append((self.next_seq, frame))
+        self.next_seq += 1
+        try:
+            outbound_socket.sendall(frame)
+        except socket.error, e:
+            raise ConnectionLost(e)
+
+    def _start_transfer(self, path):
+        """Begin sending a file to the room, a chunk at a time"""
+
+        if self.transfer is not None:
+            self.renderer.write('Already sending ' + self.transfer.name)
+            return
+        try:
+            self.transfer = OutgoingTransfer(os.path.expanduser(path),
+                                             self.alias)
+        except (IOError, OSError), e:
+            self.renderer.write('Cannot send file: ' + str(e))
+            return
+        self.renderer.write('Sending %s (%d bytes)' % (
+            self.transfer.name, self.transfer.size))
+
+    def _send_file_chunks(self, outbound_socket):
+        """Send chunks of the file being sent, while few are in flight"""
+
+        while self.transfer is not None and (
+                self.next_seq - 1 - self.acked < self.max_in_flight):
+            transfer = self.transfer
+            try:
+                chunk = transfer.next_chunk()
+            except (IOError, TransferError), e:
+                self.renderer.write('File transfer failed: ' + str(e))
+                transfer.close()
+                self.transfer = None
+                return
+            if transfer.done():
+                self.transfer = None
+                self.renderer.write('Sent ' + transfer.name)
+            self._send_numbered(outbound_socket, self.cipher.encrypt(chunk),
+                                FILE_CHUNK)
+
+    def _receive_file_chunk(self, inbound_socket, ciphertext):
+        """Write a chunk of a file from a peer to disk"""
+
+        try:
+            chunk = deserialize_chunk(self.cipher.decrypt(ciphertext))
+        except InvalidToken:
+            self.renderer.write('Secret key does not match.')
+            self._shutdown(inbound_socket)
+        download = self.downloads.get(chunk.transfer_id)
+        try:
+            if download is None:
+                if chunk.index:
+                    # Joined part way through the transfer
+                    return
+                download = IncomingTransfer(chunk, self.download_dir)
+                self.downloads[chunk.transfer_id] = download
+                self.renderer.write('<%s> is sending %s (%d bytes)' % (
+                    chunk.sender, download.name, download.size))
+            if download.add(chunk):
+                del self.downloads[chunk.transfer_id]
+                self.renderer.write('Received %s from <%s>, saved to %s' % (
+                    download.name, download.sender, download.path))
+        except (IOError, OSError, TransferError), e:
+            self.renderer.write('File transfer failed: ' + str(e))
+            if download is not None:
+                download.abort()
+                del self.downloads[chunk.transfer_id]
 
     def _shutdown(self, server_connection):
         """Close connection with server"""
 
-        print '\nDisconnected from Secure Messaging Service'
+        self.renderer.write('\nDisconnected from Secure Messaging Service')
+        self.renderer.draw()
         server_connection.close()
         self.socket.close()
         exit(0)
@@ -1,36 +1,113 @@
+import base64
+import os
+
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
 
-class Cipher(object):
-    """Message cipher for Client instances
+class FernetSuite(object):
+    """Legacy cipher suite
 
-       fernet_key: (Fernet) Symmetric encryption object.  Can only decrypt data
-         that has been encrypted with a cipher created using a matching
-         secret key
+       Fernet tokens are base64 encoded, and authenticated with a separate
+         HMAC-SHA256 pass over AES-128-CBC ciphertext
+
+       fernet_key: (Fernet) Symmetric encryption object
     """
 
+    name = 'fernet'
+
     def __init__(self, secret_key):
         self.fernet_key = Fernet(secret_key)
 
-    def encrypt(self, token):
-        cipher_text = self.fernet_key.encrypt(token)
-        return cipher_text
+    def encrypt(self, plain_text):
+        return self.fernet_key.encrypt(plain_text)
 
     def decrypt(self, token):
-        plain_text = self.fernet_key.decrypt(token)
-        return plain_text
+        return self.fernet_key.decrypt(token)
+
 
-    def is_encrypted(self, token):
-        """Check if token is encrypted
+class AESGCMSuite(object):
+    """Raw binary AEAD cipher suite
 
-           If token cannot be decrypted, it is assumed to be unencrypted
-        """
+       Tokens are a version byte, a random 96-bit nonce, then AES-256-GCM
+         ciphertext and tag. Encryption and authentication happen in one pass,
+         and nothing is base64 encoded.
 
+       The AES key is derived from the shared secret key with HKDF, so users
+         keep exchanging the same Fernet-format keys.
+
+       aead: (AESGCM) Symmetric encryption object
+    """
+
+    name = 'aes-gcm'
+    version = '\x01'
+    nonce_size = 12
+
+    def __init__(self, secret_key):
+        key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                   info='wisper ' + self.name, backend=default_backend()
+                   ).derive(base64.urlsafe_b64decode(secret_key))
+        self.aead = AESGCM(key)
+
+    def encrypt(self, plain_text):
+        nonce = os.urandom(self.nonce_size)
+        # The version byte is authenticated along with the ciphertext
+        return self.version + nonce + self.aead.encrypt(
+            nonce, plain_text, self.version)
+
+    def decrypt(self, token):
+        nonce_end = len(self.version) + self.nonce_size
         try:
-            self.fernet_key.decrypt(token)
-            return True
-        except InvalidToken:
-            return False
+            return self.aead.decrypt(
+                token[len(self.version):nonce_end], token[nonce_end:],
+                self.version)
+        except (InvalidTag, ValueError):
+            raise InvalidToken
+
+
+# Cipher suites by name
+CIPHER_SUITES = {FernetSuite.name: FernetSuite, AESGCMSuite.name: AESGCMSuite}
+
+DEFAULT_CIPHER_SUITE = AESGCMSuite.name
+
+
+class Cipher(object):
+    """Message cipher for Client instances
+
+       Can only decrypt data that has been encrypted with a cipher created
+         using a matching secret key
+
+       suites: (dict) Mapping of suite names to a suite for the secret key.
+         Tokens are decrypted by whichever suite made them, so peers using
+         Fernet can still be read
+
+       suite: (object) Suite used to encrypt. See CIPHER_SUITES
+    """
+
+    def __init__(self, secret_key, suite=DEFAULT_CIPHER_SUITE):
+        if suite not in CIPHER_SUITES:
+            raise ValueError('Invalid cipher suite: %s' % suite)
+        self.suites = dict(
+            (name, suite_class(secret_key))
+            for name, suite_class in CIPHER_SUITES.items())
+        self.suite = self.suites[suite]
+
+    def encrypt(self, token):
+        cipher_text = self.suite.encrypt(token)
+        return cipher_text
+
+    def decrypt(self, token):
+        # A base64 encoded Fernet token never starts with a version byte
+        if token[:1] == AESGCMSuite.version:
+            suite = self.suites[AESGCMSuite.name]
+        else:
+            suite = self.suites[FernetSuite.name]
+        plain_text = suite.decrypt(token)
+        return plain_text
 
 
 def generate_secret_key():
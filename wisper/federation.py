@@ -0,0 +1,473 @@
+import errno
+import hashlib
+import hmac
+import itertools
+import os
+import socket
+import struct
+from collections import deque
+
+from framing import (FED_HELLO, FED_PRESENCE, FED_PROOF, FED_RELAY,
+                     FED_SNAPSHOT, encode_frame)
+from links import LinkError, LinkedServer, decode_relay, encode_relay
+from poller import Poller
+from server import ACCEPT_ABORTED, ACCEPT_EXHAUSTED, WOULD_BLOCK
+
+
+"""Federated server nodes
+
+   Several FederatedServer nodes, each on its own host or port, link to each
+     other and forward room traffic between themselves. Clients connected to
+     different nodes share rooms as though they were on a single server, so
+     capacity grows by adding nodes. See session.run_server
+
+   Nodes share a secret, and a link is only trusted once the node at the
+     other end proves it holds it. Each end opens with a FED_HELLO of its
+     node id and a random challenge. The dialing node then sends a
+     FED_PROOF: the HMAC-SHA256, keyed with the secret, of its role, its
+     node id and challenge, and the other node's id and challenge. The
+     accepting node only proves itself the same way once that checks out,
+     so a node that merely connects can't have it answer anything. With
+     the role and both challenges in every proof, a proof can neither be
+     reflected back nor relayed to another link. Until a link's proof
+     checks out, nothing is sent over it but the handshake, and anything
+     else arriving on it drops it.
+"""
+
+
+# Origin node id, origin sequence number and hops left, heading every
+#   relayed and presence message. (origin, sequence) is the message id
+MESSAGE_HEADER = struct.Struct('!8sQB')
+
+# Number of members the origin node has in a room
+PRESENCE_HEADER = struct.Struct('!I')
+
+# Origin node id, origin sequence number and member count of a snapshot entry
+SNAPSHOT_HEADER = struct.Struct('!8sQI')
+
+NODE_ID_SIZE = 8
+
+# Random bytes of the challenge in a FED_HELLO, after the node id
+CHALLENGE_SIZE = 16
+
+# Roles a node proves itself in, the first byte of what a proof signs
+DIALER = 'D'
+ACCEPTOR = 'A'
+
+
+class MessageIdCache(object):
+    """Bounded set of recently seen message ids
+
+       Once full, the oldest id is forgotten for each one added
+
+       ids: (set) Message ids currently remembered
+       order: (deque) The same ids, oldest first
+    """
+
+    __slots__ = ('ids', 'order', 'capacity')
+
+    def __init__(self, capacity):
+        self.ids = set()
+        self.order = deque()
+        self.capacity = capacity
+
+    def __contains__(self, message_id):
+        return message_id in self.ids
+
+    def add(self, message_id):
+        if len(self.order) == self.capacity:
+            self.ids.discard(self.order.popleft())
+        self.ids.add(message_id)
+        self.order.append(message_id)
+
+
+class FederatedServer(LinkedServer):
+    """Server node linked to other nodes over TCP
+
+       Every message a node originates is stamped with a message id made of
+         the node's id and a sequence number, and flooded to every linked
+         node. Each node forwards what it has not seen before to its other
+         links, with one hop fewer. Seen ids are remembered, and messages are
+         never sent back over the link they arrived on, so any topology can
+         be used without messages looping or being delivered twice.
+
+       Room membership is shared the same way. A node sends a snapshot of
+         every member count it knows whenever a link says hello, so nodes that
+         join late, or lose a link, catch up without waiting for changes.
+
+       node_id: (str) Random id of this node, fixed for its lifetime
+
+       link_listener: (socket) Accepts links from other nodes. None when the
+         node only dials out
+
+       peer_addresses: (list) (host, port) addresses of nodes to dial. Lost
+         links to them are redialed every redial_interval seconds
+
+       max_hops: (int) Number of links a message may cross
+
+       seen: (MessageIdCache) Ids of messages already handled
+
+       link_host: (str) Interface links are accepted on. Defaults to the
+         loopback interface, so nodes on other hosts need it set to an
+         interface they can reach
+
+       link_secret: (str) Secret shared by every node of the federation
+
+       link_nodes: (dict) Mapping of links to the node id they lead to, once
+         the node has proved it holds the link secret. Only these links are
+         sent room traffic
+
+       link_claims: (dict) Mapping of links to the (node id, challenge) of
+         the first hello read from them
+
+       link_challenges: (dict) Mapping of links to the challenge sent over
+         them
+
+       dialing: (dict) Mapping of file descriptors of links still connecting
+         to their (socket, address)
+
+       routes: (dict) Mapping of origin node ids to the link their latest
+         message arrived on
+
+       presence_sequences: (dict) Mapping of (room, origin node id) to the
+         sequence number of the newest member count held for them
+    """
+
+    redial_interval = 1.0
+
+    # Seconds a link has to prove it holds the link secret
+    handshake_timeout = 10.0
+
+    def __init__(self, link_port=None, peers=(), max_hops=8,
+                 seen_capacity=65536, link_secret=None, link_host='127.0.0.1',
+                 **kwargs):
+        if not link_secret:
+            raise ValueError('Federated nodes need a link secret')
+        super(FederatedServer, self).__init__(**kwargs)
+        self.link_secret = link_secret
+        self.link_host = link_host
+        self.link_claims = dict()
+        self.link_challenges = dict()
+        self.node_id = os.urandom(NODE_ID_SIZE)
+        self.sequence = itertools.count(1)
+        self.max_hops = max_hops
+        self.seen = MessageIdCache(seen_capacity)
+        self.routes = dict()
+        self.presence_sequences = dict()
+        self.link_nodes = dict()
+        self.dialing = dict()
+        self.peer_addresses = list(peers)
+        self.link_listener = None
+        if link_port is not None:
+            self.link_listener = socket.socket(
+                socket.AF_INET, socket.SOCK_STREAM)
+            self.link_listener.setsockopt(
+                socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.link_listener.setblocking(False)
+            self.link_listener.bind((link_host, link_port))
+
+    def _run(self):
+        if self.link_listener is not None:
+            self.link_listener.listen(socket.SOMAXCONN)
+            self.poller.register(self.link_listener.fileno(), Poller.READ)
+        for address in self.peer_addresses:
+            self._dial(address)
+        try:
+            super(FederatedServer, self)._run()
+        finally:
+            if self.link_listener is not None:
+                self.link_listener.close()
+            for link in self.links.values():
+                link.sock.close()
+            for sock, address in self.dialing.values():
+                sock.close()
+
+    def _handle_event(self, fileno, events):
+        """Service a readiness event on a client, link or dialing socket"""
+
+        if (self.link_listener is not None and
+                fileno == self.link_listener.fileno()):
+            self._accept_links()
+        elif fileno in self.dialing:
+            self._finish_dial(fileno)
+        else:
+            super(FederatedServer, self)._handle_event(fileno, events)
+
+    def _accept_links(self):
+        """Accept every pending link from another node"""
+
+        while True:
+            try:
+                sock, addr = self.link_listener.accept()
+            except socket.error, e:
+                if e.errno in WOULD_BLOCK:
+                    return
+                if e.errno in ACCEPT_ABORTED:
+                    continue
+                if e.errno in ACCEPT_EXHAUSTED:
+                    self._pause_accepting(self.link_listener, e)
+                    return
+                raise
+            self._say_hello(self._add_link(sock, ('accepted', addr)))
+
+    def _dial(self, address):
+        """Start connecting a link to another node without blocking"""
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        error = sock.connect_ex(address)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            self._call_later(self.redial_interval, lambda: self._dial(address))
+            return
+        self.dialing[sock.fileno()] = (sock, address)
+        self.poller.register(sock.fileno(), Poller.WRITE)
+
+    def _finish_dial(self, fileno):
+        """Complete a link once its connection attempt has resolved"""
+
+        sock, address = self.dialing.pop(fileno)
+        self.poller.unregister(fileno)
+        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+            sock.close()
+            self._call_later(self.redial_interval, lambda: self._dial(address))
+            return
+        self._say_hello(self._add_link(sock, ('dialed', address)))
+
+    def _add_link(self, sock, addr):
+        """Start servicing a link, which must prove itself in time"""
+
+        # Relays are batched once per pass, like writes to clients
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        link = super(FederatedServer, self)._add_link(sock, addr)
+        self._call_later(self.handshake_timeout,
+                         lambda: self._check_handshake(link))
+        return link
+
+    def _check_handshake(self, link):
+        """Drop a link that never proved it holds the link secret"""
+
+        if link not in self.link_nodes and (
+                self.links.get(link.sock.fileno()) is link):
+            self.log.link_error(link.addr, LinkError('Handshake timed out'))
+            self._remove_link(link)
+
+    def _say_hello(self, link):
+        """Identify this node to the node at the other end of link, and
+             challenge it to prove it holds the link secret
+
+           A link keeps its first challenge, so a proof made with it still
+             checks out after the hello is repeated
+        """
+
+        challenge = self.link_challenges.get(link)
+        if challenge is None:
+            challenge = self.link_challenges[link] = os.urandom(
+                CHALLENGE_SIZE)
+        self._send_over_link(link, encode_frame(self.node_id + challenge,
+                                                FED_HELLO))
+
+    def _proof(self, role, prover, verifier):
+        """Proof that the node prover holds the link secret, for verifier
+
+           role: (str) DIALER or ACCEPTOR, the side of the link prover is on
+           prover, verifier: (tuple) (node id, challenge) of each end
+        """
+
+        return hmac.new(self.link_secret, role + ''.join(prover + verifier),
+                        hashlib.sha256).digest()
+
+    def _send_proof(self, link, role):
+        """Prove this node holds the link secret to the node at the other
+             end of link
+        """
+
+        proof = self._proof(role, (self.node_id, self.link_challenges[link]),
+                            self.link_claims[link])
+        self._send_over_link(link, encode_frame(proof, FED_PROOF))
+
+    def _publish(self, kind, payload, exclude=None):
+        """Send a frame to every proven link, except the exclude link"""
+
+        frame = encode_frame(payload, kind)
+        for link in self.link_nodes:
+            if link is not exclude:
+                self._send_over_link(link, frame)
+
+    def _route_link_message(self, link, kind, payload):
+        """Act on a frame from another node
+
+           Raises LinkError for anything but a handshake from a link that
+             hasn't proved itself, and for frames too short for their headers
+        """
+
+        if kind == FED_HELLO:
+            self._handle_hello(link, payload)
+            return
+        if kind == FED_PROOF:
+            self._handle_proof(link, payload)
+            return
+        if link not in self.link_nodes:
+            raise LinkError('Frame from a link that has not proved itself')
+        if kind == FED_SNAPSHOT:
+            self._handle_snapshot(link, payload)
+        elif kind in (FED_RELAY, FED_PRESENCE):
+            header_size = MESSAGE_HEADER.size
+            if kind == FED_PRESENCE:
+                header_size += PRESENCE_HEADER.size
+            if len(payload) < header_size:
+                raise LinkError('Message is missing its header')
+            origin, sequence, hops = MESSAGE_HEADER.unpack_from(payload)
+            message_id = (origin, sequence)
+            if origin == self.node_id or message_id in self.seen:
+                return
+            self.seen.add(message_id)
+            self.routes[origin] = link
+            if hops > 1:
+                header = MESSAGE_HEADER.pack(origin, sequence, hops - 1)
+                body = payload[MESSAGE_HEADER.size:]
+                self._publish(kind, header + body, exclude=link)
+            if kind == FED_RELAY:
+                room, relayed_kind, message = decode_relay(
+                    payload, MESSAGE_HEADER.size)
+                self._deliver(message, None, relayed_kind, room)
+            else:
+                offset = MESSAGE_HEADER.size
+                count = PRESENCE_HEADER.unpack_from(payload, offset)[0]
+                room = payload[offset + PRESENCE_HEADER.size:]
+                self._update_presence(room, origin, sequence, count)
+
+    def _handle_hello(self, link, payload):
+        """Take note of the node saying hello, and prove this node holds
+             the link secret if it dialed the link
+
+           A proven node says hello again to catch up, and is sent a snapshot
+             straight away
+        """
+
+        if len(payload) != NODE_ID_SIZE + CHALLENGE_SIZE:
+            raise LinkError('Malformed hello')
+        node_id, challenge = payload[:NODE_ID_SIZE], payload[NODE_ID_SIZE:]
+        if node_id == self.node_id:
+            # Dialed ourselves
+            self._remove_link(link)
+            return
+        claim = self.link_claims.get(link)
+        if claim is not None:
+            if claim[0] != node_id:
+                raise LinkError('Node changed its id')
+            if link in self.link_nodes:
+                self._send_snapshot(link)
+            return
+        self.link_claims[link] = (node_id, challenge)
+        if link.addr[0] == 'dialed':
+            # The accepting node proves itself once this checks out
+            self._send_proof(link, DIALER)
+
+    def _handle_proof(self, link, proof):
+        """Trust a link once its node proves it holds the link secret, and
+             send it a snapshot
+
+           A node that dialed in is proved to in return, now that it is
+             trusted
+        """
+
+        if link in self.link_nodes:
+            raise LinkError('Link proved itself twice')
+        claim = self.link_claims.get(link)
+        if claim is None:
+            raise LinkError('Proof before hello')
+        dialed = link.addr[0] == 'dialed'
+        expected = self._proof(ACCEPTOR if dialed else DIALER, claim,
+                               (self.node_id, self.link_challenges[link]))
+        if not hmac.compare_digest(proof, expected):
+            raise LinkError('Link failed to prove it holds the link secret')
+        self.link_nodes[link] = claim[0]
+        if not dialed:
+            self._send_proof(link, ACCEPTOR)
+        self._send_snapshot(link)
+
+    def _send_snapshot(self, link):
+        """Send every member count this node knows of over link"""
+
+        for (room, origin), sequence in self.presence_sequences.items():
+            if origin == self.node_id:
+                count = self.registry.room_size(room)
+            else:
+                count = self.remote_members.get(room, dict()).get(origin, 0)
+            self._send_over_link(link, encode_frame(SNAPSHOT_HEADER.pack(
+                origin, sequence, count) + room, FED_SNAPSHOT))
+
+    def _handle_snapshot(self, link, payload):
+        """Take any member count newer than the one held"""
+
+        if len(payload) < SNAPSHOT_HEADER.size:
+            raise LinkError('Snapshot is missing its header')
+        origin, sequence, count = SNAPSHOT_HEADER.unpack_from(payload)
+        if origin == self.node_id:
+            return
+        self.routes.setdefault(origin, link)
+        # A snapshot only catches this node up, nobody has left. Checking
+        #   for idleness part way through one would shut down a node that
+        #   has just joined, before it hears of the members still connected
+        self._update_presence(
+            payload[SNAPSHOT_HEADER.size:], origin, sequence, count,
+            check_idle=False)
+
+    def _update_presence(self, room, origin, sequence, count,
+                         check_idle=True):
+        """Record a node's member count for room, unless already newer"""
+
+        if sequence <= self.presence_sequences.get((room, origin), 0):
+            return
+        self.presence_sequences[(room, origin)] = sequence
+        self._set_remote_members(room, origin, count)
+        # The last client in the federation may have left from that node
+        if check_idle:
+            self._check_idle()
+
+    def _originate(self, kind, payload):
+        """Stamp a new message with an id and send it to every linked node"""
+
+        sequence = next(self.sequence)
+        self.seen.add((self.node_id, sequence))
+        self._publish(kind, MESSAGE_HEADER.pack(
+            self.node_id, sequence, self.max_hops) + payload)
+        return sequence
+
+    def _relay_message(self, message, conn, kind, room):
+        """Send message to every member of room but sender, on every node"""
+
+        self._deliver(message, conn, kind, room)
+        self._originate(FED_RELAY, encode_relay(room, kind, message))
+
+    def _room_changed(self, room):
+        """Tell other nodes how many members this node has in room"""
+
+        count = self.registry.room_size(room)
+        sequence = self._originate(
+            FED_PRESENCE, PRESENCE_HEADER.pack(count) + room)
+        self.presence_sequences[(room, self.node_id)] = sequence
+
+    def _link_removed(self, link):
+        """Forget nodes reached through a lost link, and redial it if ours
+
+           Counts for nodes still reachable another way are restored by the
+             snapshots that the remaining links send in reply to a hello
+        """
+
+        self.link_nodes.pop(link, None)
+        self.link_claims.pop(link, None)
+        self.link_challenges.pop(link, None)
+        for origin in [origin for origin, route in self.routes.items()
+                       if route is link]:
+            del self.routes[origin]
+            for key in [key for key in self.presence_sequences
+                        if key[1] == origin]:
+                del self.presence_sequences[key]
+            self._forget_remote_members(origin)
+        for remaining in self.links.values():
+            self._say_hello(remaining)
+        role, address = link.addr
+        if role == 'dialed' and self._running:
+            self._call_later(self.redial_interval, lambda: self._dial(address))
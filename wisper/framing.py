@@ -0,0 +1,174 @@
+import struct
+
+
+"""Length-prefixed framing for wire traffic between clients and the server
+
+   Every frame is a fixed-size header holding the payload length and kind,
+     followed by the payload itself. Payloads are opaque, so binary ciphertext
+     of any size can be carried without escaping or scanning for delimiters.
+
+   The kind is never encrypted. It tells a receiver what the payload is
+     before any work is done on it, so ciphertext is only ever decrypted once
+     and plain-text server notices are never put through the cipher.
+"""
+
+
+# Payload length as a 4 byte unsigned big-endian integer, then a 1 byte kind
+HEADER = struct.Struct('!IB')
+
+# Frame kinds
+SERVER_NOTICE = 0x01  # Plain-text status update sent by the server
+PEER_MESSAGE = 0x02  # Ciphertext sent by a client, relayed untouched
+JOIN_ROOM = 0x03  # Room a client is joining, and the codecs it has. See below
+ROOM_CODECS = 0x04  # Optional codecs every member of the client's room has
+REPLAY_HISTORY = 0x05  # Sequence number to replay the room's history from
+HISTORY_MESSAGE = 0x06  # Ciphertext from the room's history. See below
+RESUME_SESSION = 0x07  # Session a client is resuming or opening. See below
+SESSION_TOKEN = 0x08  # Token of the session the client now has
+SESSION_MESSAGE = 0x09  # Ciphertext headed by the sender's sequence number
+MESSAGE_ACK = 0x0A  # What the server has received and sent. See below
+ROOM_MESSAGE = 0x0B  # Ciphertext headed by its sequence number in the room
+FILE_CHUNK = 0x0C  # Encrypted piece of a file, passed on as received
+ROOM_PRESENCE = 0x0D  # Recent joins and leaves in the room. See below
+MESSAGE_LIMIT = 0x0E  # Largest payload the server takes. See below
+
+# Separates the room name in a JOIN_ROOM payload from the comma separated
+#   names of the optional codecs the client can decompress. Clients that
+#   have none send the room name alone
+JOIN_SEPARATOR = '\x00'
+
+# Sequence number of the first message a client wants replayed. 0 replays
+#   everything still held
+REPLAY_HEADER = struct.Struct('!Q')
+
+# Sequence number within its room and time received of a message heading
+#   its ciphertext in a HISTORY_MESSAGE payload
+HISTORY_HEADER = struct.Struct('!Qd')
+
+# Sequence number heading the ciphertext of SESSION_MESSAGE and ROOM_MESSAGE
+#   payloads. Clients number their messages from 1 for the life of their
+#   session, rooms number theirs in the room's history
+SEQUENCE_HEADER = struct.Struct('!Q')
+
+# Sequence number of the last room message a client received, heading the
+#   token of the session it is resuming in a RESUME_SESSION payload. A client
+#   without a session sends no token, and is given a new one
+RESUME_HEADER = SEQUENCE_HEADER
+
+# Random bytes identifying a session
+SESSION_TOKEN_SIZE = 16
+
+# Members who joined and left the room since the last ROOM_PRESENCE, and the
+#   number of peers the recipient now shares it with
+ROOM_PRESENCE_HEADER = struct.Struct('!III')
+
+# Largest frame payload the server takes from the client, sent when the
+#   client joins a room. A client sending more is disconnected
+MESSAGE_LIMIT_HEADER = struct.Struct('!I')
+
+# FILE_CHUNK payloads are a SEQUENCE_HEADER numbered by the sender's session,
+#   then the ciphertext. The server relays the frame exactly as it was
+#   received, so recipients see the sender's sequence number, and ignore it
+
+# Sequence number of the last session message received from the client, and
+#   of the last room message the client has been sent or has no need of. The
+#   latter is 0 when the server keeps no history
+ACK_HEADER = struct.Struct('!QQ')
+
+# Frame kinds exchanged between the worker processes of one server instance
+BUS_RELAY = 0x10  # Message for the members of a room on other workers
+BUS_PRESENCE = 0x11  # Number of members the sending worker has in a room
+BUS_SHUTDOWN = 0x12  # Sending worker found the whole instance idle
+
+# Frame kinds exchanged between federated server nodes
+FED_HELLO = 0x20  # Node id and challenge of the sender. See federation.py
+FED_RELAY = 0x21  # Message for the members of a room on other nodes
+FED_PRESENCE = 0x22  # Number of members the origin node has in a room
+FED_SNAPSHOT = 0x23  # Last known member count of a node in a room
+FED_PROOF = 0x24  # Proof the sender holds the link secret. See federation.py
+
+# Frames larger than this are treated as a corrupt or hostile stream
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class FrameError(ValueError):
+    """Raised when a stream cannot be decoded into frames"""
+
+
+def encode_frame(payload, kind):
+    """Prefix payload with its length and kind"""
+
+    return HEADER.pack(len(payload), kind) + payload
+
+
+def frame_kind(frame):
+    """Kind of an encoded frame"""
+
+    return HEADER.unpack_from(frame)[1]
+
+
+def encode_join(room, codecs=()):
+    """Pack a JOIN_ROOM payload"""
+
+    if not codecs:
+        return room
+    return room + JOIN_SEPARATOR + ','.join(sorted(codecs))
+
+
+def decode_join(payload):
+    """Unpack a JOIN_ROOM payload
+
+       Returns a (room, codecs) tuple, codecs being a frozenset of names
+    """
+
+    room, _, codecs = payload.partition(JOIN_SEPARATOR)
+    return room, frozenset(codec for codec in codecs.split(',') if codec)
+
+
+class FrameDecoder(object):
+    """Incremental decoder for a stream of frames
+
+       Partial reads are buffered until the frames they belong to are
+         complete, so callers can feed whatever a single recv returns.
+
+       buffer: (bytearray) Received bytes not yet returned as frames
+       max_frame_size: (int) Largest payload accepted. See FrameError
+       whole_kinds: (frozenset) Kinds of frame returned whole, header
+         included, in place of their payload. A frame that is only passed
+         on is then never copied again, or encoded again
+    """
+
+    __slots__ = ('buffer', 'max_frame_size', 'whole_kinds')
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, whole_kinds=()):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+        self.whole_kinds = frozenset(whole_kinds)
+
+    def feed(self, data):
+        """Buffer received data and return every frame it completes
+
+           Frames are returned as a list of (kind, payload) tuples
+        """
+
+        buf = self.buffer
+        buf.extend(data)
+        end = len(buf)
+        offset = 0
+        frames = []
+        while end - offset >= HEADER.size:
+            length, kind = HEADER.unpack_from(buf, offset)
+            if length > self.max_frame_size:
+                raise FrameError('Frame of %d bytes exceeds limit of %d' % (
+                    length, self.max_frame_size))
+            start = offset + HEADER.size
+            if end - start < length:
+                # Remainder of this frame has not arrived yet
+                break
+            if kind in self.whole_kinds:
+                start = offset
+            offset += HEADER.size + length
+            frames.append((kind, str(buf[start:offset])))
+        if offset:
+            del buf[:offset]
+        return frames
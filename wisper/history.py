@@ -0,0 +1,345 @@
+import mmap
+import os
+import re
+import struct
+import time
+from collections import deque
+
+from framing import HEADER, HISTORY_HEADER, HISTORY_MESSAGE, encode_frame
+
+
+"""Message history kept by the server for late joiners
+
+   Ciphertext relayed to a room is appended to a log on disk, so that peers
+     who join later can ask for it to be replayed. The log is split into
+     fixed-size segment files, each memory-mapped, and old segments are
+     deleted whole once a retention limit is passed. The server never holds
+     more of the history in memory than the batch it is replaying.
+"""
+
+
+# Room name length and stored frame length heading each record in a
+#   segment. A zero frame length marks the end of the records written
+RECORD_HEADER = struct.Struct('!BI')
+
+# Segment files are named after the first record number they hold
+SEGMENT_NAME = '%020d.log'
+SEGMENT_PATTERN = re.compile(r'^\d{20}\.log$')
+
+
+class Segment(object):
+    """One memory-mapped file of the history log
+
+       Records are appended until the next one doesn't fit. The file is
+         created at its full size, so unwritten space reads as zeros.
+
+       path: (str) Location of the file
+       map: (mmap) The whole file, mapped shared
+       end: (int) Offset just past the last record written
+       count: (int) Records held
+       last_time: (float) Time the newest record was received
+       rooms: (set) Names of rooms with records in this segment
+    """
+
+    __slots__ = ('path', 'file', 'map', 'end', 'count', 'last_time', 'rooms')
+
+    def __init__(self, path, size=None):
+        self.file = open(path, 'r+b' if size is None else 'w+b')
+        if size is not None:
+            self.file.truncate(size)
+        self.path = path
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.end = 0
+        self.count = 0
+        self.last_time = 0
+        self.rooms = set()
+
+    def space(self):
+        return len(self.map) - self.end
+
+    def append(self, room, frame):
+        """Write a record, returning its offset"""
+
+        offset = self.end
+        record = RECORD_HEADER.pack(len(room), len(frame)) + room + frame
+        self.map[offset:offset + len(record)] = record
+        self.end += len(record)
+        self.count += 1
+        self.rooms.add(room)
+        return offset
+
+    def read(self, offset):
+        """Copy out the frame of the record at offset"""
+
+        room_length, frame_length = RECORD_HEADER.unpack_from(self.map, offset)
+        start = offset + RECORD_HEADER.size + room_length
+        return self.map[start:start + frame_length]
+
+    def records(self):
+        """Yield (offset, room, frame) for every record, oldest first"""
+
+        offset = 0
+        while len(self.map) - offset >= RECORD_HEADER.size:
+            room_length, frame_length = RECORD_HEADER.unpack_from(
+                self.map, offset)
+            if not frame_length:
+                break
+            start = offset + RECORD_HEADER.size
+            frame_start = start + room_length
+            yield (offset, self.map[start:frame_start],
+                   self.map[frame_start:frame_start + frame_length])
+            offset = frame_start + frame_length
+        self.end = offset
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def delete(self):
+        self.close()
+        os.remove(self.path)
+
+
+class RoomHistory(object):
+    """Index of the records held for one room
+
+       Sequence numbers count the messages relayed to the room, from 1.
+         They are never reused, even once the records are deleted.
+
+       first_seq: (int) Sequence number of the oldest record held
+       next_seq: (int) Sequence number the next message will get
+       locations: (deque) (segment, offset, record) of every record held,
+         oldest first, so the location of a sequence number is found by
+         position. record numbers every record in the log, across rooms
+    """
+
+    __slots__ = ('first_seq', 'next_seq', 'locations')
+
+    def __init__(self):
+        self.first_seq = 1
+        self.next_seq = 1
+        self.locations = deque()
+
+
+class MessageHistory(object):
+    """Segmented append-only log of the ciphertext relayed to each room
+
+       Records are stored as ready-made HISTORY_MESSAGE frames, so replay
+         copies them out of the map and queues them as they are.
+
+       Retention is applied a segment at a time. The oldest segment is
+         deleted once the segments after it hold max_messages or max_bytes
+         on their own, or once its newest message is older than max_age. So
+         the limits are always held, along with at most one segment more.
+         Messages older than max_age, or older than the newest max_messages,
+         are never replayed.
+
+       directory: (str) Where segment files are kept. Records found there
+         are recovered by open
+
+       max_messages: (int) Most messages held, across every room
+       max_bytes: (int) Most bytes of segment files kept
+       max_age: (float) Seconds a message is held for
+       segment_size: (int) Size of each segment file, in bytes
+
+       segments: (list) Open segments, oldest first. The last is written to
+       rooms: (dict) Mapping of room names to their RoomHistory
+       next_record: (int) Number the next record in the log will get
+    """
+
+    def __init__(self, directory, max_messages=10000, max_bytes=67108864,
+                 max_age=86400, segment_size=4194304):
+        self.directory = directory
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segment_size = segment_size
+        self.segments = []
+        self.rooms = dict()
+        self.count = 0
+        self.size = 0
+        self.next_record = 0
+
+    def for_worker(self, worker_id):
+        """Unopened copy with its own directory, for a worker process"""
+
+        return MessageHistory(
+            os.path.join(self.directory, 'worker-%d' % worker_id),
+            self.max_messages, self.max_bytes, self.max_age,
+            self.segment_size)
+
+    def open(self):
+        """Create the directory if needed, and recover its records"""
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        names = sorted(name for name in os.listdir(self.directory)
+                       if SEGMENT_PATTERN.match(name))
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if not os.path.getsize(path):
+                # Never written, cannot be mapped
+                os.remove(path)
+                continue
+            segment = Segment(path)
+            self._add_segment(segment)
+            for offset, room, frame in segment.records():
+                seq, received = HISTORY_HEADER.unpack_from(frame, HEADER.size)
+                history = self._room(room)
+                if not history.locations:
+                    history.first_seq = seq
+                history.next_seq = seq + 1
+                history.locations.append(
+                    (segment, offset, int(name[:20]) + segment.count))
+                segment.count += 1
+                segment.last_time = received
+                segment.rooms.add(room)
+            self.count += segment.count
+            self.next_record = int(name[:20]) + segment.count
+        self._apply_retention(time.time())
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+        del self.segments[:]
+
+    def append(self, room, message):
+        """Store a message relayed to room, returning its sequence number"""
+
+        now = time.time()
+        history = self._room(room)
+        seq = history.next_seq
+        frame = encode_frame(HISTORY_HEADER.pack(seq, now) + message,
+                             HISTORY_MESSAGE)
+        record_size = RECORD_HEADER.size + len(room) + len(frame)
+        if not self.segments or self.segments[-1].space() < record_size:
+            segment = Segment(
+                os.path.join(self.directory, SEGMENT_NAME % self.next_record),
+                max(self.segment_size, record_size))
+            self._add_segment(segment)
+        segment = self.segments[-1]
+        history.locations.append(
+            (segment, segment.append(room, frame), self.next_record))
+        history.next_seq = seq + 1
+        segment.last_time = now
+        self.count += 1
+        self.next_record += 1
+        self._apply_retention(now)
+        return seq
+
+    def read(self, room, seq):
+        """Return the HISTORY_MESSAGE frame of room's message number seq
+
+           None when the message has been deleted, or doesn't exist yet
+        """
+
+        history = self.rooms.get(room)
+        if history is None or not history.first_seq <= seq < history.next_seq:
+            return None
+        segment, offset, record = history.locations[seq - history.first_seq]
+        if record < self.next_record - self.max_messages:
+            # Past max_messages, though its segment is still waiting to be
+            #   deleted
+            return None
+        frame = segment.read(offset)
+        received = HISTORY_HEADER.unpack_from(frame, HEADER.size)[1]
+        if received < time.time() - self.max_age:
+            # Expired, though its segment is still waiting to be deleted
+            return None
+        return frame
+
+    def last_seq(self, room):
+        """Sequence number of the newest message relayed to room, or 0"""
+
+        history = self.rooms.get(room)
+        if history is None:
+            return 0
+        return history.next_seq - 1
+
+    def cursor(self, room, from_seq=0):
+        """Start a replay of room's history. See HistoryCursor"""
+
+        history = self.rooms.get(room)
+        if history is None:
+            return HistoryCursor(self, room, 1, 1)
+        # The room can't have more than max_messages of the newest
+        return HistoryCursor(
+            self, room, max(from_seq, history.first_seq,
+                            history.next_seq - self.max_messages),
+            history.next_seq)
+
+    def _room(self, room):
+        history = self.rooms.get(room)
+        if history is None:
+            history = self.rooms[room] = RoomHistory()
+        return history
+
+    def _add_segment(self, segment):
+        self.segments.append(segment)
+        self.size += len(segment.map)
+
+    def _apply_retention(self, now):
+        """Delete the oldest segments while they are over a limit"""
+
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            if not (self.count - oldest.count >= self.max_messages or
+                    self.size - len(oldest.map) >= self.max_bytes or
+                    oldest.last_time < now - self.max_age):
+                return
+            self._drop_oldest()
+
+    def _drop_oldest(self):
+        segment = self.segments.pop(0)
+        for room in segment.rooms:
+            history = self.rooms[room]
+            locations = history.locations
+            while locations and locations[0][0] is segment:
+                locations.popleft()
+                history.first_seq += 1
+        self.count -= segment.count
+        self.size -= len(segment.map)
+        segment.delete()
+
+
+class HistoryCursor(object):
+    """Position of a replay in progress
+
+       Replays stop at the newest message there was when they started.
+         Anything relayed after that reaches the client live.
+
+       next_seq: (int) Sequence number of the next message to replay
+       end_seq: (int) Sequence number the replay stops before
+    """
+
+    __slots__ = ('history', 'room', 'next_seq', 'end_seq')
+
+    def __init__(self, history, room, next_seq, end_seq):
+        self.history = history
+        self.room = room
+        self.next_seq = next_seq
+        self.end_seq = end_seq
+
+    def done(self):
+        return self.next_seq >= self.end_seq
+
+    def read(self, max_bytes):
+        """Return the next frames of the replay, up to about max_bytes
+
+           Messages deleted since the replay started are skipped
+        """
+
+        frames = []
+        size = 0
+        while size < max_bytes and self.next_seq < self.end_seq:
+            history = self.history.rooms[self.room]
+            # Skip past anything deleted by retention
+            self.next_seq = max(self.next_seq, history.first_seq)
+            if self.next_seq >= self.end_seq:
+                break
+            frame = self.history.read(self.room, self.next_seq)
+            self.next_seq += 1
+            if frame is not None:
+                frames.append(frame)
+                size += len(frame)
+        return frames
@@ -0,0 +1,83 @@
+"""Limits on what clients can ask of a server
+
+   Each connection can be given token buckets limiting the frames and bytes
+     it sends. A frame is let through while the buckets hold any tokens at
+     all, so a frame larger than a bucket's burst still gets through, and
+     the bucket is overdrawn until it has been paid back. See
+     Server._admit_frames
+
+   Bytes buffered for every client are counted against a BufferBudget,
+     shared by the whole server. See Server._enforce_budget. Links between
+     servers are limited on their own instead, see links.py
+"""
+
+
+# What happens to a client sending faster than its rate limits allow
+#   throttle: Frames past the limits are held, and the socket isn't read
+#     until they have been routed, so TCP flow control slows the client down
+#   disconnect: The client is removed
+RATE_LIMIT_POLICIES = ('throttle', 'disconnect')
+
+
+class TokenBucket(object):
+    """Rate limit that allows short bursts
+
+       rate: (float) Tokens added per second
+       burst: (float) Most tokens held at once
+       tokens: (float) Tokens available. Negative while overdrawn
+       updated: (float) Time tokens was last refilled
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def ready(self, now):
+        """Refill the bucket, returns whether it isn't overdrawn"""
+
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens >= 0
+
+    def take(self, amount):
+        self.tokens -= amount
+
+    def wait(self):
+        """Seconds until an overdrawn bucket is paid back"""
+
+        return max(0, -self.tokens / self.rate)
+
+
+class BufferBudget(object):
+    """Bytes a server holds in connection buffers, against a limit
+
+       Outbound queues count what they hold as frames are pushed and
+         written, and the server counts what frame decoders hold as data is
+         read. A frame relayed to many clients is counted once for each
+         queue it is in, so used is an upper bound on the memory held.
+
+       limit: (int) Most bytes buffered before clients are shed. 0 for no
+         limit
+       used: (int) Bytes buffered now
+       peak: (int) Most bytes buffered at the end of any pass of the event
+         loop
+    """
+
+    __slots__ = ('limit', 'used', 'peak')
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+
+    def exceeded(self):
+        """Record the peak, returns whether the limit is exceeded"""
+
+        if self.used > self.peak:
+            self.peak = self.used
+        return bool(self.limit) and self.used > self.limit
@@ -0,0 +1,213 @@
+import struct
+
+from framing import encode_frame
+from poller import Poller
+from server import Connection, Server
+
+
+"""Links between servers
+
+   LinkedServer is the shared base of servers that exchange room traffic and
+     membership with other servers over links: the worker processes of one
+     instance (see workers.py) and federated nodes (see federation.py).
+
+   Frames for a link are never dropped, as the server at the other end
+     relies on every one of them. A link that falls more than
+     link_buffer_limit bytes behind is dropped instead. Link buffers count
+     against their own budget, not the server's, so a stuck link never gets
+     clients shed.
+"""
+
+
+# Frame kind and room name length of a message relayed between servers
+RELAY_HEADER = struct.Struct('!BB')
+
+
+class LinkError(ValueError):
+    """Raised when a frame from a link is malformed, or not allowed yet"""
+
+
+def encode_relay(room, kind, message):
+    """Pack a room message for delivery by another server"""
+
+    return RELAY_HEADER.pack(kind, len(room)) + room + message
+
+
+def decode_relay(payload, offset=0):
+    """Unpack a room message relayed by another server
+
+       offset: (int) Position of the relay header within payload
+
+       Returns a (room, kind, message) tuple. Raises LinkError when payload
+         is too short to hold what its header says
+    """
+
+    if len(payload) < offset + RELAY_HEADER.size:
+        raise LinkError('Relayed message is missing its header')
+    kind, room_length = RELAY_HEADER.unpack_from(payload, offset)
+    room_start = offset + RELAY_HEADER.size
+    room_end = room_start + room_length
+    if len(payload) < room_end:
+        raise LinkError('Relayed message is missing its room name')
+    return payload[room_start:room_end], kind, payload[room_end:]
+
+
+class LinkedServer(Server):
+    """Server that shares its rooms with other servers over links
+
+       Link sockets are serviced by the same event loop as clients, and use
+         the same framing and outbound queues. Frames read from a link are
+         passed to _route_link_message, which subclasses implement.
+
+       links: (dict) Mapping of link socket file descriptors to the
+         Connection for the server at the other end
+
+       remote_members: (dict) Mapping of room names to a mapping of remote
+         server ids to the number of members that server has in the room
+
+       link_buffer_limit: (int) Most bytes queued for a link before it is
+         dropped
+    """
+
+    def __init__(self, link_buffer_limit=16777216, **kwargs):
+        super(LinkedServer, self).__init__(**kwargs)
+        self.links = dict()
+        self.remote_members = dict()
+        self.link_buffer_limit = link_buffer_limit
+
+    def _add_link(self, sock, addr):
+        """Start servicing a connected link socket"""
+
+        sock.setblocking(False)
+        link = Connection(sock, addr, self.high_watermark, self.low_watermark)
+        self.links[sock.fileno()] = link
+        self.poller.register(sock.fileno(), Poller.READ)
+        return link
+
+    def _handle_event(self, fileno, events):
+        """Service a readiness event on a client or link socket"""
+
+        link = self.links.get(fileno)
+        if link is None:
+            super(LinkedServer, self)._handle_event(fileno, events)
+            return
+        try:
+            self._handle_link_event(link, fileno, events)
+        except Exception, e:
+            # A link that sends what can't be handled is dropped, like a
+            #   client would be, rather than taking the server down with it
+            self.log.link_error(link.addr, e)
+            if self.links.get(fileno) is link:
+                self._remove_link(link)
+
+    def _handle_link_event(self, link, fileno, events):
+        """Service a readiness event on a link socket"""
+
+        if events & Poller.READ:
+            link_messages = self._receive_frames(link)
+            if link_messages is None:
+                self._remove_link(link)
+                return
+            for kind, payload in link_messages:
+                self._route_link_message(link, kind, payload)
+                if fileno not in self.links:
+                    return
+        if fileno not in self.links:
+            return
+        if events & Poller.WRITE:
+            self._flush(link)
+        elif events & Poller.ERROR and not events & Poller.READ:
+            self._remove_link(link)
+
+    def _route_link_message(self, link, kind, payload):
+        """Act on a frame read from a link
+
+           Raises LinkError, or any other exception, to drop the link
+        """
+
+        raise NotImplementedError
+
+    def _publish(self, kind, payload, exclude=None):
+        """Send a frame to every linked server, except the exclude link"""
+
+        frame = encode_frame(payload, kind)
+        for link in self.links.values():
+            if link is not exclude:
+                self._send_over_link(link, frame)
+
+    def _send_over_link(self, link, frame):
+        """Queue a frame for the server at the other end of link
+
+           A link the frame would take past link_buffer_limit is dropped once
+             the current pass of the event loop is done with it
+        """
+
+        if link.sock in self.failed_clients:
+            return
+        if link.outbound.size + len(frame) > self.link_buffer_limit:
+            self.log.link_error(link.addr, LinkError(
+                'Link is %d bytes behind' % link.outbound.size))
+            self.failed_clients.append(link.sock)
+            return
+        self._queue_frame(link, frame)
+
+    def _set_remote_members(self, room, server_id, count):
+        """Record the number of members a remote server has in room"""
+
+        members = self.remote_members.setdefault(room, dict())
+        change = count - members.get(server_id, 0)
+        if change > 0:
+            self._presence_changed(room, joined=change)
+        elif change < 0:
+            self._presence_changed(room, left=-change)
+        if count:
+            members[server_id] = count
+            # A client arrived on another server
+            self._leave_idle()
+        else:
+            members.pop(server_id, None)
+            if not members:
+                del self.remote_members[room]
+
+    def _forget_remote_members(self, server_id):
+        """Drop every member count held for a remote server"""
+
+        for room in [room for room, members in self.remote_members.items()
+                     if server_id in members]:
+            self._set_remote_members(room, server_id, 0)
+
+    def _room_size(self, room):
+        """Number of clients that have joined room, across every server"""
+
+        remote_count = sum(self.remote_members.get(room, dict()).values())
+        return self.registry.room_size(room) + remote_count
+
+    def _is_idle(self):
+        """Whether no clients remain on any linked server"""
+
+        return not self.registry and not self.remote_members
+
+    def _remove_client(self, conn):
+        """Remove unresponsive client or link connection"""
+
+        for link in self.links.values():
+            if link.sock is conn:
+                self._remove_link(link)
+                return
+        super(LinkedServer, self)._remove_client(conn)
+
+    def _remove_link(self, link):
+        """Stop servicing a link that has gone away"""
+
+        fileno = link.sock.fileno()
+        del self.links[fileno]
+        self.pending_writes.discard(link)
+        self._release_buffers(link)
+        self.poller.unregister(fileno)
+        link.sock.close()
+        self._link_removed(link)
+
+    def _link_removed(self, link):
+        """Called after a link has been closed and forgotten"""
+
+        pass
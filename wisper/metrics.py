@@ -0,0 +1,253 @@
+import BaseHTTPServer
+import threading
+from bisect import bisect_left
+
+
+"""Live server metrics
+
+   Every Server keeps a ServerMetrics registry. Updating it costs an integer
+     addition, or a bisect for histograms, so it is always on. With a
+     metrics port set, the registry is served over HTTP in the Prometheus
+     text format at /metrics. See session.run_server
+"""
+
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Histogram bucket upper bounds, in seconds and in bytes
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576,
+                4194304)
+IDLE_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+class Counter(object):
+    """Value that only goes up"""
+
+    __slots__ = ('name', 'help', 'value')
+
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        return [(self.name, '', self.value)]
+
+
+class Gauge(object):
+    """Value read from the server whenever the metrics are rendered
+
+       function: (callable) Returns the current value. Runs on the metrics
+         endpoint thread, so it must only read
+    """
+
+    __slots__ = ('name', 'help', 'function')
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, function):
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def samples(self):
+        return [(self.name, '', self.function())]
+
+
+class Histogram(object):
+    """Distribution of observed values over fixed buckets
+
+       buckets: (tuple) Ascending bucket upper bounds
+       counts: (list) Observations per bucket, not cumulative. The last
+         entry counts values above every bound
+       sum: (float) Total of every observed value
+    """
+
+    __slots__ = ('name', 'help', 'buckets', 'counts', 'sum')
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            samples.append((self.name + '_bucket', '{le="%s"}' % bound,
+                            cumulative))
+        samples.append((self.name + '_sum', '', self.sum))
+        samples.append((self.name + '_count', '', cumulative))
+        return samples
+
+
+class Registry(object):
+    """Collection of metrics rendered together
+
+       Metrics are registered up front and never removed, so rendering from
+         another thread needs no lock. A scrape may see a histogram part way
+         through an update, which is corrected by the next one.
+
+       metrics: (list) Registered metrics, in rendering order
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help):
+        return self._register(Counter(name, help))
+
+    def gauge(self, name, help, function):
+        return self._register(Gauge(name, help, function))
+
+    def histogram(self, name, help, buckets):
+        return self._register(Histogram(name, help, buckets))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Format every metric in the Prometheus text format"""
+
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %r' % (name, labels, float(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class ServerMetrics(Registry):
+    """Metrics kept by every Server
+
+       Counters and histograms are updated by the server as events happen.
+         Gauges read the server's own state, so they cost nothing until
+         rendered.
+    """
+
+    def __init__(self, server):
+        super(ServerMetrics, self).__init__()
+        self.connections_accepted = self.counter(
+            'wisper_connections_accepted_total', 'Client connections accepted')
+        self.connections_rejected = self.counter(
+            'wisper_connections_rejected_total',
+            'Client connections turned away by the connection limit')
+        self.gauge('wisper_connections_open', 'Client connections open',
+                   lambda: len(server.registry))
+        self.gauge('wisper_rooms', 'Rooms with members on this server',
+                   lambda: len(server.registry.rooms))
+        self.messages_received = self.counter(
+            'wisper_messages_received_total', 'Peer messages received')
+        self.messages_delivered = self.counter(
+            'wisper_messages_delivered_total',
+            'Peer messages and notices routed to room members')
+        self.file_chunks = self.counter(
+            'wisper_file_chunks_total', 'File chunks received from clients')
+        self.bytes_received = self.counter(
+            'wisper_bytes_received_total', 'Bytes read from sockets')
+        self.bytes_sent = self.counter(
+            'wisper_bytes_sent_total', 'Bytes written to sockets')
+        self.slow_consumer_events = self.counter(
+            'wisper_slow_consumer_events_total',
+            'Frames sent to congested clients')
+        self.rate_limited = self.counter(
+            'wisper_rate_limited_total',
+            'Times a client was held back or removed for exceeding its '
+            'rate limits')
+        self.gauge('wisper_buffered_bytes',
+                   'Bytes held in connection buffers, counting a frame '
+                   'queued for several clients once for each',
+                   lambda: server.budget.used)
+        self.gauge('wisper_buffered_bytes_peak',
+                   'Most bytes held in connection buffers so far',
+                   lambda: server.budget.peak)
+        self.budget_disconnects = self.counter(
+            'wisper_budget_disconnects_total',
+            'Clients removed for holding more buffered bytes than allowed')
+        self.relay_seconds = self.histogram(
+            'wisper_relay_seconds',
+            'Time taken to route a peer message to every member of its room',
+            LATENCY_BUCKETS)
+        self.gauge('wisper_sessions', 'Sessions clients can resume',
+                   lambda: len(server.sessions))
+        self.sessions_resumed = self.counter(
+            'wisper_sessions_resumed_total',
+            'Sessions resumed by a reconnecting client')
+        self.duplicate_messages = self.counter(
+            'wisper_duplicate_messages_total',
+            'Session messages sent again after a reconnect, that had arrived')
+        self.idle_periods = self.counter(
+            'wisper_idle_periods_total',
+            'Times the last client left, starting the idle grace period')
+        self.idle_reconnects = self.counter(
+            'wisper_idle_reconnects_total',
+            'Idle grace periods ended by a client arriving')
+        self.idle_seconds = self.histogram(
+            'wisper_idle_seconds',
+            'Length of each idle grace period, until a client arrived or '
+            'the server shut down', IDLE_BUCKETS)
+        self.outbound_bytes = self.histogram(
+            'wisper_outbound_bytes',
+            'Bytes queued for a socket each time it is written to',
+            SIZE_BUCKETS)
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the registry of the MetricsEndpoint it belongs to"""
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes aren't server events
+        pass
+
+
+class MetricsEndpoint(object):
+    """HTTP endpoint serving a registry from a background thread
+
+       Scrapes are served apart from the event loop, so a slow scraper never
+         holds up relaying.
+
+       httpd: (HTTPServer) Bound HTTP server
+    """
+
+    def __init__(self, registry, address):
+        self.httpd = BaseHTTPServer.HTTPServer(address, _MetricsHandler)
+        self.httpd.registry = registry
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
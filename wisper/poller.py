@@ -0,0 +1,59 @@
+import select
+
+
+class Poller(object):
+    """Readiness notification for non-blocking sockets
+
+       Wraps epoll where the platform provides it, and falls back to poll
+         otherwise. Both share event mask values, so callers only ever deal
+         with the constants defined on this class.
+
+       READ: Socket has data to receive, or a connection to accept
+       WRITE: Socket can accept more outbound data
+       ERROR: Socket hung up or is in an error state
+    """
+
+    READ = select.POLLIN
+    WRITE = select.POLLOUT
+    ERROR = select.POLLERR | select.POLLHUP
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            # epoll timeouts are in seconds
+            self._timeout_scale = 1
+        else:
+            self._poller = select.poll()
+            # poll timeouts are in milliseconds
+            self._timeout_scale = 1000
+
+    def register(self, fileno, events):
+        self._poller.register(fileno, events)
+
+    def modify(self, fileno, events):
+        self._poller.modify(fileno, events)
+
+    def unregister(self, fileno):
+        try:
+            self._poller.unregister(fileno)
+        except (KeyError, IOError, OSError):
+            # Already unregistered, or descriptor was closed first
+            pass
+
+    def poll(self, timeout=None):
+        """Block until at least one registered socket is ready
+
+           timeout: (float) Seconds to wait. None waits indefinitely
+
+           Returns a list of (fileno, events) tuples
+        """
+
+        if timeout is None:
+            timeout = -1
+        else:
+            timeout *= self._timeout_scale
+        return self._poller.poll(timeout)
+
+    def close(self):
+        if hasattr(self._poller, 'close'):
+            self._poller.close()
@@ -1,18 +1,80 @@
-from secure_message_pb2 import SecureMessage
+from compression import (BASELINE_CODECS, CompressionError,
+                         available_codecs, compress, decompress)
+from secure_message_pb2 import FileChunk, SecureMessage
 
 
-def serialize(body, sender):
-    """Serialize outbound message with protobuf"""
+def serialize(body, sender, codecs=BASELINE_CODECS):
+    """Serialize outbound message with protobuf
+
+       Large bodies are compressed with the preferred codec out of codecs.
+         See compression.py
+    """
+
+    return serialize_batch([body], sender, codecs)
+
+
+def serialize_batch(bodies, sender, codecs=BASELINE_CODECS):
+    """Serialize several outbound messages into one with protobuf
+
+       The first body is sent as the message itself, and the rest in its
+         batch, so peers that don't read batches still see the first. Each
+         body is compressed on its own, as serialize does
+    """
 
     sm = SecureMessage()
-    sm.body = body
-    sm.sender = sender
+    _set_body(sm, bodies[0], sender, codecs)
+    for body in bodies[1:]:
+        _set_body(sm.batch.add(), body, sender, codecs)
     return sm.SerializeToString()
 
 
+def _set_body(sm, body, sender, codecs):
+    codec, sm.body = compress(body, codecs)
+    if codec is not None:
+        sm.codec = SecureMessage.Codec.Value(codec.upper())
+    sm.sender = sender
+
+
 def deserialize(data):
-    """Deserialize inbound message with protobuf"""
+    """Deserialize inbound message with protobuf
+
+       Compressed bodies are decompressed, including those in the batch.
+         Raises CompressionError when that isn't possible
+    """
 
     sm = SecureMessage()
     sm.ParseFromString(data)
+    for message in [sm] + list(sm.batch):
+        if message.codec != SecureMessage.NONE:
+            message.body = decompress(
+                message.body, SecureMessage.Codec.Name(message.codec).lower())
+            message.ClearField('codec')
     return sm
+
+
+def serialize_chunk(transfer_id, sender, index, data, name=None, size=None,
+                    digest=None):
+    """Serialize one chunk of a file transfer with protobuf
+
+       Chunks are never compressed. See transfers.py
+    """
+
+    chunk = FileChunk()
+    chunk.transfer_id = transfer_id
+    chunk.sender = sender
+    chunk.index = index
+    chunk.data = data
+    if name is not None:
+        chunk.name = name
+        chunk.size = size
+    if digest is not None:
+        chunk.digest = digest
+    return chunk.SerializeToString()
+
+
+def deserialize_chunk(data):
+    """Deserialize one chunk of a file transfer with protobuf"""
+
+    chunk = FileChunk()
+    chunk.ParseFromString(data)
+    return chunk
@@ -0,0 +1,97 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    # Optional, see the 'zstd' extra in setup.py
+    zstandard = None
+
+
+"""Compression of message bodies before they are encrypted
+
+   Ciphertext does not compress, so bodies are compressed by the sender,
+     before encryption. Short bodies are sent as they are, and a codec is
+     only used when its output is actually smaller, so small messages pay
+     nothing for it. The codec used is recorded in the SecureMessage itself.
+
+   zlib is in the standard library, so every client can read it. zstd is
+     faster and compresses better, but is only used in rooms where every
+     member has it. See server.Server._announce_codecs
+"""
+
+
+# Bodies shorter than this are never compressed, in bytes
+MIN_COMPRESS_SIZE = 512
+
+# Largest body a compressed message may expand to, in bytes. Matches the
+#   largest frame a client accepts
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+# Codecs every client can decompress
+BASELINE_CODECS = frozenset(['zlib'])
+
+# Codecs in order of preference
+CODEC_PREFERENCE = ('zstd', 'zlib')
+
+
+class CompressionError(ValueError):
+    """Raised when a body can't be decompressed"""
+
+
+def available_codecs():
+    """Names of the codecs this installation can compress and decompress"""
+
+    codecs = set(BASELINE_CODECS)
+    if zstandard is not None:
+        codecs.add('zstd')
+    return frozenset(codecs)
+
+
+def compress(body, codecs=BASELINE_CODECS):
+    """Compress body with the preferred codec out of codecs
+
+       Returns a (codec, data) tuple. codec is None when body was left as it
+         is, because it is too short or didn't get any smaller
+    """
+
+    if len(body) < MIN_COMPRESS_SIZE:
+        return None, body
+    for codec in CODEC_PREFERENCE:
+        if codec in codecs:
+            break
+    else:
+        return None, body
+    if codec == 'zstd':
+        data = zstandard.ZstdCompressor().compress(body)
+    else:
+        data = zlib.compress(body)
+    if len(data) >= len(body):
+        return None, body
+    return codec, data
+
+
+def decompress(data, codec):
+    """Reverse compress. Raises CompressionError if codec isn't available,
+         or data is corrupt or expands past MAX_BODY_SIZE
+    """
+
+    if codec == 'zlib':
+        decompressor = zlib.decompressobj()
+        try:
+            body = decompressor.decompress(data, MAX_BODY_SIZE)
+        except zlib.error, e:
+            raise CompressionError('Corrupt zlib body: %s' % e)
+        if decompressor.unconsumed_tail:
+            raise CompressionError('Body exceeds %d bytes' % MAX_BODY_SIZE)
+        return body
+    if codec == 'zstd' and zstandard is not None:
+        try:
+            # The size is in the frame header, and sizes the output buffer
+            if zstandard.frame_content_size(data) > MAX_BODY_SIZE:
+                raise CompressionError(
+                    'Body exceeds %d bytes' % MAX_BODY_SIZE)
+            return zstandard.ZstdDecompressor().decompress(
+                data, max_output_size=MAX_BODY_SIZE)
+        except zstandard.ZstdError, e:
+            raise CompressionError('Corrupt zstd body: %s' % e)
+    raise CompressionError('Unsupported codec: %s' % codec)
@@ -19,11 +19,37 @@ DESCRIPTOR = _descriptor.FileDescriptor(
   name='secure_message.proto',
   package='serializer',
   syntax='proto2',
-  serialized_pb=_b('\n\x14secure_message.proto\x12\nserializer\"-\n\rSecureMessage\x12\x0c\n\x04\x62ody\x18\x01 \x02(\t\x12\x0e\n\x06sender\x18\x02 \x02(\t')
+  serialized_pb=_b('\n\x14secure_message.proto\x12\nserializer\"\xb4\x01\n\rSecureMessage\x12\x0c\n\x04\x62ody\x18\x01 \x02(\x0c\x12\x0e\n\x06sender\x18\x02 \x02(\t\x12\x34\n\x05\x63odec\x18\x03 \x01(\x0e\x32\x1f.serializer.SecureMessage.Codec:\x04NONE\x12(\n\x05\x62\x61tch\x18\x04 \x03(\x0b\x32\x19.serializer.SecureMessage\"%\n\x05\x43odec\x12\x08\n\x04NONE\x10\x00\x12\x08\n\x04ZLIB\x10\x01\x12\x08\n\x04ZSTD\x10\x02\"y\n\tFileChunk\x12\x13\n\x0btransfer_id\x18\x01 \x02(\x0c\x12\x0e\n\x06sender\x18\x02 \x02(\t\x12\r\n\x05index\x18\x03 \x02(\r\x12\x0c\n\x04\x64\x61ta\x18\x04 \x02(\x0c\x12\x0c\n\x04name\x18\x05 \x01(\t\x12\x0c\n\x04size\x18\x06 \x01(\x04\x12\x0e\n\x06\x64igest\x18\x07 \x01(\x0c')
 )
 
 
 
+_SECUREMESSAGE_CODEC = _descriptor.EnumDescriptor(
+  name='Codec',
+  full_name='serializer.SecureMessage.Codec',
+  filename=None,
+  file=DESCRIPTOR,
+  values=[
+    _descriptor.EnumValueDescriptor(
+      name='NONE', index=0, number=0,
+      options=None,
+      type=None),
+    _descriptor.EnumValueDescriptor(
+      name='ZLIB', index=1, number=1,
+      options=None,
+      type=None),
+    _descriptor.EnumValueDescriptor(
+      name='ZSTD', index=2, number=2,
+      options=None,
+      type=None),
+  ],
+  containing_type=None,
+  options=None,
+  serialized_start=180,
+  serialized_end=217,
+)
+_sym_db.RegisterEnumDescriptor(_SECUREMESSAGE_CODEC)
+
 
 _SECUREMESSAGE = _descriptor.Descriptor(
   name='SecureMessage',
@@ -34,8 +60,8 @@ _SECUREMESSAGE = _descriptor.Descriptor(
   fields=[
     _descriptor.FieldDescriptor(
       name='body', full_name='serializer.SecureMessage.body', index=0,
-      number=1, type=9, cpp_type=9, label=2,
-      has_default_value=False, default_value=_b("").decode('utf-8'),
+      number=1, type=12, cpp_type=9, label=2,
+      has_default_value=False, default_value=_b(""),
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
       options=None),
@@ -46,11 +72,26 @@ _SECUREMESSAGE = _descriptor.Descriptor(
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
       options=None),
+    _descriptor.FieldDescriptor(
+      name='codec', full_name='serializer.SecureMessage.codec', index=2,
+      number=3, type=14, cpp_type=8, label=1,
+      has_default_value=True, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='batch', full_name='serializer.SecureMessage.batch', index=3,
+      number=4, type=11, cpp_type=10, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
   ],
   extensions=[
   ],
   nested_types=[],
   enum_types=[
+    _SECUREMESSAGE_CODEC,
   ],
   options=None,
   is_extendable=False,
@@ -58,11 +99,88 @@ _SECUREMESSAGE = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=36,
-  serialized_end=81,
+  serialized_start=37,
+  serialized_end=217,
 )
 
+
+_FILECHUNK = _descriptor.Descriptor(
+  name='FileChunk',
+  full_name='serializer.FileChunk',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='transfer_id', full_name='serializer.FileChunk.transfer_id', index=0,
+      number=1, type=12, cpp_type=9, label=2,
+      has_default_value=False, default_value=_b(""),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='sender', full_name='serializer.FileChunk.sender', index=1,
+      number=2, type=9, cpp_type=9, label=2,
+      has_default_value=False, default_value=_b("").decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='index', full_name='serializer.FileChunk.index', index=2,
+      number=3, type=13, cpp_type=3, label=2,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='data', full_name='serializer.FileChunk.data', index=3,
+      number=4, type=12, cpp_type=9, label=2,
+      has_default_value=False, default_value=_b(""),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='name', full_name='serializer.FileChunk.name', index=4,
+      number=5, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b("").decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='size', full_name='serializer.FileChunk.size', index=5,
+      number=6, type=4, cpp_type=4, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='digest', full_name='serializer.FileChunk.digest', index=6,
+      number=7, type=12, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b(""),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  options=None,
+  is_extendable=False,
+  syntax='proto2',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=219,
+  serialized_end=340,
+)
+
+_SECUREMESSAGE.fields_by_name['codec'].enum_type = _SECUREMESSAGE_CODEC
+_SECUREMESSAGE.fields_by_name['batch'].message_type = _SECUREMESSAGE
+_SECUREMESSAGE_CODEC.containing_type = _SECUREMESSAGE
 DESCRIPTOR.message_types_by_name['SecureMessage'] = _SECUREMESSAGE
+DESCRIPTOR.message_types_by_name['FileChunk'] = _FILECHUNK
 _sym_db.RegisterFileDescriptor(DESCRIPTOR)
 
 SecureMessage = _reflection.GeneratedProtocolMessageType('SecureMessage', (_message.Message,), dict(
@@ -72,5 +190,12 @@ SecureMessage = _reflection.GeneratedProtocolMessageType('SecureMessage', (_mess
   ))
 _sym_db.RegisterMessage(SecureMessage)
 
+FileChunk = _reflection.GeneratedProtocolMessageType('FileChunk', (_message.Message,), dict(
+  DESCRIPTOR = _FILECHUNK,
+  __module__ = 'secure_message_pb2'
+  # @@protoc_insertion_point(class_scope:serializer.FileChunk)
+  ))
+_sym_db.RegisterMessage(FileChunk)
+
 
 # @@protoc_insertion_point(module_scope)
@@ -0,0 +1,124 @@
+from collections import deque
+from itertools import islice
+
+from limits import BufferBudget
+
+
+class OutboundQueue(object):
+    """Frames waiting to be written to a single client socket
+
+       Frames are queued whole and written from the head. A frame that only
+         partly fit in the socket buffer is resumed from where it stopped.
+         Several small frames can be gathered into a single write.
+
+       Frames are shared by every queue they are pushed to. The server
+         encodes a relayed message once, and each recipient's queue holds a
+         reference to that same string, which is never modified.
+
+       The queue becomes congested once its size reaches the high watermark,
+         and stays congested until it drains to the low watermark. The gap
+         keeps a consumer hovering around the limit from flapping in and out
+         of the congested state on every write.
+
+       frames: (deque) Encoded frames, oldest first
+       offset: (int) Bytes of the head frame already written
+       size: (int) Bytes queued and not yet written
+       high_watermark: (int) Size at which the queue becomes congested
+       low_watermark: (int) Size at which a congested queue recovers
+       congested: (bool) Whether the consumer is currently considered slow
+       budget: (BufferBudget) Counts the bytes queued, along with those of
+         every other queue it is shared with. See limits.py
+    """
+
+    __slots__ = ('frames', 'offset', 'size', 'high_watermark',
+                 'low_watermark', 'congested', 'budget')
+
+    # Frames of at least this many bytes are never copied into a batch.
+    #   Copying them for every recipient would cost more than the system
+    #   call it saves
+    max_gathered_frame = 4096
+
+    def __init__(self, high_watermark, low_watermark, budget=None):
+        self.frames = deque()
+        self.offset = 0
+        self.size = 0
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.congested = False
+        self.budget = budget or BufferBudget()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def push(self, frame):
+        """Add a frame to the tail of the queue"""
+
+        self.frames.append(frame)
+        self.size += len(frame)
+        self.budget.used += len(frame)
+        if self.size >= self.high_watermark:
+            self.congested = True
+
+    def gather(self, max_bytes):
+        """Return unwritten data from the head of the queue for one write
+
+           Small frames are joined into a single buffer of at most
+             max_bytes, so a burst of them costs one system call instead of
+             one each. Python 2 has no vectored send, so joining is the
+             cheapest way to gather. Any other frame is returned alone, as a
+             memoryview of the shared frame, without copying it.
+        """
+
+        frames = self.frames
+        size = len(frames[0]) - self.offset
+        count = 1
+        if len(frames[0]) < self.max_gathered_frame:
+            for frame in islice(frames, 1, None):
+                size += len(frame)
+                if size > max_bytes or len(frame) >= self.max_gathered_frame:
+                    break
+                count += 1
+        if count == 1:
+            return memoryview(frames[0])[self.offset:]
+        batch = list(islice(frames, count))
+        if self.offset:
+            batch[0] = batch[0][self.offset:]
+        return ''.join(batch)
+
+    def consume(self, sent):
+        """Account for bytes written from the head of the queue"""
+
+        self.size -= sent
+        self.budget.used -= sent
+        offset = self.offset + sent
+        frames = self.frames
+        while frames and offset >= len(frames[0]):
+            offset -= len(frames.popleft())
+        self.offset = offset
+        if self.congested and self.size <= self.low_watermark:
+            self.congested = False
+
+    def coalesce(self, keep=None):
+        """Discard every frame not yet started
+
+           A partly written head frame is kept so the stream stays in sync.
+
+           keep: (function) Given a frame, returns whether it must be kept
+             all the same
+
+           Returns the number of frames discarded
+        """
+
+        frames = self.frames
+        self.frames = deque()
+        if self.offset:
+            self.frames.append(frames.popleft())
+        if keep is not None:
+            self.frames.extend(frame for frame in frames if keep(frame))
+        discarded = len(frames) + bool(self.offset) - len(self.frames)
+        size = self.size
+        self.size = sum(len(frame) for frame in self.frames) - self.offset
+        self.budget.used -= size - self.size
+        if self.size <= self.low_watermark:
+            self.congested = False
+        return discarded
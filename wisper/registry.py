@@ -0,0 +1,86 @@
+import itertools
+
+
+"""Clients connected to a server, and the rooms they have joined
+
+   Only the event loop changes the registry. Other threads, such as the
+     metrics endpoint, read it without a lock. Room membership is copy on
+     write: each room maps to a tuple of its members that is replaced,
+     never changed, on every join and leave. Relaying to a room iterates the
+     tuple it was handed, so fan-out neither copies the membership first nor
+     sees it change part way through, even when a member is removed along
+     the way.
+"""
+
+
+class ConnectionRegistry(object):
+    """Connections by socket and file descriptor, and room members
+
+       Every connection is given a peer id when added. Ids count up from 1
+         and are never reused, so they tell apart clients in the server log
+         however many have come and gone.
+
+       connections: (dict) Mapping of socket file descriptors to their
+         Connection
+       sockets: (dict) Mapping of sockets to their Connection
+       rooms: (dict) Mapping of room names to a tuple of member Connections.
+         Rooms are created by their first member and deleted with their last
+    """
+
+    def __init__(self):
+        self.connections = dict()
+        self.sockets = dict()
+        self.rooms = dict()
+        self._peer_ids = itertools.count(1)
+
+    def __len__(self):
+        return len(self.connections)
+
+    def add(self, connection):
+        """Register a newly accepted connection, and give it a peer id"""
+
+        connection.peer_id = next(self._peer_ids)
+        self.connections[connection.sock.fileno()] = connection
+        self.sockets[connection.sock] = connection
+
+    def get(self, sock):
+        """Connection of sock, or None once it has been removed"""
+
+        return self.sockets.get(sock)
+
+    def remove(self, connection):
+        """Forget a connection, and take it out of its room
+
+           Called before its socket is closed
+        """
+
+        del self.sockets[connection.sock]
+        del self.connections[connection.sock.fileno()]
+        if connection.room is not None:
+            members = tuple(member for member in self.rooms[connection.room]
+                            if member is not connection)
+            if members:
+                self.rooms[connection.room] = members
+            else:
+                del self.rooms[connection.room]
+
+    def join(self, connection, room):
+        """Add a connection to the members of room"""
+
+        connection.room = room
+        self.rooms[room] = self.rooms.get(room, ()) + (connection,)
+
+    def members(self, room):
+        """Snapshot of the connections in room, safe to iterate while
+             members come and go
+        """
+
+        return self.rooms.get(room, ())
+
+    def room_size(self, room):
+        """Number of connections in room"""
+
+        return len(self.rooms.get(room, ()))
+
+    def __contains__(self, connection):
+        return self.sockets.get(connection.sock) is connection
@@ -0,0 +1,87 @@
+import sys
+import time
+from collections import deque
+
+
+"""Terminal output for the client
+
+   Lines are collected as messages are decoded, and drawn together at most
+     frame_rate times a second, in a single write. A busy room then costs
+     a few terminal writes a second, however many messages arrive, and
+     decoding never waits on the terminal between frames.
+"""
+
+
+class Renderer(object):
+    """Buffered, frame rate limited writer of client output
+
+       lines: (deque) Lines waiting for the next frame, oldest first. Holds
+         at most scrollback lines. Past it, the oldest are dropped
+       skipped: (int) Lines dropped since the last frame
+       sent: (list) Lines typed and sent since the last frame. The terminal
+         echoed them as they were typed, so the next frame rewrites them in
+         place as sent, before drawing anything below them
+       interval: (float) Least seconds between frames
+       drawn_at: (float) Time the last frame was drawn
+       stream: (file) Where frames are written
+    """
+
+    def __init__(self, stream=None, frame_rate=30, scrollback=1000):
+        if frame_rate <= 0:
+            raise ValueError('frame_rate must be positive')
+        self.lines = deque(maxlen=scrollback)
+        self.skipped = 0
+        self.sent = []
+        self.interval = 1.0 / frame_rate
+        self.drawn_at = 0
+        self.stream = stream or sys.stdout
+
+    def write(self, line):
+        """Add a line to the next frame"""
+
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        if len(self.lines) == self.lines.maxlen:
+            self.skipped += 1
+        self.lines.append(line)
+
+    def echo_sent(self, lines):
+        """Mark lines the user typed as sent, in the next frame"""
+
+        self.sent.extend(lines)
+
+    def pending(self):
+        return bool(self.lines or self.sent or self.skipped)
+
+    def timeout(self):
+        """Seconds until the next frame is due, None when nothing waits"""
+
+        if not self.pending():
+            return None
+        return max(0, self.drawn_at + self.interval - time.time())
+
+    def refresh(self):
+        """Draw a frame if one is due"""
+
+        if self.pending() and time.time() >= self.drawn_at + self.interval:
+            self.draw()
+
+    def draw(self):
+        """Write every waiting line now"""
+
+        chunks = []
+        if self.sent:
+            # Move shell cursor to beginning of the lines just typed
+            # Ref: http://tldp.org/HOWTO/Bash-Prompt-HOWTO/x361.html
+            chunks.append('\033[%dF' % len(self.sent))
+            chunks.extend('Sent: ' + line for line in self.sent)
+            self.sent = []
+        if self.skipped:
+            chunks.append('%d lines skipped\n' % self.skipped)
+            self.skipped = 0
+        chunks.extend(line + '\n' for line in self.lines)
+        self.lines.clear()
+        self.drawn_at = time.time()
+        if chunks:
+            self.stream.write(''.join(chunks))
+            self.stream.flush()
@@ -1,32 +1,344 @@
+import errno
+import heapq
+import itertools
 import os
-import psutil
-import signal
 import socket
-import threading
+import time
 
+from framing import (ACK_HEADER, FILE_CHUNK, HEADER, MAX_FRAME_SIZE,
+                     FrameDecoder, FrameError, JOIN_ROOM, MESSAGE_ACK,
+                     MESSAGE_LIMIT, MESSAGE_LIMIT_HEADER, PEER_MESSAGE,
+                     REPLAY_HEADER,
+                     REPLAY_HISTORY, RESUME_HEADER, RESUME_SESSION,
+                     ROOM_CODECS, ROOM_MESSAGE, ROOM_PRESENCE,
+                     ROOM_PRESENCE_HEADER, SEQUENCE_HEADER, SERVER_NOTICE,
+                     SESSION_MESSAGE, SESSION_TOKEN, SESSION_TOKEN_SIZE,
+                     decode_join, encode_frame, frame_kind)
+from limits import RATE_LIMIT_POLICIES, BufferBudget, TokenBucket
+from metrics import MetricsEndpoint, ServerMetrics
+from poller import Poller
+from queues import OutboundQueue
+from registry import ConnectionRegistry
 from utils import ServerLog, socket_context
 
 
+# Socket errors that only mean a non-blocking call has nothing to do yet
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# Errors accepting a connection that leave the listener usable. An aborted
+#   connection is skipped. Out of descriptors or buffers, accepting again
+#   straight away would only fail the same way, so the listener is set aside
+#   for a while and connections wait in its backlog
+ACCEPT_ABORTED = (errno.ECONNABORTED, errno.EPROTO)
+ACCEPT_EXHAUSTED = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)
+
+# What happens to frames for a client whose outbound queue is congested
+#   drop: New frames are discarded until the queue drains
+#   disconnect: The client is removed
+#   coalesce: Unsent frames are replaced by a notice of how many were skipped
+SLOW_CONSUMER_POLICIES = ('drop', 'disconnect', 'coalesce')
+
+# Longest room name a client may join, in bytes
+MAX_ROOM_NAME = 64
+
+
+class Connection(object):
+    """State held by the server for each connected client
+
+       sock: (socket) Non-blocking client socket
+       addr: (tuple) Client endpoint address
+       decoder: (FrameDecoder) Reassembles frames from partial reads. File
+         chunks are returned whole, to be relayed as they are. Holds at most
+         one partial frame of up to max_frame_size bytes
+       outbound: (OutboundQueue) Frames waiting for the socket to become
+         writable, counted against budget. See queues.py
+       awaiting_write: (bool) Whether write readiness is registered
+       room: (str) Name of the room joined, None until the client joins
+       codecs: (frozenset) Optional codecs the client can decompress, sent
+         when it joins. See protobuf/compression.py
+       replay: (HistoryCursor) Replay of the room's history in progress, if
+         any. See history.py
+       session: (Session) Session the client opened or resumed, if any
+       peer_id: (int) Identifies the client in the server log. Given by the
+         registry, see registry.py
+       message_bucket: (TokenBucket) Limits the frames the client sends,
+         None when unlimited. See limits.py
+       byte_bucket: (TokenBucket) Limits the bytes of frames the client
+         sends, None when unlimited
+       paused: (bool) Whether the socket is left unread until the client's
+         rate limits allow more
+       held: (list) Frames read past the client's rate limits, routed once
+         they allow
+       ack_held: (bool) Whether the client's acknowledgement is held back
+         until the slow consumers in its room catch up. See
+         Server._hold_ack
+    """
+
+    __slots__ = ('sock', 'addr', 'decoder', 'outbound', 'awaiting_write',
+                 'room', 'codecs', 'replay', 'session', 'peer_id',
+                 'message_bucket', 'byte_bucket', 'paused', 'held',
+                 'ack_held')
+
+    def __init__(self, sock, addr, high_watermark, low_watermark,
+                 budget=None, max_frame_size=MAX_FRAME_SIZE):
+        self.sock = sock
+        self.addr = addr
+        self.decoder = FrameDecoder(max_frame_size, whole_kinds=(FILE_CHUNK,))
+        self.outbound = OutboundQueue(high_watermark, low_watermark, budget)
+        self.awaiting_write = False
+        self.room = None
+        self.codecs = frozenset()
+        self.replay = None
+        self.session = None
+        self.peer_id = None
+        self.message_bucket = None
+        self.byte_bucket = None
+        self.paused = False
+        self.held = None
+        self.ack_held = False
+
+
+class Session(object):
+    """State kept for a client across reconnects
+
+       A client that loses its connection reconnects with the session's
+         token. Messages it sent that were never acknowledged are sent again,
+         and are dropped here if they did arrive. Room messages it missed
+         are replayed from the room's history.
+
+       token: (str) Random bytes the client resumes the session with
+       room: (str) Room the session belongs to. It can't be resumed in
+         another
+       acked: (int) Sequence number of the last message received from the
+         client
+       connection: (Connection) Client connection, None while it is away
+       detached_at: (float) Time the client's connection was lost
+    """
+
+    __slots__ = ('token', 'room', 'acked', 'connection', 'detached_at')
+
+    def __init__(self, token, room, connection):
+        self.token = token
+        self.room = room
+        self.acked = 0
+        self.connection = connection
+        self.detached_at = None
+
+
+class PresenceChange(object):
+    """Joins and leaves in a room not yet announced to its members
+
+       joined: (int) Members who joined, on any server
+       left: (int) Members who left, on any server
+       newcomers: (set) Connections of the local members among those who
+         joined. They are only told the size of the room they joined
+    """
+
+    __slots__ = ('joined', 'left', 'newcomers')
+
+    def __init__(self):
+        self.joined = 0
+        self.left = 0
+        self.newcomers = set()
+
+
 class Server(object):
     """Manages a session between two or more clients.
 
        All inter-client communication remains encrypted between endpoints.
 
-       client_conn_addr_map: (dict) Mapping of socket objects to their endpoint
-         addresses
+       A single thread services every client. Sockets are non-blocking, and
+         accept, read, relay and disconnect are each handled as readiness
+         events delivered by the poller. See poller.py
+
+       Clients join a named room with their first frame. Messages and
+         presence notices only ever reach members of the sender's room.
+
+       registry: (ConnectionRegistry) Connected clients, by socket and by
+         file descriptor, and the members of each room. See registry.py
+
+       room_codecs: (dict) Mapping of room names to a mapping of optional
+         codecs to the number of members that have them
+
+       announced_codecs: (dict) Mapping of room names to the codecs that
+         members were last told they all have
+
+       failed_clients: (list) Sockets whose writes failed mid-relay. They are
+         removed once the current batch of events has been handled, so one
+         broken peer can't recurse through the removal of every other
+
+       high_watermark: (int) Queued outbound bytes at which a client is
+         considered a slow consumer
+
+       low_watermark: (int) Queued outbound bytes at which a slow consumer
+         is considered to have caught up
+
+       slow_consumer_policy: (str) One of SLOW_CONSUMER_POLICIES
+
+       write_coalescing: (bool) Whether frames are left queued until the end
+         of the current pass of the event loop, then written together. Trades
+         a little latency for far fewer system calls during bursts. When
+         False, a frame is written as soon as it is queued
 
-       log: (ServerLog) Handles server event logging. See utils.py
+       max_write_batch: (int) Most bytes of queued frames gathered into a
+         single write. 0 writes one frame at a time. See queues.py
+
+       pending_writes: (set) Connections with frames queued during the
+         current pass of the event loop, written at its end
+
+       listener: (socket) Optional socket that is already bound and listening,
+         such as one shared by worker processes. See workers.py
+
+       timers: (list) Heap of (deadline, sequence, callback) tuples. Callbacks
+         run from the event loop once their deadline has passed
+
+       log: (ServerLog) Handles server event logging. One with default
+         settings is created when not given. See utils.py
+
+       metrics: (ServerMetrics) Counters and histograms of server activity.
+         See metrics.py
+
+       metrics_port: (int) Local port the metrics are served on over HTTP.
+         None to not serve them
+
+       history: (MessageHistory) Log of the messages relayed to each room,
+         replayed to clients that ask. None to keep no history. See
+         history.py
+
+       idle_grace: (float) Seconds the server lingers once its last client
+         has left, in case one reconnects. Shuts down straight away when 0
+
+       idle_started: (float) Time the server last became idle, None while
+         clients remain
+
+       presence_interval: (float) Seconds joins and leaves are gathered for
+         before members are told of them. However many there were, each
+         member is sent a single ROOM_PRESENCE frame, so a storm of
+         reconnects costs one frame per member rather than one per member
+         for every reconnect
+
+       presence_changes: (dict) Mapping of room names to the PresenceChange
+         waiting to be announced
+
+       sessions: (dict) Mapping of session tokens to their Session
+
+       session_ttl: (float) Seconds a session can be resumed for once its
+         client's connection is lost. Sessions are kept by the server that
+         opened them, so a client that reconnects to another worker or node
+         gets a new one
+
+       max_connections: (int) Most clients connected at once. Clients
+         arriving beyond it are told the server is full and disconnected. 0
+         for no limit
+
+       message_rate: (float) Frames per second each client may send, on
+         average. 0 for no limit
+
+       message_burst: (int) Frames a client may send at once, above the
+         message rate
+
+       byte_rate: (float) Bytes of frames per second each client may send,
+         on average. 0 for no limit
+
+       byte_burst: (int) Bytes a client may send at once, above the byte
+         rate
+
+       rate_limit_policy: (str) One of RATE_LIMIT_POLICIES. See limits.py
+
+       recv_buffer_limit: (int) Largest frame a client may send. A client's
+         frame decoder never buffers more than one frame, so this caps the
+         bytes held for it on the way in. Clients are told it when they join
+
+       send_buffer_limit: (int) Most bytes queued for a client. A frame that
+         would take its queue past this removes the client, whatever the
+         slow consumer policy. Only reached by frames the policy doesn't
+         hold back, such as replays, file chunks and acknowledgements
+
+       held_acks: (dict) Mapping of room names to the set of members whose
+         acknowledgement is held back until the room's slow consumers catch
+         up
+
+       budget: (BufferBudget) Bytes held in the buffers of every client,
+         and the most the server may hold. Past it, clients holding the
+         most are removed until the server is back within it. See limits.py
     """
 
-    def __init__(self, host='0.0.0.0', port=4440):
+    recv_size = 65536
+
+    # Bytes of history queued for a client at a time during a replay
+    replay_batch = 65536
+
+    # Seconds a listener is left unwatched after accept runs out of
+    #   descriptors or buffers
+    accept_pause = 0.5
+
+    def __init__(self, host='0.0.0.0', port=4440, high_watermark=1048576,
+                 low_watermark=262144, slow_consumer_policy='drop',
+                 write_coalescing=True, max_write_batch=65536, listener=None,
+                 metrics_port=None, log=None, history=None, idle_grace=0,
+                 session_ttl=60, presence_interval=0.05, max_connections=0,
+                 message_rate=0, message_burst=50, byte_rate=0,
+                 byte_burst=262144, rate_limit_policy='throttle',
+                 recv_buffer_limit=1048576, send_buffer_limit=4194304,
+                 max_buffered_bytes=0):
+        if slow_consumer_policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(
+                'Invalid slow consumer policy: %s' % slow_consumer_policy)
+        if rate_limit_policy not in RATE_LIMIT_POLICIES:
+            raise ValueError(
+                'Invalid rate limit policy: %s' % rate_limit_policy)
+        if not 0 <= low_watermark < high_watermark:
+            raise ValueError('Watermarks must satisfy 0 <= low < high')
+        if send_buffer_limit < high_watermark:
+            raise ValueError('send_buffer_limit must be at least the high '
+                             'watermark')
         # Unassigned port:
         # https://www.iana.org/assignments/service-names-port-numbers/
         self.address = (host, port)
-        self.client_conn_addr_map = dict()
-        self.log = ServerLog(self.address)
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # Allow server to reuse address between sessions
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.slow_consumer_policy = slow_consumer_policy
+        self.write_coalescing = write_coalescing
+        self.max_write_batch = max_write_batch
+        self.pending_writes = set()
+        self.registry = ConnectionRegistry()
+        self.room_codecs = dict()
+        self.announced_codecs = dict()
+        self.failed_clients = list()
+        self.timers = list()
+        self._timer_sequence = itertools.count()
+        self.log = log or ServerLog()
+        self.metrics = ServerMetrics(self)
+        self.metrics_port = metrics_port
+        self.metrics_endpoint = None
+        self.history = history
+        self.idle_grace = idle_grace
+        self.idle_started = None
+        self._idle_generation = 0
+        self.sessions = dict()
+        self.session_ttl = session_ttl
+        self.presence_interval = presence_interval
+        self.presence_changes = dict()
+        self.max_connections = max_connections
+        self.message_rate = message_rate
+        self.message_burst = message_burst
+        self.byte_rate = byte_rate
+        self.byte_burst = byte_burst
+        self.rate_limit_policy = rate_limit_policy
+        self.recv_buffer_limit = recv_buffer_limit
+        self.send_buffer_limit = send_buffer_limit
+        self.held_acks = dict()
+        self.budget = BufferBudget(max_buffered_bytes)
+        self.poller = Poller()
+        self.listening = listener is not None
+        if self.listening:
+            self.socket = listener
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Allow server to reuse address between sessions
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.setblocking(False)
+        self._running = False
 
     def start(self):
         """Bind address and listen for client connections.
@@ -34,117 +346,975 @@ class Server(object):
            Only public method of the class
         """
 
-        self.log.server_start()
-        self.socket.bind(self.address)
-        self.socket.listen(100)
-        self._run()
+        self.log.server_start(self.address)
+        if not self.listening:
+            self.socket.bind(self.address)
+            self.socket.listen(socket.SOMAXCONN)
+        if self.metrics_port is not None:
+            # Metrics stay private to the instance
+            self.metrics_endpoint = MetricsEndpoint(
+                self.metrics, ('127.0.0.1', self.metrics_port))
+            self.metrics_endpoint.start()
+        if self.history is not None:
+            self.history.open()
+        try:
+            self._run()
+        finally:
+            if self.metrics_endpoint is not None:
+                self.metrics_endpoint.close()
+            if self.history is not None:
+                self.history.close()
+            self.log.close()
 
     def _run(self):
-        """Accept client connections and create a client thread for each
+        """Dispatch socket events until shutdown
 
            KeyboardInterrupt shuts down the server
         """
 
         # Python2 doesn't manage socket contexts, here's a hand-rolled manager
-        with socket_context(self.socket) as client_connection:
-            while True:
-                try:
-                    conn, addr = client_connection.accept()
-                    self.log.client_connect(addr)
-                    self.client_conn_addr_map[conn] = addr
-                    # Notify existing clients of new connection
-                    self._relay_message('Peer connected', conn)
-                    self._create_client_thread(conn, addr)
-                except KeyboardInterrupt:
-                    break
-            return
-
-    def _create_client_thread(self, conn, addr):
-        """Create thread for newly connected client"""
-
-        t = threading.Thread(
-            target=self._client_thread, name=None, args=(conn, addr))
-        t.setDaemon(True)
-        t.start()
-
-    def _client_thread(self, conn, addr):
+        with socket_context(self.socket) as listener:
+            listener_fileno = listener.fileno()
+            self.poller.register(listener_fileno, Poller.READ)
+            self._running = True
+            try:
+                while self._running:
+                    for fileno, events in self._poll():
+                        if fileno == listener_fileno:
+                            self._accept_clients(listener)
+                        else:
+                            self._handle_event(fileno, events)
+                    self._run_timers()
+                    # Decoders fill up without any write being queued, so
+                    #   the budget is checked on every pass
+                    self._enforce_budget()
+                    self._flush_pending()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                self.poller.close()
+            return
+
+    def _poll(self):
+        """Wait for socket events, tolerating interrupted system calls"""
+
+        timeout = None
+        if self.timers:
+            timeout = max(0, self.timers[0][0] - time.time())
+        try:
+            return self.poller.poll(timeout)
+        except (IOError, OSError), e:
+            if e.errno == errno.EINTR:
+                return []
+            raise
+
+    def _call_later(self, delay, callback):
+        """Run callback from the event loop after delay seconds"""
+
+        heapq.heappush(self.timers, (
+            time.time() + delay, next(self._timer_sequence), callback))
+
+    def _run_timers(self):
+        """Run every callback whose deadline has passed"""
+
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            heapq.heappop(self.timers)[2]()
+
+    def _accept_clients(self, listener):
+        """Accept every pending client connection"""
+
+        while True:
+            try:
+                conn, addr = listener.accept()
+            except socket.error, e:
+                if e.errno in WOULD_BLOCK:
+                    return
+                if e.errno in ACCEPT_ABORTED:
+                    continue
+                if e.errno in ACCEPT_EXHAUSTED:
+                    self._pause_accepting(listener, e)
+                    return
+                raise
+            conn.setblocking(False)
+            # Frames are already batched once per pass, Nagle would only
+            #   delay them further
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.max_connections and (
+                    len(self.registry) >= self.max_connections):
+                self._reject_client(conn)
+                continue
+            self.metrics.connections_accepted.inc()
+            self._leave_idle()
+            connection = Connection(
+                conn, addr, self.high_watermark, self.low_watermark,
+                self.budget, self.recv_buffer_limit)
+            now = time.time()
+            if self.message_rate:
+                connection.message_bucket = TokenBucket(
+                    self.message_rate, self.message_burst, now)
+            if self.byte_rate:
+                connection.byte_bucket = TokenBucket(
+                    self.byte_rate, self.byte_burst, now)
+            self.registry.add(connection)
+            self.log.client_connect(connection.peer_id)
+            self.poller.register(conn.fileno(), Poller.READ)
+
+    def _pause_accepting(self, listener, error):
+        """Stop watching a listener for accept_pause seconds
+
+           Pending connections keep the listener readable, so while accept
+             fails for want of descriptors, watching it would fail on every
+             pass of the event loop
+        """
+
+        self.log.accept_failed(error, self.accept_pause)
+        fileno = listener.fileno()
+        self.poller.unregister(fileno)
+        self._call_later(self.accept_pause,
+                         lambda: self.poller.register(fileno, Poller.READ))
+
+    def _reject_client(self, conn):
+        """Turn away a client arriving at a full server
+
+           The client is told why, if its socket will take the notice
+             straight away. It is never waited on
+        """
+
+        self.metrics.connections_rejected.inc()
+        self.log.client_rejected()
+        try:
+            conn.send(encode_frame('Server is full, try again later',
+                                   SERVER_NOTICE))
+        except socket.error:
+            pass
+        conn.close()
+
+    def _join_room(self, connection, payload):
+        """Add client to a room and notify the room's existing members"""
+
+        conn = connection.sock
+        if connection.room is not None:
+            self._sendall(conn, 'Already joined room ' + connection.room)
+            return
+        room, codecs = decode_join(payload)
+        if not room or len(room) > MAX_ROOM_NAME:
+            self.failed_clients.append(conn)
+            return
+        connection.codecs = codecs
+        self.registry.join(connection, room)
+        counts = self.room_codecs.setdefault(room, dict())
+        for codec in codecs:
+            counts[codec] = counts.get(codec, 0) + 1
+        self.log.room_join(connection.peer_id, room)
+        # Notify existing members of new connection
+        self._presence_changed(room, joined=1, newcomer=connection)
+        self._room_changed(room)
+        self._greet_client(connection, room)
+
+    def _greet_client(self, connection, room):
         """Prepare client connection to begin receiving messages"""
 
-        self._sendall(conn, 'Connected to Wisper server')
-        if len(self.client_conn_addr_map) < 2:
+        conn = connection.sock
+        # So the client splits its messages to fit, rather than be dropped
+        self._send_to(connection, encode_frame(
+            MESSAGE_LIMIT_HEADER.pack(self.recv_buffer_limit), MESSAGE_LIMIT),
+            control=True)
+        self._sendall(conn, 'Connected to Wisper server, room ' + room)
+        if self._room_size(room) < 2:
             self._sendall(conn, 'Waiting for peers to connect. ' +
                 'When connected, type your messages below')
         else:
-            self._update_peer_count()
             self._sendall(conn, 'Type your messages below')
-        while True:
-            try:
-                self._route_messages(conn, addr)
-            except:
-                continue
+
+    def _handle_event(self, fileno, events):
+        """Service a readiness event on a client socket"""
+
+        connection = self.registry.connections.get(fileno)
+        if connection is None:
+            # Client was removed earlier in this batch of events
+            return
+        try:
+            if events & Poller.READ:
+                self._route_messages(connection)
+            if fileno not in self.registry.connections:
+                return
+            if events & Poller.WRITE:
+                self._flush(connection)
+            elif events & Poller.ERROR and not events & Poller.READ:
+                self._remove_client(connection.sock)
+        except Exception, e:
+            self._drop_after_error(connection, e)
+
+    def _drop_after_error(self, connection, error):
+        """Remove a client whose handling raised
+
+           Whatever went wrong, the client is dropped rather than left to
+             raise again on its next event, and the rest are served on
+        """
+
+        self.log.client_error(connection.peer_id, error)
+        self._remove_client(connection.sock)
+
+    def _send_parting_notice(self, connection, message):
+        """Tell a client about to be removed why
+
+           The notice is queued behind whatever the client is still owed, and
+             the queue is written as far as the socket takes it straight
+             away. It is never waited on
+        """
+
+        connection.outbound.push(encode_frame(message, SERVER_NOTICE))
+        self._flush(connection)
 
     def _sendall(self, conn, message):
-        """Delineate an"""
+        """Frame a server notice and queue it for delivery"""
+
+        self._send_frame(conn, encode_frame(message, SERVER_NOTICE))
+
+    def _send_frame(self, conn, frame):
+        """Queue an encoded frame for delivery
+
+           Frames for a slow consumer are subject to the slow consumer
+             policy, so a congested client never holds up delivery to others
+        """
+
+        connection = self.registry.get(conn)
+        if connection is None:
+            # Client was removed while this message was being routed
+            return
+        self._send_to(connection, frame)
+
+    def _send_to(self, connection, frame, control=False):
+        """Queue an encoded frame for a connection that may have been removed
+
+           Lets fan-out hand over the Connection records of a room's
+             membership snapshot, rather than look each one up by socket.
+             Control frames, such as acknowledgements and file chunks, are
+             never held back by the slow consumer policy, as sessions and
+             transfers stall without them. Only send_buffer_limit applies to
+             them
+        """
+
+        if connection not in self.registry:
+            return
+        if not control and connection.outbound.congested and not (
+                self._handle_slow_consumer(connection)):
+            return
+        if connection.outbound.size + len(frame) > self.send_buffer_limit:
+            self._shed_client(connection)
+            return
+        self._queue_frame(connection, frame)
+
+    def _queue_frame(self, connection, frame):
+        """Queue a frame on a connection
+
+           The frame is written at the end of the current pass of the event
+             loop, or right away without write coalescing. Either way, a
+             connection waiting for its socket to drain is left to wait.
+        """
+
+        connection.outbound.push(frame)
+        self._schedule_flush(connection)
+
+    def _schedule_flush(self, connection):
+        """Write a connection's queue when write coalescing says to"""
+
+        if connection.awaiting_write:
+            return
+        if self.write_coalescing:
+            self.pending_writes.add(connection)
+        else:
+            self._flush(connection)
+
+    def _handle_slow_consumer(self, connection):
+        """Apply the slow consumer policy to a congested client
+
+           Returns whether the frame being sent should still be queued
+        """
+
+        self.metrics.slow_consumer_events.inc()
+        if self.slow_consumer_policy == 'disconnect':
+            self.failed_clients.append(connection.sock)
+            return False
+        if self.slow_consumer_policy == 'coalesce':
+            # File chunks are kept. Their senders are held back instead
+            skipped = connection.outbound.coalesce(
+                keep=lambda frame: frame_kind(frame) == FILE_CHUNK)
+            if skipped:
+                connection.outbound.push(encode_frame(
+                    'Connection too slow, %d messages skipped' % skipped,
+                    SERVER_NOTICE))
+            if not connection.outbound.congested:
+                self._release_acks(connection.room)
+            return True
+        return False
+
+    def _flush(self, connection):
+        """Write as much queued data as the socket will take
+
+           Write interest is only registered while data remains queued
+        """
+
+        outbound = connection.outbound
+        congested = outbound.congested
+        self.metrics.outbound_bytes.observe(outbound.size)
+        sent = 0
+        try:
+            while outbound:
+                written = connection.sock.send(
+                    outbound.gather(self.max_write_batch))
+                outbound.consume(written)
+                sent += written
+        except socket.error, e:
+            if e.errno not in WOULD_BLOCK:
+                self.failed_clients.append(connection.sock)
+                return
+        finally:
+            self.metrics.bytes_sent.inc(sent)
+        if congested and not outbound.congested:
+            self._release_acks(connection.room)
+        if connection.replay is not None and (
+                outbound.size < self.replay_batch):
+            # Written once the socket is next ready, so a long replay takes
+            #   a batch per pass of the event loop, never the whole pass
+            self._continue_replay(connection)
+        awaiting_write = bool(outbound)
+        if awaiting_write != connection.awaiting_write:
+            connection.awaiting_write = awaiting_write
+            self._update_events(connection)
+
+    def _update_events(self, connection):
+        """Register the readiness events a connection is waiting for"""
 
-        message += '\n'
-        conn.sendall(message)
+        events = 0
+        if not connection.paused:
+            events |= Poller.READ
+        if connection.awaiting_write:
+            events |= Poller.WRITE
+        self.poller.modify(connection.sock.fileno(), events)
 
-    def _route_messages(self, conn, addr):
+    def _flush_pending(self):
+        """Write frames queued during this pass, and remove failed clients
+
+           Removing a client notifies the rest of its room, which queues more
+             frames, so this repeats until nothing is left to do
+        """
+
+        while self.pending_writes or self.failed_clients:
+            pending = self.pending_writes
+            self.pending_writes = set()
+            for connection in pending:
+                self._flush(connection)
+            self._remove_failed_clients()
+
+    def _enforce_budget(self):
+        """Remove the clients holding the most buffered bytes, while the
+             server holds more than its budget
+
+           Clients are removed largest first, the newest of any that hold
+             the same, so the same state always sheds the same clients. A
+             client holding nothing is never removed
+        """
+
+        if not self.budget.exceeded():
+            return
+        excess = self.budget.used - self.budget.limit
+        for connection in sorted(
+                self.registry.connections.values(), reverse=True,
+                key=lambda connection: (self._buffered(connection),
+                                        connection.peer_id)):
+            buffered = self._buffered(connection)
+            if excess <= 0 or not buffered:
+                return
+            excess -= buffered
+            self._shed_client(connection)
+
+    def _shed_client(self, connection):
+        """Remove a client for holding more buffered bytes than allowed"""
+
+        if connection.sock in self.failed_clients:
+            return
+        self.metrics.budget_disconnects.inc()
+        self.log.over_budget(connection.peer_id, self._buffered(connection))
+        self.failed_clients.append(connection.sock)
+
+    @staticmethod
+    def _buffered(connection):
+        """Bytes held in a connection's buffers"""
+
+        return connection.outbound.size + len(connection.decoder.buffer)
+
+    def _release_buffers(self, connection):
+        """Stop counting a removed connection's buffers against the budget"""
+
+        connection.outbound.budget.used -= self._buffered(connection)
+
+    def _remove_failed_clients(self):
+        """Remove clients whose sockets failed while being written to"""
+
+        while self.failed_clients:
+            self._remove_client(self.failed_clients.pop())
+
+    def _receive_frames(self, connection):
+        """Read from a connection and return the frames the read completed
+
+           Received data is fed to the connection's frame decoder, so only
+             complete frames are returned, however many reads they spanned.
+
+           Returns None once the peer has closed the connection or sent data
+             that can't be decoded
+        """
+
+        try:
+            data = connection.sock.recv(self.recv_size)
+        except socket.error, e:
+            if e.errno in WOULD_BLOCK:
+                return []
+            return None
+        if not data:
+            # If no data received
+            return None
+        self.metrics.bytes_received.inc(len(data))
+        decoder = connection.decoder
+        buffered = len(decoder.buffer)
+        try:
+            return decoder.feed(data)
+        except FrameError:
+            # Stream can't be resynchronised once framing is lost
+            self._send_parting_notice(
+                connection, 'Message too large, this server takes messages '
+                'of at most %d bytes' % decoder.max_frame_size)
+            return None
+        finally:
+            # Counted against the same budget as the connection's queue
+            connection.outbound.budget.used += len(decoder.buffer) - buffered
+
+    def _route_messages(self, connection):
         """Route client messages to expected recipients"""
 
-        inbound_message = conn.recv(1024)
-        if inbound_message:
-            self.log.message_received(addr, inbound_message)
-            # When only one client is connected, sent messages have nowhere to go
-            if len(self.client_conn_addr_map) == 1:
-                self._sendall(conn, 'Message not delivered... ' +
-                    'Waiting for peers to connect')
+        inbound_messages = self._receive_frames(connection)
+        if inbound_messages is None:
+            self._remove_client(connection.sock)
+            return
+        self._route_frames(connection, inbound_messages)
+
+    def _route_frames(self, connection, inbound_messages):
+        """Act on frames read from a client, as far as its rate limits
+             allow
+        """
+
+        conn = connection.sock
+        admitted = self._admit_frames(connection, inbound_messages)
+        held = None
+        if admitted < len(inbound_messages):
+            held = inbound_messages[admitted:]
+            inbound_messages = inbound_messages[:admitted]
+        acked = chunked = False
+        for kind, inbound_message in inbound_messages:
+            if kind == JOIN_ROOM:
+                self._join_room(connection, inbound_message)
+                continue
+            if kind == REPLAY_HISTORY:
+                self._start_replay(connection, inbound_message)
+                continue
+            if kind == RESUME_SESSION:
+                self._resume_session(connection, inbound_message)
+                continue
+            if kind == FILE_CHUNK:
+                chunked |= self._relay_file_chunk(connection, inbound_message)
+                continue
+            if kind == SESSION_MESSAGE:
+                inbound_message = self._receive_session_message(
+                    connection, inbound_message)
+                if inbound_message is None:
+                    continue
+                acked = True
+            elif kind != PEER_MESSAGE or connection.room is None:
+                # Clients may only send ciphertext for the peers in their room
+                continue
+            self.metrics.messages_received.inc()
+            self.log.message_received(connection.peer_id, inbound_message)
+            # When alone in the room, sent messages have nowhere to go
+            if self._room_size(connection.room) == 1:
+                if self.history is None:
+                    self._sendall(conn, 'Message not delivered... ' +
+                        'Waiting for peers to connect')
+                else:
+                    self.history.append(connection.room, inbound_message)
+                    self._sendall(conn, 'No peers connected... ' +
+                        'Message saved for peers who join later')
+            else:
+                started = time.time()
+                self._relay_message(
+                    inbound_message, conn, PEER_MESSAGE, connection.room)
+                self.metrics.relay_seconds.observe(time.time() - started)
+        if acked or chunked:
+            # One acknowledgement covers every message in the read
+            if connection.ack_held or (
+                    chunked and self._room_congested(connection)):
+                self._hold_ack(connection)
+            else:
+                self._send_ack(connection)
+        if held is not None:
+            self._throttle(connection, held)
+
+    def _admit_frames(self, connection, frames):
+        """Charge frames to a client's rate limits
+
+           Returns how many of them, from the first, are within the limits
+        """
+
+        message_bucket = connection.message_bucket
+        byte_bucket = connection.byte_bucket
+        if message_bucket is None and byte_bucket is None:
+            return len(frames)
+        now = time.time()
+        for admitted, (kind, payload) in enumerate(frames):
+            if message_bucket is not None:
+                if not message_bucket.ready(now):
+                    return admitted
+            if byte_bucket is not None:
+                if not byte_bucket.ready(now):
+                    return admitted
+                byte_bucket.take(len(payload))
+            if message_bucket is not None:
+                message_bucket.take(1)
+        return len(frames)
+
+    def _throttle(self, connection, held):
+        """Apply the rate limit policy to a client that went over its limits
+
+           A throttled client's socket is left unread until the frames held
+             back have been routed
+        """
+
+        self.metrics.rate_limited.inc()
+        if self.rate_limit_policy == 'disconnect':
+            self.log.rate_limited(connection.peer_id)
+            self.failed_clients.append(connection.sock)
+            return
+        connection.held = held
+        if not connection.paused:
+            connection.paused = True
+            self._update_events(connection)
+        wait = max(bucket.wait() for bucket in (
+            connection.message_bucket, connection.byte_bucket)
+            if bucket is not None)
+        self._call_later(wait, lambda: self._release_frames(connection))
+
+    def _release_frames(self, connection):
+        """Route the frames held back from a throttled client, and read
+             from it again once they all have been
+        """
+
+        if connection not in self.registry:
+            return
+        held = connection.held
+        connection.held = None
+        try:
+            self._route_frames(connection, held)
+        except Exception, e:
+            self._drop_after_error(connection, e)
+            return
+        if connection.held is None and connection in self.registry:
+            connection.paused = False
+            self._update_events(connection)
+
+    def _relay_message(self, message, conn, kind, room):
+        """Send message to every member of room but sender"""
+
+        self._deliver(message, conn, kind, room)
+
+    def _deliver(self, message, conn, kind, room):
+        """Send message to every member of room connected to this server,
+             except conn
+
+           The frame is encoded once, and the same immutable string is
+             queued for every recipient, so the work done per message doesn't
+             grow with the size of the room. Once stored in the history, a
+             message is sent to clients with a session headed by its sequence
+             number, so that they know where to resume from. Each frame is
+             only encoded if a recipient needs it.
+
+           Recipients are taken from a snapshot of the room's membership,
+             which is iterated as it is. See registry.py
+        """
+
+        seq = None
+        if kind == PEER_MESSAGE and self.history is not None:
+            seq = self.history.append(room, message)
+        frame = sequenced = None
+        if kind == FILE_CHUNK:
+            # Already a whole frame, passed on untouched. See framing.py
+            frame = message
+        members = self.registry.members(room)
+        # A local sender is always a member of the room it sends to
+        self.metrics.messages_delivered.inc(len(members) - (conn is not None))
+        for client in members:
+            if client.sock is conn:
+                continue
+            if seq is not None and client.session is not None:
+                if sequenced is None:
+                    sequenced = encode_frame(
+                        SEQUENCE_HEADER.pack(seq) + message, ROOM_MESSAGE)
+                self._send_to(client, sequenced)
             else:
-                self._relay_message(inbound_message, conn)
+                if frame is None:
+                    frame = encode_frame(message, kind)
+                self._send_to(client, frame, control=kind == FILE_CHUNK)
+
+    def _start_replay(self, connection, payload):
+        """Begin streaming the history of a client's room to it
+
+           Without history there is nothing to replay. Every client asks on
+             joining, so the request is ignored rather than answered with a
+             notice on every connection
+        """
+
+        if connection.room is None or self.history is None:
+            return
+        if len(payload) != REPLAY_HEADER.size:
+            self.failed_clients.append(connection.sock)
+            return
+        from_seq = REPLAY_HEADER.unpack(payload)[0]
+        connection.replay = self.history.cursor(connection.room, from_seq)
+        self._continue_replay(connection)
+        self._schedule_flush(connection)
+
+    def _continue_replay(self, connection):
+        """Queue the next batch of a replay in progress"""
+
+        cursor = connection.replay
+        for frame in cursor.read(self.replay_batch):
+            connection.outbound.push(frame)
+        if cursor.done():
+            connection.replay = None
+            connection.outbound.push(
+                encode_frame('End of room history', SERVER_NOTICE))
+
+    def _resume_session(self, connection, payload):
+        """Attach a client to the session it names, or open a new one
+
+           The client is always told the token of the session it now has. A
+             resumed session replays what the room relayed after the last
+             message the client received. Without history to replay, the
+             client is told it may have missed messages
+        """
+
+        if connection.room is None or connection.session is not None:
+            return
+        if len(payload) not in (RESUME_HEADER.size,
+                                RESUME_HEADER.size + SESSION_TOKEN_SIZE):
+            self.failed_clients.append(connection.sock)
+            return
+        last_seq = RESUME_HEADER.unpack_from(payload)[0]
+        session = self.sessions.get(payload[RESUME_HEADER.size:])
+        resumed = session is not None and session.room == connection.room
+        if resumed:
+            if session.connection is not None:
+                # Connection was lost before the server noticed
+                session.connection.session = None
+                self.failed_clients.append(session.connection.sock)
+            session.connection = connection
+            self.metrics.sessions_resumed.inc()
+            self.log.session_resumed(connection.peer_id)
         else:
-            # If no data received
-            self._remove_client(conn)
+            token = os.urandom(SESSION_TOKEN_SIZE)
+            session = self.sessions[token] = Session(
+                token, connection.room, connection)
+        connection.session = session
+        self._send_to(connection, encode_frame(session.token, SESSION_TOKEN),
+                      control=True)
+        if not resumed:
             return
+        if self.history is not None:
+            connection.replay = self.history.cursor(
+                connection.room, last_seq + 1)
+            self._continue_replay(connection)
+        else:
+            self._sendall(connection.sock,
+                          'Session resumed, but message history is not kept '
+                          'on this server. Messages the room sent while '
+                          'disconnected may be missing')
 
-    def _relay_message(self, message, conn):
-        """Send message to every client but sender"""
+    def _receive_session_message(self, connection, payload):
+        """Unpack a message numbered by the client's session
+
+           Returns its ciphertext, or None when it has been received already
+             or the client has no session
+        """
+
+        session = connection.session
+        if session is None or len(payload) < SEQUENCE_HEADER.size:
+            return None
+        seq = SEQUENCE_HEADER.unpack_from(payload)[0]
+        if seq <= session.acked:
+            # Sent again after a reconnect, but arrived the first time
+            self.metrics.duplicate_messages.inc()
+            return None
+        session.acked = seq
+        return payload[SEQUENCE_HEADER.size:]
+
+    def _relay_file_chunk(self, connection, frame):
+        """Pass a file chunk on to the rest of the client's room
+
+           The frame the chunk arrived in is queued for every recipient as it
+             is, and written from a memoryview of it, so its ciphertext is
+             never copied or encoded again. Chunks are never stored in the
+             history. Returns whether the chunk is to be acknowledged
+        """
+
+        session = connection.session
+        if session is None or connection.room is None or (
+                len(frame) < HEADER.size + SEQUENCE_HEADER.size):
+            return False
+        seq = SEQUENCE_HEADER.unpack_from(frame, HEADER.size)[0]
+        if seq <= session.acked:
+            # Sent again after a reconnect, but arrived the first time
+            self.metrics.duplicate_messages.inc()
+            return True
+        session.acked = seq
+        self.metrics.file_chunks.inc()
+        if self._room_size(connection.room) > 1:
+            self._relay_message(frame, connection.sock, FILE_CHUNK,
+                                connection.room)
+        return True
+
+    def _send_ack(self, connection):
+        """Acknowledge the session messages received from a client
+
+           The client has been sent every room message stored so far, other
+             than its own, so the acknowledgement also says how far it has
+             caught up
+        """
+
+        last_seq = 0
+        if self.history is not None:
+            last_seq = self.history.last_seq(connection.room)
+        self._send_to(connection, encode_frame(
+            ACK_HEADER.pack(connection.session.acked, last_seq), MESSAGE_ACK),
+            control=True)
+
+    def _room_congested(self, connection):
+        """Whether any other member of a client's room is a slow consumer"""
+
+        for member in self.registry.members(connection.room):
+            if member is not connection and member.outbound.congested:
+                return True
+        return False
+
+    def _hold_ack(self, connection):
+        """Hold back a client's acknowledgement while its room has slow
+             consumers
+
+           A client sending a file stops once max_in_flight chunks are
+             unacknowledged, so the transfer goes at the pace of the slowest
+             member, rather than outrunning it. See _release_acks
+        """
+
+        connection.ack_held = True
+        self.held_acks.setdefault(connection.room, set()).add(connection)
+
+    def _release_acks(self, room):
+        """Send the acknowledgements held back for members of room, once
+             no other member is a slow consumer
+        """
+
+        waiting = self.held_acks.get(room)
+        if waiting is None:
+            return
+        for connection in list(waiting):
+            if not self._room_congested(connection):
+                waiting.discard(connection)
+                connection.ack_held = False
+                self._send_ack(connection)
+        if not waiting:
+            del self.held_acks[room]
+
+    def _detach_session(self, connection):
+        """Keep a lost client's session for session_ttl seconds"""
+
+        session = connection.session
+        session.connection = None
+        session.detached_at = time.time()
+        self._call_later(self.session_ttl,
+                         lambda: self._expire_session(session))
+
+    def _expire_session(self, session):
+        """Forget a session, unless its client has come back since"""
+
+        if session.connection is not None or (
+                time.time() - session.detached_at < self.session_ttl):
+            return
+        if self.sessions.get(session.token) is session:
+            del self.sessions[session.token]
 
-        for client in self.client_conn_addr_map.keys():
-            if client != conn:
-                try:
-                    self._sendall(client, message)
-                except socket.error:
-                    self._remove_client(client)
+    def _room_size(self, room):
+        """Number of clients that have joined room"""
+
+        return self.registry.room_size(room)
+
+    def _room_changed(self, room):
+        """Called after a client joins or leaves room"""
+
+        pass
+
+    def _is_idle(self):
+        """Whether no clients remain to be served"""
+
+        return not self.registry
 
     def _remove_client(self, conn):
         """Remove unresponsive client connection"""
 
-        removed_client_addr = self.client_conn_addr_map[conn]
-        del self.client_conn_addr_map[conn]
-        self.log.client_disconnect(removed_client_addr)
-        # Notify remaining clients of disconnection
-        self._relay_message('Peer disconnected', conn)
+        connection = self.registry.get(conn)
+        if connection is None:
+            # Already removed while handling an earlier event
+            return
+        self.registry.remove(connection)
+        self.pending_writes.discard(connection)
+        self._release_buffers(connection)
+        room = connection.room
+        self.poller.unregister(conn.fileno())
+        self.log.client_disconnect(connection.peer_id)
         conn.close()
-        self._update_peer_count()
-        # No more client connections, kill server
-        if not self.client_conn_addr_map:
-            self._shutdown()
+        if connection.session is not None:
+            self._detach_session(connection)
+        if room is not None:
+            self.held_acks.get(room, set()).discard(connection)
+            # It may have been the slow consumer the rest were waiting on
+            self._release_acks(room)
+            counts = self.room_codecs[room]
+            for codec in connection.codecs:
+                counts[codec] -= 1
+                if not counts[codec]:
+                    del counts[codec]
+            if not self.registry.room_size(room):
+                del self.room_codecs[room]
+                self.announced_codecs.pop(room, None)
+            # Notify remaining members of disconnection
+            self._presence_changed(room, left=1)
+            self._room_changed(room)
+        # No more client connections, kill server once the grace period ends
+        self._check_idle()
+
+    def _announce_codecs(self, room, newcomers=()):
+        """Tell members of room which optional codecs they all have
+
+           Members are only told when that changes, except for members that
+             have just joined, which are always told unless there are none.
+             Members of other servers aren't counted by room_codecs, so
+             while there are any, no optional codec is announced.
+        """
+
+        members = self.registry.members(room)
+        if not members:
+            return
+        size = self._room_size(room)
+        codecs = frozenset(
+            codec for codec, count in self.room_codecs[room].items()
+            if count == size)
+        if codecs != self.announced_codecs.get(room, frozenset()):
+            self.announced_codecs[room] = codecs
+            recipients = members
+        elif codecs and newcomers:
+            recipients = [client for client in newcomers
+                          if client.room == room]
+        else:
+            return
+        frame = encode_frame(','.join(sorted(codecs)), ROOM_CODECS)
+        for client in recipients:
+            self._send_to(client, frame)
+
+    def _check_idle(self):
+        """Start the idle grace period if no clients remain
+
+           Called whenever a client may have been the last to leave
+        """
 
-    def _update_peer_count(self):
-        """Notify connected clients with number of connected peers"""
+        if self.idle_started is not None or not self._is_idle():
+            return
+        self.idle_started = time.time()
+        self.metrics.idle_periods.inc()
+        if not self.idle_grace:
+            self._idle_expired(self._idle_generation)
+            return
+        self.log.idle(self.idle_grace)
+        generation = self._idle_generation
+        self._call_later(self.idle_grace,
+                         lambda: self._idle_expired(generation))
+
+    def _leave_idle(self):
+        """End the idle grace period, as a client has arrived"""
+
+        if self.idle_started is None:
+            return
+        self.metrics.idle_seconds.observe(time.time() - self.idle_started)
+        self.metrics.idle_reconnects.inc()
+        self.idle_started = None
+        # Disarms the timer of the grace period that just ended
+        self._idle_generation += 1
+
+    def _idle_expired(self, generation):
+        """Shut down if the grace period ended without a client arriving"""
+
+        if generation != self._idle_generation or not self._is_idle():
+            return
+        self.metrics.idle_seconds.observe(time.time() - self.idle_started)
+        self._shutdown()
 
-        for client in self.client_conn_addr_map.keys():
-            self._sendall(client, 'Number of connected peers: ' + str(
-                len(self.client_conn_addr_map) - 1))
+    def _presence_changed(self, room, joined=0, left=0, newcomer=None):
+        """Record joins and leaves in room, to be announced together
+
+           The first change since the last announcement schedules the next
+             one, presence_interval seconds later
+        """
+
+        if not self.presence_changes:
+            self._call_later(self.presence_interval, self._announce_presence)
+        change = self.presence_changes.get(room)
+        if change is None:
+            change = self.presence_changes[room] = PresenceChange()
+        change.joined += joined
+        change.left += left
+        if newcomer is not None:
+            change.newcomers.add(newcomer)
+
+    def _announce_presence(self):
+        """Tell the members of every changed room who came and went
+
+           Each room's frames are encoded once, one for existing members and
+             one for newcomers, however many members there are
+        """
+
+        changes = self.presence_changes
+        self.presence_changes = dict()
+        for room, change in changes.items():
+            members = self.registry.members(room)
+            if not members:
+                continue
+            peers = self._room_size(room) - 1
+            update = encode_frame(ROOM_PRESENCE_HEADER.pack(
+                change.joined, change.left, peers), ROOM_PRESENCE)
+            greeting = None
+            for client in members:
+                if client not in change.newcomers:
+                    self._send_to(client, update)
+                    continue
+                if greeting is None:
+                    greeting = encode_frame(
+                        ROOM_PRESENCE_HEADER.pack(0, 0, peers), ROOM_PRESENCE)
+                self._send_to(client, greeting)
+            # Room size changed, and with it the codecs every member has
+            self._announce_codecs(room, change.newcomers)
 
     def _shutdown(self):
         """End service session
 
-           The subprocess is interrupted to handle TIME_WAIT.
-             See http://man7.org/linux/man-pages/man8/netstat.8.html
+           Stops the event loop. The listening socket is closed on the way
+             out of _run, which returns control to the caller of start().
         """
 
         self.log.shutdown()
-        self.socket.close()
-        pid = os.getpid()
-        psutil.Process(pid).send_signal(signal.SIGINT)
+        self._running = False
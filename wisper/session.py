@@ -1,7 +1,13 @@
+import argparse
 import time
 
 from client import Client
-from server import Server
+from federation import FederatedServer
+from server import SLOW_CONSUMER_POLICIES, Server
+from workers import run_workers
+from history import MessageHistory
+from limits import RATE_LIMIT_POLICIES
+from utils import LOG_LEVELS, ServerLog
 from aws.api_gateway import lambda_proxy
 from encryption import Cipher, generate_secret_key
 from multiprocessing.pool import ThreadPool
@@ -15,21 +21,229 @@ from multiprocessing.pool import ThreadPool
 """
 
 
+# Room joined when the user doesn't name one
+DEFAULT_ROOM = 'lobby'
+
+
 def run_server():
     """Run a server instance
 
        This function runs on EC2 instance when 'wisper-runserver' is run in the
          console by a Lambda function. See aws.EC2.run_wisper_server
+
+       'wisper-runserver --workers N' spreads clients across N processes,
+         one per core. See workers.py
+
+       'wisper-runserver --link-port PORT --peer HOST:PORT
+         --link-secret-file FILE' runs a node that shares its rooms with
+         other nodes. See federation.py
     """
 
-    new_server = Server()
-    new_server.start()
+    parser = argparse.ArgumentParser(prog='wisper-runserver')
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='number of server processes to run (default: 1)')
+    parser.add_argument(
+        '--link-port', type=int,
+        help='port to accept links from other federated nodes on')
+    parser.add_argument(
+        '--link-host', default='127.0.0.1',
+        help='interface to accept links on. Set it to one other nodes can '
+             'reach (default: 127.0.0.1)')
+    parser.add_argument(
+        '--link-secret-file', metavar='FILE',
+        help='file holding the secret every federated node shares. Links '
+             'are only trusted once they prove they hold it. Required with '
+             'federation')
+    parser.add_argument(
+        '--peer', action='append', default=[], type=parse_address,
+        help='HOST:PORT link address of a federated node to link to. '
+             'May be repeated')
+    parser.add_argument(
+        '--write-batch', type=int, default=65536, metavar='BYTES',
+        help='most bytes of queued messages written to a client at once. '
+             '0 writes one message at a time (default: 65536)')
+    parser.add_argument(
+        '--no-write-coalescing', dest='write_coalescing',
+        action='store_false',
+        help='write each message as soon as it is relayed, rather than '
+             'once per pass of the event loop. Lowers latency, costs more '
+             'system calls')
+    parser.add_argument(
+        '--metrics-port', type=int,
+        help='local port to serve Prometheus metrics on, at /metrics. '
+             'Worker N serves on this port + N')
+    parser.add_argument(
+        '--log-level', choices=sorted(LOG_LEVELS, key=LOG_LEVELS.get),
+        default='info', help='least severe events to log (default: info)')
+    parser.add_argument(
+        '--log-sample', type=int, default=1, metavar='N',
+        help='log only 1 in N messages received (default: 1)')
+    parser.add_argument(
+        '--log-payloads', action='store_true',
+        help='log the ciphertext of messages received, not just their size')
+    parser.add_argument(
+        '--idle-grace', type=float, default=300, metavar='SECONDS',
+        help='seconds to keep the server and its instance up once the last '
+             'peer leaves, in case one reconnects (default: 300)')
+    parser.add_argument(
+        '--presence-interval', type=float, default=0.05, metavar='SECONDS',
+        help='seconds joins and leaves are gathered for before peers are '
+             'told of them together (default: 0.05)')
+    parser.add_argument(
+        '--session-ttl', type=float, default=60, metavar='SECONDS',
+        help='seconds a disconnected peer can resume its session for '
+             '(default: 60)')
+    parser.add_argument(
+        '--max-connections', type=int, default=0, metavar='N',
+        help='most peers connected at once, per worker. 0 for no limit '
+             '(default: 0)')
+    parser.add_argument(
+        '--message-rate', type=float, default=0, metavar='N',
+        help='messages per second each peer may send, in bursts of up to '
+             '50. 0 for no limit (default: 0)')
+    parser.add_argument(
+        '--byte-rate', type=float, default=0, metavar='BYTES',
+        help='bytes per second each peer may send, in bursts of up to '
+             '262144. 0 for no limit (default: 0)')
+    parser.add_argument(
+        '--rate-limit-policy', choices=RATE_LIMIT_POLICIES,
+        default='throttle',
+        help='whether peers sending too fast are slowed down or '
+             'disconnected (default: throttle)')
+    parser.add_argument(
+        '--high-watermark', type=int, default=1048576, metavar='BYTES',
+        help='bytes queued for a peer at which it is a slow consumer '
+             '(default: 1048576)')
+    parser.add_argument(
+        '--low-watermark', type=int, default=262144, metavar='BYTES',
+        help='bytes queued for a slow consumer at which it is caught up '
+             'again (default: 262144)')
+    parser.add_argument(
+        '--slow-consumer-policy', choices=SLOW_CONSUMER_POLICIES,
+        default='drop',
+        help='whether messages for a slow consumer are dropped, replaced '
+             'by a notice of how many were skipped, or the peer '
+             'disconnected (default: drop)')
+    parser.add_argument(
+        '--recv-buffer-limit', type=int, default=1048576, metavar='BYTES',
+        help='largest message a peer may send (default: 1048576)')
+    parser.add_argument(
+        '--send-buffer-limit', type=int, default=4194304, metavar='BYTES',
+        help='most bytes queued for a peer before it is disconnected '
+             '(default: 4194304)')
+    parser.add_argument(
+        '--max-buffered-bytes', type=int, default=0, metavar='BYTES',
+        help='most bytes buffered across every peer, per worker. Peers '
+             'buffering the most are disconnected past it. 0 for no limit '
+             '(default: 0)')
+    parser.add_argument(
+        '--link-buffer-limit', type=int, default=16777216, metavar='BYTES',
+        help='most bytes queued for a worker or federated node before its '
+             'link is dropped (default: 16777216)')
+    parser.add_argument(
+        '--history-dir', metavar='DIR',
+        help='keep room history in DIR, for clients that join later')
+    parser.add_argument(
+        '--history-messages', type=int, default=10000, metavar='N',
+        help='messages of history to keep, across rooms (default: 10000)')
+    parser.add_argument(
+        '--history-bytes', type=int, default=67108864, metavar='BYTES',
+        help='bytes of history to keep on disk (default: 67108864)')
+    parser.add_argument(
+        '--history-age', type=float, default=86400, metavar='SECONDS',
+        help='seconds to keep history for (default: 86400)')
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    federated = args.link_port is not None or args.peer
+    if federated and args.workers > 1:
+        parser.error('--workers cannot be combined with federation')
+    link_secret = None
+    if federated:
+        if args.link_secret_file is None:
+            parser.error('federation needs --link-secret-file')
+        with open(args.link_secret_file) as secret_file:
+            link_secret = secret_file.read().strip()
+        if not link_secret:
+            parser.error('--link-secret-file is empty')
+    if args.write_batch < 0:
+        parser.error('--write-batch cannot be negative')
+    if args.log_sample < 1:
+        parser.error('--log-sample must be at least 1')
+    if args.idle_grace < 0:
+        parser.error('--idle-grace cannot be negative')
+    if args.session_ttl < 0:
+        parser.error('--session-ttl cannot be negative')
+    if args.presence_interval < 0:
+        parser.error('--presence-interval cannot be negative')
+    if args.max_connections < 0:
+        parser.error('--max-connections cannot be negative')
+    if args.message_rate < 0 or args.byte_rate < 0:
+        parser.error('--message-rate and --byte-rate cannot be negative')
+    if args.recv_buffer_limit < 1:
+        parser.error('--recv-buffer-limit must be at least 1')
+    if not 0 <= args.low_watermark < args.high_watermark:
+        parser.error('--low-watermark must be at least 0 and less than '
+                     '--high-watermark')
+    if args.send_buffer_limit < args.high_watermark:
+        parser.error('--send-buffer-limit must be at least --high-watermark')
+    if args.max_buffered_bytes < 0:
+        parser.error('--max-buffered-bytes cannot be negative')
+    if args.link_buffer_limit < 1:
+        parser.error('--link-buffer-limit must be at least 1')
+    server_options = dict(write_coalescing=args.write_coalescing,
+                          max_write_batch=args.write_batch,
+                          metrics_port=args.metrics_port,
+                          idle_grace=args.idle_grace,
+                          session_ttl=args.session_ttl,
+                          presence_interval=args.presence_interval,
+                          high_watermark=args.high_watermark,
+                          low_watermark=args.low_watermark,
+                          slow_consumer_policy=args.slow_consumer_policy,
+                          max_connections=args.max_connections,
+                          message_rate=args.message_rate,
+                          byte_rate=args.byte_rate,
+                          rate_limit_policy=args.rate_limit_policy,
+                          recv_buffer_limit=args.recv_buffer_limit,
+                          send_buffer_limit=args.send_buffer_limit,
+                          max_buffered_bytes=args.max_buffered_bytes,
+                          log=ServerLog(level=args.log_level,
+                                        sample_every=args.log_sample,
+                                        payloads=args.log_payloads))
+    if federated or args.workers > 1:
+        server_options['link_buffer_limit'] = args.link_buffer_limit
+    if args.history_dir is not None:
+        server_options['history'] = MessageHistory(
+            args.history_dir, max_messages=args.history_messages,
+            max_bytes=args.history_bytes, max_age=args.history_age)
+
+    if federated:
+        new_server = FederatedServer(
+            link_port=args.link_port, peers=args.peer,
+            link_host=args.link_host, link_secret=link_secret,
+            **server_options)
+        new_server.start()
+    elif args.workers == 1:
+        new_server = Server(**server_options)
+        new_server.start()
+    else:
+        run_workers(args.workers, **server_options)
     print 'Stopping EC2 server instance...'
     lambda_proxy('stop_instance')
     print 'Server stopped.'
     exit(0)
 
 
+def parse_address(address):
+    """Parse a HOST:PORT command line argument into a (host, port) tuple"""
+
+    host, _, port = address.rpartition(':')
+    if not host or not port.isdigit():
+        raise argparse.ArgumentTypeError('Expected HOST:PORT, got ' + address)
+    return host, int(port)
+
+
 def run_client():
     """Start a new chat session
 
@@ -72,6 +286,7 @@ class Session(object):
 
        cipher: (Cipher) Object used by Client to encrypt/decrypt messages
        alias: (str) Username for the session
+       room: (str) Name of the room to join on the server
        client: (Client) The new Client instance that will be started
     """
 
@@ -82,6 +297,7 @@ class Session(object):
         self.port = 4440
         self.cipher = None
         self.alias = None
+        self.room = None
         self.client = None
 
     def start_client(self, ec2_async_result):
@@ -90,8 +306,10 @@ class Session(object):
         self._generate_new_secret_key()
         self.cipher = self._construct_cipher()
         self.alias = self._set_alias()
+        self.room = self._set_room()
         self.host = fetch_async_host_address(ec2_async_result)
-        self.client = Client(self.host, self.port, self.alias, self.cipher)
+        self.client = Client(
+            self.host, self.port, self.alias, self.cipher, self.room)
         self.client.start()
 
     @staticmethod
@@ -121,6 +339,14 @@ class Session(object):
             entered_alias = raw_input('Enter alias: ')
         return entered_alias
 
+    def _set_room(self):
+        entered_room = raw_input('Enter room (blank for %s): ' % DEFAULT_ROOM)
+        while entered_room and not entered_room.isalnum():
+            print 'Room must only contain alphanumeric characters'
+            entered_room = raw_input(
+                'Enter room (blank for %s): ' % DEFAULT_ROOM)
+        return entered_room or DEFAULT_ROOM
+
 
 def fetch_async_host_address(ec2_async_result):
     """Retrieve EC2 Instance public IPv4 address from async thread pool"""
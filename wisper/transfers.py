@@ -0,0 +1,163 @@
+import hashlib
+import os
+
+from protobuf import serialize_chunk
+
+
+"""File transfers between the members of a room
+
+   A file is sent as a run of FILE_CHUNK frames, each encrypted on its own,
+     so neither end ever holds more of it than a chunk. The sender reads the
+     file a chunk at a time, and the receiver writes each chunk straight to
+     disk, checking the digest carried by the last chunk once the file is
+     complete. The server relays chunks without looking inside them.
+     See framing.py
+"""
+
+
+# Bytes of the file carried by each chunk
+CHUNK_SIZE = 65536
+
+# Random bytes identifying a transfer
+TRANSFER_ID_SIZE = 16
+
+# Appended to the name of a file while it is being received
+PARTIAL_SUFFIX = '.part'
+
+
+class TransferError(ValueError):
+    """Raised when a file being received doesn't match what was sent"""
+
+
+class OutgoingTransfer(object):
+    """File being sent to the room
+
+       transfer_id: (str) Random bytes every chunk of the transfer carries
+       name: (str) File name the receivers are given, without its directory
+       size: (int) Bytes in the file when the transfer started
+       file: (file) Open file, None once the last chunk has been read
+       hasher: (hashlib.sha256) Digest of the chunks read so far
+       index: (int) Number of the next chunk
+       sent: (int) Bytes of the file read into chunks so far
+    """
+
+    def __init__(self, path, sender, chunk_size=CHUNK_SIZE):
+        self.file = open(path, 'rb')
+        self.transfer_id = os.urandom(TRANSFER_ID_SIZE)
+        self.sender = sender
+        self.name = os.path.basename(path)
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.chunk_size = chunk_size
+        self.hasher = hashlib.sha256()
+        self.index = 0
+        self.sent = 0
+
+    def done(self):
+        return self.file is None
+
+    def next_chunk(self):
+        """Read and serialize the next chunk
+
+           The first chunk names the file, and the last carries its digest.
+             An empty file is sent as a single chunk that does both
+        """
+
+        data = self.file.read(min(self.chunk_size, self.size - self.sent))
+        if len(data) < min(self.chunk_size, self.size - self.sent):
+            self.close()
+            raise TransferError('%s was truncated while being sent' % (
+                self.name))
+        self.hasher.update(data)
+        self.sent += len(data)
+        name = size = digest = None
+        if not self.index:
+            name, size = self.name, self.size
+        if self.sent == self.size:
+            digest = self.hasher.digest()
+            self.close()
+        chunk = serialize_chunk(self.transfer_id, self.sender, self.index,
+                                data, name, size, digest)
+        self.index += 1
+        return chunk
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class IncomingTransfer(object):
+    """File being received from a peer
+
+       Chunks are written to a partial file next to where the file will be
+         saved, which is renamed into place once the digest checks out.
+
+       sender: (str) Alias of the peer sending the file
+       name: (str) File name the sender gave
+       size: (int) Bytes the file is said to hold
+       path: (str) Where the file will be saved
+       file: (file) Open partial file
+       hasher: (hashlib.sha256) Digest of the chunks received so far
+       next_index: (int) Number of the chunk expected next
+       received: (int) Bytes of the file received so far
+    """
+
+    def __init__(self, chunk, directory):
+        if chunk.index or not chunk.HasField('name'):
+            raise TransferError('Transfer started part way through')
+        self.sender = chunk.sender
+        self.name = chunk.name
+        self.size = chunk.size
+        # Never trust a peer with anything but a bare file name
+        name = os.path.basename(chunk.name.replace('\\', '/'))
+        if name in ('', '.', '..'):
+            name = 'file'
+        self.path = self._unused_path(directory, name)
+        self.file = open(self.path + PARTIAL_SUFFIX, 'wb')
+        self.hasher = hashlib.sha256()
+        self.next_index = 0
+        self.received = 0
+
+    @staticmethod
+    def _unused_path(directory, name):
+        """Path in directory for name that no file has yet"""
+
+        path = os.path.join(directory, name)
+        root, extension = os.path.splitext(path)
+        copy = 1
+        while os.path.exists(path) or os.path.exists(path + PARTIAL_SUFFIX):
+            path = '%s (%d)%s' % (root, copy, extension)
+            copy += 1
+        return path
+
+    def add(self, chunk):
+        """Write the next chunk to disk
+
+           Returns whether the file is complete. Raises TransferError when a
+             chunk is missing, or the file doesn't match its digest
+        """
+
+        if chunk.index != self.next_index:
+            raise TransferError('Chunk %d of %s never arrived' % (
+                self.next_index, self.name))
+        self.received += len(chunk.data)
+        if self.received > self.size:
+            raise TransferError('%s is larger than its sender said' % (
+                self.name))
+        self.file.write(chunk.data)
+        self.hasher.update(chunk.data)
+        self.next_index += 1
+        if not chunk.HasField('digest'):
+            return False
+        self.file.close()
+        if (self.received != self.size or
+                chunk.digest != self.hasher.digest()):
+            raise TransferError('%s does not match its digest' % self.name)
+        os.rename(self.path + PARTIAL_SUFFIX, self.path)
+        return True
+
+    def abort(self):
+        """Close and delete the partial file"""
+
+        self.file.close()
+        os.remove(self.path + PARTIAL_SUFFIX)
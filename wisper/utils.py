@@ -1,32 +1,166 @@
+import sys
+import threading
+import time
+from collections import deque
 from contextlib import contextmanager
 
 
+# Log levels, by name. Events below the level of a ServerLog are ignored
+LOG_LEVELS = {'debug': 10, 'info': 20, 'warning': 30}
+
+
 class ServerLog(object):
-    """Anonymous event logger for TCP servers"""
+    """Anonymous event logger for TCP servers
+
+       Logging never blocks the server. Events are appended to a bounded ring
+         buffer, and a background thread formats and writes them out. When
+         the buffer is full, the oldest events are dropped, and the number
+         dropped is logged in their place.
+
+       Messages are logged by size, and only 1 in sample_every of them.
+         Payloads are only logged when asked for.
+
+       level: (int) Least severe level logged. See LOG_LEVELS
+       sample_every: (int) Log one message out of every this many
+       payloads: (bool) Whether message payloads are logged. Peers are
+         named by the ids the server's registry gives them, never by their
+         addresses. See registry.py
+       buffer: (deque) Events waiting to be written, as (timestamp, format,
+         args) tuples
+       dropped: (int) Events lost to a full buffer. Only counted up by the
+         server thread, so no lock is needed
+       reported_dropped: (int) Value of dropped when last reported
+       stream: (file) Where events are written
+       flush_interval: (float) Seconds between writes
+    """
+
+    def __init__(self, level='info', sample_every=1, payloads=False,
+                 capacity=8192, stream=None, flush_interval=0.1):
+        if level not in LOG_LEVELS:
+            raise ValueError('Invalid log level: %s' % level)
+        if sample_every < 1:
+            raise ValueError('sample_every must be at least 1')
+        self.level = LOG_LEVELS[level]
+        self.sample_every = sample_every
+        self.payloads = payloads
+        self.buffer = deque(maxlen=capacity)
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.stream = stream or sys.stdout
+        self.flush_interval = flush_interval
+        self._messages = 0
+        self._flusher = None
+        self._closed = threading.Event()
+
+    def _log(self, level, format, *args):
+        if level < self.level:
+            return
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append((time.time(), format, args))
+
+    def server_start(self, address):
+        """Start writing events out, and log the server starting
+
+           Called from the process that will run the server, so that workers
+             forked with a ServerLog each start their own flusher
+        """
+
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_forever)
+            self._flusher.daemon = True
+            self._flusher.start()
+        self._log(LOG_LEVELS['info'], 'Wisper server started')
+        self._log(LOG_LEVELS['info'], 'Listening at %s', address)
+
+    def client_connect(self, peer_id):
+        self._log(LOG_LEVELS['info'], 'Peer %d connected', peer_id)
+
+    def room_join(self, peer_id, room):
+        self._log(LOG_LEVELS['info'], 'Peer %d joined room %s', peer_id, room)
+
+    def session_resumed(self, peer_id):
+        self._log(LOG_LEVELS['info'], 'Peer %d resumed its session', peer_id)
+
+    def client_disconnect(self, peer_id):
+        self._log(LOG_LEVELS['info'], 'Peer %d disconnected', peer_id)
+
+    def message_received(self, peer_id, message):
+        self._messages += 1
+        if self._messages % self.sample_every:
+            return
+        if self.payloads:
+            self._log(LOG_LEVELS['info'], 'Received from Peer %d: %s',
+                      peer_id, message)
+        else:
+            self._log(LOG_LEVELS['info'], 'Received %d bytes from Peer %d',
+                      len(message), peer_id)
+
+    def client_rejected(self):
+        self._log(LOG_LEVELS['warning'],
+                  'Server full, turned away a connection')
+
+    def accept_failed(self, error, pause):
+        self._log(LOG_LEVELS['warning'],
+                  'Cannot accept connections: %s, pausing for %g seconds',
+                  error, pause)
+
+    def rate_limited(self, peer_id):
+        self._log(LOG_LEVELS['warning'],
+                  'Peer %d exceeded its rate limits, disconnecting', peer_id)
+
+    def over_budget(self, peer_id, buffered):
+        self._log(LOG_LEVELS['warning'],
+                  'Peer %d holds %d buffered bytes, over budget, '
+                  'disconnecting', peer_id, buffered)
+
+    def client_error(self, peer_id, error):
+        self._log(LOG_LEVELS['warning'], 'Peer %d dropped after error: %r',
+                  peer_id, error)
+
+    def link_error(self, addr, error):
+        self._log(LOG_LEVELS['warning'], 'Link %s dropped after error: %r',
+                  addr, error)
+
+    def idle(self, grace):
+        self._log(LOG_LEVELS['info'],
+                  'No peers connected, shutting down in %g seconds', grace)
+
+    def shutdown(self):
+        self._log(LOG_LEVELS['info'], 'Wisper server shutdown')
 
-    def __init__(self, address):
-        self.address = address
-        self.peers = dict()
+    def close(self):
+        """Stop the flusher, and write out every event left"""
 
-    def server_start(self):
-        print 'Wisper server started'
-        print 'Listening at', self.address
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
 
-    def client_connect(self, addr):
-        peer_id = len(self.peers) + 1
-        self.peers[addr] = peer_id
-        print 'Peer %d connected' % self.peers[addr]
+    def _flush_forever(self):
+        """Body of the flusher thread"""
 
-    def client_disconnect(self, addr):
-        print 'Peer %d disconnected' % self.peers[addr]
-        del self.peers[addr]
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
 
-    def message_received(self, addr, message):
-        print 'Received from Peer %d: %s' % (self.peers[addr], message)
+    def flush(self):
+        """Format and write every buffered event"""
 
-    @staticmethod
-    def shutdown():
-        print 'Wisper server shutdown'
+        lines = []
+        buf = self.buffer
+        dropped = self.dropped
+        if dropped != self.reported_dropped:
+            lines.append('%d log events dropped' % (
+                dropped - self.reported_dropped))
+            self.reported_dropped = dropped
+        while buf:
+            timestamp, format, args = buf.popleft()
+            lines.append('%s %s' % (
+                time.strftime('%H:%M:%S', time.localtime(timestamp)),
+                format % args))
+        if lines:
+            self.stream.write('\n'.join(lines) + '\n')
+            self.stream.flush()
 
 
 @contextmanager
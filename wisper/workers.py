@@ -0,0 +1,172 @@
+import errno
+import os
+import socket
+import struct
+import sys
+import traceback
+
+from framing import BUS_PRESENCE, BUS_RELAY, BUS_SHUTDOWN
+from links import LinkError, LinkedServer, decode_relay, encode_relay
+
+
+"""Multi-process server mode
+
+   run_workers forks a number of WorkerServer processes that accept clients
+     from one shared listening socket, so a single instance can serve from
+     every core. See session.run_server
+"""
+
+
+# Number of members a worker has in a room
+PRESENCE_HEADER = struct.Struct('!I')
+
+
+class WorkerServer(LinkedServer):
+    """Server running as one of several worker processes on an instance
+
+       Every pair of workers is joined by a Unix socket. Together the links
+         form a bus that carries relayed messages and room membership counts,
+         so peers on different workers share rooms exactly as they would on
+         a single Server. See links.py
+
+       worker_id: (int) Index of this worker
+    """
+
+    def __init__(self, worker_id, link_sockets, **kwargs):
+        super(WorkerServer, self).__init__(**kwargs)
+        self.worker_id = worker_id
+        for peer_id, sock in link_sockets.items():
+            self._add_link(sock, ('worker', peer_id))
+
+    def _route_link_message(self, link, kind, payload):
+        """Act on a message from another worker"""
+
+        if kind == BUS_RELAY:
+            room, relayed_kind, message = decode_relay(payload)
+            self._deliver(message, None, relayed_kind, room)
+        elif kind == BUS_PRESENCE:
+            if len(payload) < PRESENCE_HEADER.size:
+                raise LinkError('Presence message is missing its count')
+            room = payload[PRESENCE_HEADER.size:]
+            count = PRESENCE_HEADER.unpack_from(payload)[0]
+            self._set_remote_members(room, link.addr[1], count)
+            # The last client on the instance may have left from that worker
+            self._check_idle()
+        elif kind == BUS_SHUTDOWN:
+            # The sender's grace period ended without a client arriving. A
+            #   worker with clients of its own may have joined too late for
+            #   the sender to know about them, so it keeps serving
+            if self._is_idle():
+                self._shutdown()
+
+    def _relay_message(self, message, conn, kind, room):
+        """Send message to every member of room but sender, on every worker"""
+
+        self._deliver(message, conn, kind, room)
+        self._publish(BUS_RELAY, encode_relay(room, kind, message))
+
+    def _room_changed(self, room):
+        """Tell other workers how many members this worker has in room"""
+
+        count = self.registry.room_size(room)
+        self._publish(BUS_PRESENCE, PRESENCE_HEADER.pack(count) + room)
+
+    def _link_removed(self, link):
+        """Forget a worker that has gone away, along with its members"""
+
+        self._forget_remote_members(link.addr[1])
+        self._check_idle()
+
+    def _shutdown(self):
+        """End service session on this worker, and ask the others to follow"""
+
+        if not self._running:
+            # Already shutting down
+            return
+        self._publish(BUS_SHUTDOWN, '')
+        super(WorkerServer, self)._shutdown()
+
+
+def run_workers(workers, host='0.0.0.0', port=4440, **server_options):
+    """Serve one instance from several worker processes
+
+       The listening socket and a Unix socket between every pair of workers
+         are created before forking, so each worker inherits them. Returns
+         once every worker has shut down.
+
+       workers: (int) Number of worker processes to fork
+       server_options: Passed on to each WorkerServer. See server.Server.
+         Each worker serves metrics on metrics_port plus its worker id, and
+         keeps its history in a directory of its own
+    """
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(socket.SOMAXCONN)
+
+    link_sockets = dict((worker_id, dict()) for worker_id in range(workers))
+    for worker_id in range(workers):
+        for peer_id in range(worker_id + 1, workers):
+            pair = socket.socketpair()
+            link_sockets[worker_id][peer_id] = pair[0]
+            link_sockets[peer_id][worker_id] = pair[1]
+
+    pids = []
+    for worker_id in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(worker_id, listener, link_sockets, host, port,
+                        server_options)
+        pids.append(pid)
+
+    # Workers own every socket from here on
+    listener.close()
+    for sockets in link_sockets.values():
+        for sock in sockets.values():
+            sock.close()
+    for pid in pids:
+        _wait_for_worker(pid)
+
+
+def _run_worker(worker_id, listener, link_sockets, host, port,
+                server_options):
+    """Entry point of a forked worker process. Never returns"""
+
+    for other_id, sockets in link_sockets.items():
+        if other_id != worker_id:
+            for sock in sockets.values():
+                sock.close()
+    server_options = dict(server_options)
+    if server_options.get('metrics_port') is not None:
+        server_options['metrics_port'] += worker_id
+    if server_options.get('history') is not None:
+        server_options['history'] = server_options['history'].for_worker(
+            worker_id)
+    exit_code = 0
+    try:
+        WorkerServer(worker_id, link_sockets[worker_id], host=host, port=port,
+                     listener=listener, **server_options).start()
+    except Exception:
+        traceback.print_exc()
+        exit_code = 1
+    sys.stdout.flush()
+    os._exit(exit_code)
+
+
+def _wait_for_worker(pid):
+    """Block until a worker process exits
+
+       KeyboardInterrupt reaches the workers as well, and they shut down on
+         their own, so it is only waited out here
+    """
+
+    while True:
+        try:
+            os.waitpid(pid, 0)
+            return
+        except KeyboardInterrupt:
+            continue
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                return